@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Synthetic company, chart of accounts and General Ledger for benchmarks.
+
+Journal Entries, their accounts and GL Entries are written with bulk inserts
+(already submitted), so a 1M row ledger can be generated in minutes. Only use
+this on a throwaway benchmark site.
+"""
+from __future__ import unicode_literals
+import random
+from datetime import date, timedelta
+import frappe
+from frappe.utils import now
+from zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger import rebuild_company_payment_ledger
+
+# Number of GL Entries per dataset size (each Journal Entry posts two)
+DATASET_SIZES = {
+    "10k": 10000,
+    "100k": 100000,
+    "1m": 1000000,
+}
+
+# Depth and fan-out of each generated account tree
+TREE_DEPTH = 5
+TREE_FANOUT = 2
+
+# Every PAYMENT_EVERY-th Journal Entry is a zakaah payment
+PAYMENT_EVERY = 100
+
+FIRST_YEAR = 2020
+LAST_YEAR = 2024
+INSERT_CHUNK = 10000
+
+
+def get_benchmark_company(size):
+    return f"Zakaah Benchmark {size}"
+
+
+def generate_dataset(size, seed=42):
+    """Create (or reuse) the benchmark company for size and fill its ledger"""
+    if size not in DATASET_SIZES:
+        frappe.throw(f"Unknown dataset size {size}. Use one of {', '.join(DATASET_SIZES)}")
+
+    rng = random.Random(seed)
+    company = _create_company(size)
+    accounts = _create_accounts(company)
+    _create_fiscal_years(company)
+    _create_gold_prices()
+
+    if not frappe.db.exists("GL Entry", {"company": company}):
+        _create_ledger(company, accounts, DATASET_SIZES[size], rng)
+        frappe.db.commit()
+
+    _create_configurations(company, accounts)
+    _create_calculation_runs(company)
+    # The ledger is bulk inserted, so the Journal Entry hooks never filled the payment ledger
+    rebuild_company_payment_ledger(company)
+    frappe.db.commit()
+
+    return {"company": company, "accounts": accounts}
+
+
+def _create_company(size):
+    company = get_benchmark_company(size)
+    if not frappe.db.exists("Company", company):
+        frappe.get_doc({
+            "doctype": "Company",
+            "company_name": company,
+            "abbr": f"ZB{size.upper()}",
+            "default_currency": "EGP",
+            "country": "Egypt",
+            "create_chart_of_accounts_based_on": "Standard Template",
+            "chart_of_accounts": "Standard"
+        }).insert(ignore_permissions=True)
+        frappe.db.commit()
+    return company
+
+
+def _get_root_account(company, root_type):
+    return frappe.get_all("Account",
+                          filters={"company": company, "root_type": root_type, "is_group": 1},
+                          order_by="lft asc", limit=1, pluck="name")[0]
+
+
+def _create_account(company, parent, account_name, is_group):
+    abbr = frappe.get_cached_value("Company", company, "abbr")
+    name = f"{account_name} - {abbr}"
+    if not frappe.db.exists("Account", name):
+        frappe.get_doc({
+            "doctype": "Account",
+            "company": company,
+            "account_name": account_name,
+            "parent_account": parent,
+            "is_group": is_group
+        }).insert(ignore_permissions=True)
+    return name
+
+
+def _create_tree(company, parent, prefix, depth):
+    """Nested group accounts TREE_DEPTH deep; returns (root, leaves)"""
+    root = _create_account(company, parent, prefix, 1)
+    level = [root]
+    for current_depth in range(1, depth + 1):
+        is_group = 1 if current_depth < depth else 0
+        next_level = []
+        for node_idx, node in enumerate(level):
+            for child in range(TREE_FANOUT):
+                next_level.append(_create_account(
+                    company, node, f"{prefix} {current_depth}.{node_idx}.{child}", is_group
+                ))
+        level = next_level
+    return root, level
+
+
+def _create_accounts(company):
+    assets = _get_root_account(company, "Asset")
+    liabilities = _get_root_account(company, "Liability")
+    equity = _get_root_account(company, "Equity")
+
+    accounts = {}
+    for key, parent in (("cash", assets), ("inventory", assets), ("receivables", assets),
+                        ("liabilities", liabilities)):
+        accounts[key], accounts[f"{key}_leaves"] = _create_tree(
+            company, parent, f"Bench {key.title()}", TREE_DEPTH
+        )
+
+    accounts["payment"] = _create_account(company, liabilities, "Bench Zakaah Payable", 0)
+    accounts["capital"] = _create_account(company, equity, "Bench Capital", 0)
+    frappe.db.commit()
+    return accounts
+
+
+def _create_fiscal_years(company):
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        name = str(year)
+        if not frappe.db.exists("Fiscal Year", name):
+            frappe.get_doc({
+                "doctype": "Fiscal Year",
+                "year": name,
+                "year_start_date": date(year, 1, 1),
+                "year_end_date": date(year, 12, 31)
+            }).insert(ignore_permissions=True)
+
+        fiscal_year = frappe.get_doc("Fiscal Year", name)
+        if fiscal_year.get("companies") and company not in [row.company for row in fiscal_year.companies]:
+            fiscal_year.append("companies", {"company": company})
+            fiscal_year.save(ignore_permissions=True)
+
+
+def _create_gold_prices():
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        if not frappe.db.exists("Gold Price", {"price_date": date(year, 12, 31)}):
+            frappe.get_doc({
+                "doctype": "Gold Price",
+                "price_date": date(year, 12, 31),
+                "price_per_gram_24k": 1000 + 500 * (year - FIRST_YEAR),
+                "source": "Benchmark"
+            }).insert(ignore_permissions=True)
+
+
+def _create_ledger(company, accounts, gl_entries, rng):
+    """Bulk insert gl_entries / 2 submitted Journal Entries with their GL Entries"""
+    start = date(FIRST_YEAR, 1, 1)
+    days = (date(LAST_YEAR, 12, 31) - start).days
+    debit_leaves = (accounts["cash_leaves"] + accounts["inventory_leaves"]
+                    + accounts["receivables_leaves"])
+    abbr = frappe.get_cached_value("Company", company, "abbr")
+    timestamp = now()
+    user = frappe.session.user
+
+    journal_entries, je_accounts, gl_rows = [], [], []
+    for idx in range(gl_entries // 2):
+        name = f"{abbr}-JE-{idx:07d}"
+        posting_date = start + timedelta(days=rng.randint(0, days))
+        amount = round(rng.uniform(1000, 100000), 2)
+
+        if idx % PAYMENT_EVERY == 0:
+            # Zakaah payment: pay the liability from cash
+            debit_account, credit_account = accounts["payment"], rng.choice(accounts["cash_leaves"])
+        elif idx % 7 == 0:
+            debit_account, credit_account = accounts["capital"], rng.choice(accounts["liabilities_leaves"])
+        else:
+            debit_account, credit_account = rng.choice(debit_leaves), accounts["capital"]
+
+        fiscal_year = str(posting_date.year)
+        journal_entries.append((name, company, posting_date, "Journal Entry", amount, amount,
+            f"Benchmark entry {idx}", 1, timestamp, timestamp, user, user))
+        for row_idx, (account, debit, credit) in enumerate(((debit_account, amount, 0), (credit_account, 0, amount)), 1):
+            je_accounts.append((f"{name}-{row_idx}", name, "Journal Entry", "accounts", row_idx,
+                account, debit, credit, debit, credit, "EGP", 1, timestamp, timestamp, user, user))
+            gl_rows.append((f"{name}-GL{row_idx}", posting_date, account, debit, credit, debit, credit,
+                "EGP", "Journal Entry", name, company, fiscal_year, 0, 1, timestamp, timestamp, user, user))
+
+        if len(gl_rows) >= INSERT_CHUNK:
+            _flush_ledger(journal_entries, je_accounts, gl_rows)
+            journal_entries, je_accounts, gl_rows = [], [], []
+
+    _flush_ledger(journal_entries, je_accounts, gl_rows)
+
+
+def _flush_ledger(journal_entries, je_accounts, gl_rows):
+    if journal_entries:
+        frappe.db.bulk_insert("Journal Entry", fields=[
+            "name", "company", "posting_date", "voucher_type", "total_debit", "total_credit",
+            "user_remark", "docstatus", "creation", "modified", "owner", "modified_by"
+        ], values=journal_entries)
+    if je_accounts:
+        frappe.db.bulk_insert("Journal Entry Account", fields=[
+            "name", "parent", "parenttype", "parentfield", "idx", "account", "debit", "credit",
+            "debit_in_account_currency", "credit_in_account_currency", "account_currency", "docstatus",
+            "creation", "modified", "owner", "modified_by"
+        ], values=je_accounts)
+    if gl_rows:
+        frappe.db.bulk_insert("GL Entry", fields=[
+            "name", "posting_date", "account", "debit", "credit", "debit_in_account_currency",
+            "credit_in_account_currency", "account_currency", "voucher_type", "voucher_no", "company",
+            "fiscal_year", "is_cancelled", "docstatus", "creation", "modified", "owner", "modified_by"
+        ], values=gl_rows)
+    frappe.db.commit()
+
+
+def _create_configurations(company, accounts):
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        if frappe.db.exists("Zakaah Assets Configuration", {"company": company, "fiscal_year": str(year)}):
+            continue
+        frappe.get_doc({
+            "doctype": "Zakaah Assets Configuration",
+            "company": company,
+            "fiscal_year": str(year),
+            "cash_accounts": [{"account": accounts["cash"]}],
+            "inventory_accounts": [{"account": accounts["inventory"]}],
+            "receivable_accounts": [{"account": accounts["receivables"]}],
+            "liabilities_accounts": [{"account": accounts["liabilities"]}],
+            "payment_accounts": [{"account": accounts["payment"]}]
+        }).insert(ignore_permissions=True)
+
+
+def _create_calculation_runs(company):
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        if frappe.db.exists("Zakaah Calculation Run", {"company": company, "fiscal_year": str(year)}):
+            continue
+        frappe.get_doc({
+            "doctype": "Zakaah Calculation Run",
+            "company": company,
+            "fiscal_year": str(year)
+        }).insert(ignore_permissions=True)
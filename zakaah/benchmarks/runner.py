@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Time the hot paths of the app against a generated benchmark dataset.
+
+Results are written as JSON (one file per run, tagged with the git commit)
+so that regressions can be spotted by comparing two files with
+compare_results.
+"""
+from __future__ import unicode_literals
+import json
+import os
+import statistics
+import subprocess
+import time
+import frappe
+from frappe.utils import now
+
+from zakaah.benchmarks.generator import DATASET_SIZES, LAST_YEAR, generate_dataset, get_benchmark_company
+from zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger import rebuild_company_payment_ledger
+from zakaah.zakaah_management.profiler import QueryCounter
+
+# Journal Entries handed to allocate_payments per iteration
+ALLOCATION_BATCH = 50
+
+# Median slowdown (new / baseline) reported as a regression by compare_results
+REGRESSION_THRESHOLD = 1.2
+
+BENCHMARKS = (
+    "calculate_assets",
+    "_load_journal_entries",
+    "import_journal_entries",
+    "allocate_payments",
+    "get_allocation_history",
+)
+
+
+def run_benchmarks(size, repeat=3, output=None, generate=True):
+    """Run every benchmark repeat times on the size dataset and return the results"""
+    if size not in DATASET_SIZES:
+        frappe.throw(f"Unknown dataset size {size}. Use one of {', '.join(DATASET_SIZES)}")
+
+    company = get_benchmark_company(size)
+    if generate:
+        dataset = generate_dataset(size)
+        accounts = dataset["accounts"]
+    elif not frappe.db.exists("Company", company):
+        frappe.throw(f"Benchmark company {company} not found. Generate the dataset first.")
+    else:
+        accounts = None
+
+    context = _get_context(company, accounts)
+
+    results = {
+        "commit": _get_git_commit(),
+        "timestamp": now(),
+        "size": size,
+        "gl_entries": frappe.db.count("GL Entry", {"company": company}),
+        "repeat": repeat,
+        "benchmarks": {}
+    }
+
+    for name in BENCHMARKS:
+        results["benchmarks"][name] = _time_benchmark(BENCHMARK_FUNCTIONS[name], context, repeat,
+                                                      BENCHMARK_SETUP.get(name))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+    return results
+
+
+def compare_results(baseline, current):
+    """Return per-benchmark median ratios of two result files (or dicts)"""
+    baseline = _load_results(baseline)
+    current = _load_results(current)
+
+    comparison = []
+    for name, result in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if not base or not base.get("median_s"):
+            continue
+        ratio = result["median_s"] / base["median_s"]
+        comparison.append({
+            "benchmark": name,
+            "baseline_s": base["median_s"],
+            "current_s": result["median_s"],
+            "ratio": round(ratio, 3),
+            "baseline_queries": base.get("queries"),
+            "current_queries": result.get("queries"),
+            "regression": ratio > REGRESSION_THRESHOLD
+        })
+
+    return comparison
+
+
+def _load_results(results):
+    if isinstance(results, dict):
+        return results
+    with open(results) as f:
+        return json.load(f)
+
+
+def _time_benchmark(fn, context, repeat, setup=None):
+    # Inputs are prepared once, outside the timed block: _reset restores the same state
+    if setup:
+        context = frappe._dict(context, **setup(context))
+
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        start = time.monotonic()
+        try:
+            with QueryCounter() as counter:
+                fn(context)
+            elapsed = time.monotonic() - start
+        finally:
+            _reset(context)
+        timings.append(round(elapsed, 4))
+        queries = counter.count
+
+    return {
+        "runs_s": timings,
+        "min_s": min(timings),
+        "median_s": round(statistics.median(timings), 4),
+        "max_s": max(timings),
+        "queries": queries
+    }
+
+
+def _get_context(company, accounts=None):
+    from zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run import get_zakaah_assets_config
+
+    fiscal_year = str(LAST_YEAR)
+    run = frappe.get_all("Zakaah Calculation Run",
+                         filters={"company": company, "fiscal_year": fiscal_year},
+                         fields=["name"], limit=1, pluck="name")
+    if not run:
+        frappe.throw(f"No Zakaah Calculation Run for {company} {fiscal_year}. Generate the dataset first.")
+
+    config = get_zakaah_assets_config(company, fiscal_year)
+    payment_accounts = [row.get("account") for row in config.get("payment_accounts", []) if row.get("account")]
+
+    runs = frappe.get_all("Zakaah Calculation Run",
+                          filters={"company": company},
+                          fields=["name", "total_zakaah", "paid_zakaah", "outstanding_zakaah", "status"],
+                          order_by="fiscal_year asc")
+
+    return frappe._dict({
+        "company": company,
+        "fiscal_year": fiscal_year,
+        "run": run[0],
+        "runs": runs,
+        "config": config,
+        "payment_accounts": payment_accounts
+    })
+
+
+def _bench_calculate_assets(context):
+    doc = frappe.get_doc("Zakaah Calculation Run", context.run)
+    # Full (non-incremental) calculation
+    doc.calculation_basis = None
+    doc.set("items", [])
+    doc.calculate_assets(context.config, context.company)
+
+
+def _bench_load_journal_entries(context):
+    doc = frappe.get_doc("Zakaah Calculation Run", context.run)
+    doc._load_journal_entries()
+
+
+def _bench_import_journal_entries(context):
+    from zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments import import_journal_entries
+
+    doc = frappe.get_doc("Zakaah Calculation Run", context.run)
+    return import_journal_entries(context.company, doc.from_date, doc.to_date, context.payment_accounts)
+
+
+def _setup_allocate_payments(context):
+    return {
+        "journal_entries": _bench_import_journal_entries(context)["journal_entry_records"][:ALLOCATION_BATCH],
+        "run_items": [{"zakaah_calculation_run": run.name} for run in context.runs]
+    }
+
+
+def _bench_allocate_payments(context):
+    from zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments import allocate_payments
+
+    allocate_payments(context.run_items, context.journal_entries)
+
+
+def _bench_get_allocation_history(context):
+    from zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments import get_allocation_history
+
+    get_allocation_history(calculation_run=context.run)
+
+
+def _reset(context):
+    """Undo allocations made by a benchmark so every iteration starts from the same state"""
+    frappe.db.rollback()
+    run_names = [run.name for run in context.runs]
+    if not run_names:
+        return
+
+    frappe.db.sql("""
+        DELETE FROM `tabZakaah Allocation History`
+        WHERE zakaah_calculation_run IN %(runs)s
+    """, {"runs": run_names})
+
+    for run in context.runs:
+        frappe.db.set_value("Zakaah Calculation Run", run.name, {
+            "paid_zakaah": run.paid_zakaah,
+            "outstanding_zakaah": run.outstanding_zakaah,
+            "status": run.status
+        }, update_modified=False)
+
+    rebuild_company_payment_ledger(context.company)
+    frappe.db.commit()
+
+
+def _get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+BENCHMARK_FUNCTIONS = {
+    "calculate_assets": _bench_calculate_assets,
+    "_load_journal_entries": _bench_load_journal_entries,
+    "import_journal_entries": _bench_import_journal_entries,
+    "allocate_payments": _bench_allocate_payments,
+    "get_allocation_history": _bench_get_allocation_history,
+}
+
+# Untimed preparation of a benchmark's inputs, merged into its context
+BENCHMARK_SETUP = {
+    "allocate_payments": _setup_allocate_payments,
+}
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import sys
+import time
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("rebuild-zakaah-balance-snapshots")
+@click.option("--company", required=True, help="Company to rebuild snapshots for")
+@click.option("--upto", help="Last period end to snapshot (defaults to the end of last month)")
+@pass_context
+def rebuild_zakaah_balance_snapshots(context, company, upto=None):
+	"""Rebuild Zakaah Balance Snapshots of a company from GL Entry"""
+	from zakaah.zakaah_management.doctype.zakaah_balance_snapshot.zakaah_balance_snapshot import rebuild_balance_snapshots
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		result = rebuild_balance_snapshots(company, upto)
+		click.echo(f"{result['snapshots_created']} snapshots created for {company}")
+	finally:
+		frappe.destroy()
+
+
+@click.command("rebuild-zakaah-account-activity")
+@click.option("--company", required=True, help="Company to rebuild the account activity summary for")
+@pass_context
+def rebuild_zakaah_account_activity(context, company):
+	"""Rebuild the Zakaah Account Activity summary of a company from GL Entry"""
+	from zakaah.zakaah_management.doctype.zakaah_account_activity.zakaah_account_activity import rebuild_account_activity
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		result = rebuild_account_activity(company)
+		click.echo(f"{result['accounts']} accounts summarized for {company}")
+	finally:
+		frappe.destroy()
+
+
+@click.command("rebuild-zakaah-payment-ledger")
+@click.option("--company", required=True, help="Company to rebuild the payment ledger for")
+@pass_context
+def rebuild_zakaah_payment_ledger(context, company):
+	"""Rebuild the Zakaah Payment Ledger of a company from GL Entry and Zakaah Allocation History"""
+	from zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger import rebuild_payment_ledger
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		result = rebuild_payment_ledger(company)
+		click.echo(f"{result['journal_entries']} journal entries in the payment ledger of {company}")
+	finally:
+		frappe.destroy()
+
+
+@click.command("repair-zakaah-run-totals")
+@click.option("--company", help="Only repair runs of this company")
+@pass_context
+def repair_zakaah_run_totals(context, company=None):
+	"""Rewrite paid and outstanding amounts of runs that disagree with Zakaah Allocation History"""
+	from zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments import update_stale_calculation_run_totals
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		click.echo(f"{update_stale_calculation_run_totals(company)} calculation runs repaired")
+	finally:
+		frappe.destroy()
+
+
+@click.command("calculate-zakaah-runs")
+@click.option("--pairs", required=True, help='JSON list of [company, fiscal_year] pairs, e.g. \'[["My Company", "2024"]]\'')
+@click.option("--workers", default=4, type=int, help="Number of parallel shards (companies never share a shard)")
+@click.option("--now", "run_now", is_flag=True, default=False, help="Run in this process instead of on RQ workers")
+@click.option("--wait/--no-wait", default=True, help="Wait for the workers and print the result table")
+@click.option("--timeout", default=7200, type=int, help="Seconds to wait for the workers before reporting unfinished shards")
+@pass_context
+def calculate_zakaah_runs(context, pairs, workers=4, run_now=False, wait=True, timeout=7200):
+	"""Create or recalculate Zakaah Calculation Runs for many companies and fiscal years"""
+	from zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run import (
+		bulk_calculate_zakaah,
+		calculate_run_for_fiscal_year,
+		get_bulk_calculation_results,
+		parse_calculation_pairs,
+	)
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+
+		if run_now:
+			results = [
+				calculate_run_for_fiscal_year(company, fiscal_year)
+				for company, fiscal_year in parse_calculation_pairs(pairs)
+			]
+		else:
+			batch = bulk_calculate_zakaah(pairs, workers)
+			frappe.db.commit()
+			click.echo(f"Batch {batch['batch_id']}: {batch['runs']} runs in {batch['shards']} shards")
+			if not wait:
+				return
+
+			# Stop once no shard is still queued or running, or at the deadline
+			deadline = time.monotonic() + timeout
+			while True:
+				batch_results = get_bulk_calculation_results(batch["batch_id"])
+				if not batch_results["pending_shards"] or time.monotonic() >= deadline:
+					break
+				time.sleep(2)
+			results = batch_results["results"]
+
+			for shard in batch_results["failed_shards"]:
+				click.echo(f"Shard {shard['shard']} did not write results (job {shard['status']})", err=True)
+			for shard in batch_results["pending_shards"]:
+				click.echo(f"Shard {shard['shard']} still {shard['status']} after {timeout} seconds", err=True)
+
+		_echo_calculation_results(results)
+		if not run_now and not batch_results["completed"]:
+			sys.exit(1)
+	finally:
+		frappe.destroy()
+
+
+def _echo_calculation_results(results):
+	click.echo(f"{'Company':<30} {'Fiscal Year':<12} {'Run':<24} {'Status':<15} {'Total Zakaah':>15} {'Seconds':>8}")
+	for row in results:
+		click.echo(
+			f"{row['company']:<30} {row['fiscal_year']:<12} {row['run'] or '-':<24} {row['status']:<15} "
+			f"{row.get('total_zakaah') or 0:>15,.2f} {row['seconds']:>8.2f}"
+		)
+		if row.get("error"):
+			click.echo(f"    Error: {row['error']}")
+
+
+@click.command("backfill-zakaah-runs")
+@click.option("--company", required=True, help="Company to backfill")
+@click.option("--from-fiscal-year", required=True, help="First fiscal year")
+@click.option("--to-fiscal-year", required=True, help="Last fiscal year")
+@pass_context
+def backfill_zakaah_runs(context, company, from_fiscal_year, to_fiscal_year):
+	"""Create or update Zakaah Calculation Runs for a range of fiscal years from one GL sweep"""
+	from zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run import backfill_calculation_runs
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		_echo_calculation_results(backfill_calculation_runs(company, from_fiscal_year, to_fiscal_year))
+	finally:
+		frappe.destroy()
+
+
+@click.command("import-zakaah-gold-prices")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--source", default="Bulk Import", help="Source recorded on the imported prices")
+@pass_context
+def import_zakaah_gold_prices(context, path, source="Bulk Import"):
+	"""Import Gold Prices from a CSV, JSON or JSON Lines file"""
+	from zakaah.zakaah_management.doctype.gold_price.gold_price import import_gold_prices_from_file
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		report = import_gold_prices_from_file(path, source)
+		click.echo(f"Inserted: {report['inserted']}, Updated: {report['updated']}, Skipped: {report['skipped']}")
+		for error in report["errors"]:
+			click.echo(f"    Row {error['row']}: {error['error']}")
+	finally:
+		frappe.destroy()
+
+
+@click.command("run-zakaah-benchmarks")
+@click.option("--size", default="10k", type=click.Choice(["10k", "100k", "1m"]), help="Synthetic GL Entry count")
+@click.option("--repeat", default=3, type=int, help="Timed iterations per benchmark")
+@click.option("--output", help="Write the results as JSON to this file")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Results JSON of an earlier commit to compare against")
+@click.option("--generate/--no-generate", default=True, help="Create the synthetic dataset if it does not exist yet")
+@pass_context
+def run_zakaah_benchmarks(context, size="10k", repeat=3, output=None, baseline=None, generate=True):
+	"""Benchmark the calculation and payment allocation paths on a synthetic ledger (benchmark sites only)"""
+	from zakaah.benchmarks.runner import compare_results, run_benchmarks
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user("Administrator")
+		results = run_benchmarks(size, repeat, output, generate)
+
+		click.echo(f"Commit {results['commit'] or '-'}, {results['gl_entries']} GL Entries")
+		click.echo(f"{'Benchmark':<26} {'Median (s)':>11} {'Min (s)':>9} {'Queries':>8}")
+		for name, result in results["benchmarks"].items():
+			click.echo(f"{name:<26} {result['median_s']:>11.4f} {result['min_s']:>9.4f} {result['queries']:>8}")
+
+		if baseline:
+			click.echo("")
+			for row in compare_results(baseline, results):
+				flag = "  REGRESSION" if row["regression"] else ""
+				click.echo(f"{row['benchmark']:<26} {row['ratio']:>6.2f}x{flag}")
+	finally:
+		frappe.destroy()
+
+
+commands = [
+	rebuild_zakaah_balance_snapshots,
+	rebuild_zakaah_account_activity,
+	rebuild_zakaah_payment_ledger,
+	repair_zakaah_run_totals,
+	calculate_zakaah_runs,
+	backfill_zakaah_runs,
+	import_zakaah_gold_prices,
+	run_zakaah_benchmarks,
+]
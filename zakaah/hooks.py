@@ -15,6 +15,38 @@ app_email = "info@zakaah.com"
 # include js in doctype views
 # doctype_js = {}
 
+# Document Events
+doc_events = {
+	"GL Entry": {
+		"after_insert": [
+			"zakaah.zakaah_management.doctype.zakaah_balance_snapshot.zakaah_balance_snapshot.update_snapshots_on_gl_insert",
+			"zakaah.zakaah_management.doctype.zakaah_account_activity.zakaah_account_activity.update_activity_on_gl_insert"
+		],
+		"on_cancel": [
+			"zakaah.zakaah_management.doctype.zakaah_balance_snapshot.zakaah_balance_snapshot.update_snapshots_on_gl_cancel",
+			"zakaah.zakaah_management.doctype.zakaah_account_activity.zakaah_account_activity.update_activity_on_gl_cancel"
+		]
+	},
+	"Journal Entry": {
+		"on_submit": "zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger.update_ledger_on_je_submit",
+		"on_cancel": "zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger.update_ledger_on_je_cancel"
+	},
+	"Currency Exchange": {
+		"on_update": "zakaah.zakaah_management.exchange_rates.clear_exchange_rate_cache",
+		"on_trash": "zakaah.zakaah_management.exchange_rates.clear_exchange_rate_cache"
+	}
+}
+
+# Scheduled Tasks
+scheduler_events = {
+	"daily": [
+		"zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments.repair_all_calculation_run_totals"
+	],
+	"monthly": [
+		"zakaah.zakaah_management.doctype.zakaah_balance_snapshot.zakaah_balance_snapshot.create_month_end_snapshots"
+	]
+}
+
 def get_data():
 	return [
 		{
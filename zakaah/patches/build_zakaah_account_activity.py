@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+from zakaah.zakaah_management.doctype.zakaah_account_activity.zakaah_account_activity import rebuild_company_account_activity
+
+
+def execute():
+    """Backfill Zakaah Account Activity of existing sites: GL Entry hooks only add entries posted after install"""
+    frappe.reload_doc("zakaah_management", "doctype", "zakaah_account_activity")
+
+    for company in frappe.get_all("Company", pluck="name"):
+        rebuild_company_account_activity(company)
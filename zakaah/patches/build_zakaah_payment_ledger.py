@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+from zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger import rebuild_company_payment_ledger
+
+
+def execute():
+    """Backfill the Zakaah Payment Ledger of existing sites: import_journal_entries reads only the ledger"""
+    frappe.reload_doc("zakaah_management", "doctype", "zakaah_payment_ledger")
+
+    for company in frappe.get_all("Company", pluck="name"):
+        rebuild_company_payment_ledger(company)
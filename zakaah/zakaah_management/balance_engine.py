@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+import numpy as np
+from frappe.utils import add_days, date_diff, flt, getdate
+
+
+def get_account_balances(accounts, date, company=None):
+    """Get balances for many accounts as of date with one grouped GL Entry query.
+
+    Returns {account: balance} with the same (signed) numbers as ERPNext's
+    get_balance_on: group accounts are resolved through the Account lft/rgt
+    tree, Profit and Loss accounts only count the current fiscal year, and
+    foreign currency ledger accounts are summed in account currency.
+
+    Balance sheet accounts start from the latest Zakaah Balance Snapshot, so
+    only the GL Entry rows posted after it are aggregated.
+    """
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    if not accounts:
+        return {}
+
+    balances = {account: 0.0 for account in accounts}
+    date = getdate(date)
+
+    account_details = _get_account_details(accounts)
+    if not account_details:
+        return balances
+
+    # Map every configured account to the ledger (non-group) accounts it covers
+    leaf_accounts = _get_leaf_accounts(account_details)
+    all_leaves = sorted(set(leaf for leaves in leaf_accounts.values() for leaf in leaves))
+    if not all_leaves:
+        return balances
+
+    pl_start_date = _get_pl_start_date(date, company or account_details[0].company)
+
+    # Profit and Loss accounts only count the current fiscal year, so they
+    # are summed from the fiscal year start; everything else is cumulative
+    pl_accounts = set(
+        acc.name for acc in account_details
+        if acc.report_type == "Profit and Loss" and pl_start_date
+    )
+    bs_leaves = sorted(set(
+        leaf for account, leaves in leaf_accounts.items() if account not in pl_accounts for leaf in leaves
+    ))
+    pl_leaves = sorted(set(
+        leaf for account, leaves in leaf_accounts.items() if account in pl_accounts for leaf in leaves
+    ))
+
+    bs_totals = _get_cumulative_totals(bs_leaves, date, company) if bs_leaves else {}
+    pl_totals = _get_period_totals(pl_leaves, pl_start_date, date, company) if pl_leaves else {}
+
+    for acc in account_details:
+        gl_totals = pl_totals if acc.name in pl_accounts else bs_totals
+        in_account_currency = not acc.is_group and acc.account_currency != _get_company_currency(acc.company)
+        field = "balance_in_account_currency" if in_account_currency else "balance"
+
+        balances[acc.name] = flt(sum(
+            flt(gl_totals[leaf].get(field)) for leaf in leaf_accounts.get(acc.name, []) if leaf in gl_totals
+        ))
+
+    return balances
+
+
+def _get_cumulative_totals(leaves, date, company=None):
+    """Return {account: totals} for ledger accounts from the start of time up to date.
+
+    Reads the latest Zakaah Balance Snapshot of each account on or before date
+    and only aggregates the GL Entry rows posted after it.
+    """
+    totals = {}
+    values = {'leaves': leaves, 'date': date, 'company': company}
+
+    if not company:
+        rows = frappe.db.sql("""
+            SELECT
+                gle.account,
+                SUM(gle.debit) - SUM(gle.credit) AS balance,
+                SUM(gle.debit_in_account_currency) - SUM(gle.credit_in_account_currency) AS balance_in_account_currency
+            FROM `tabGL Entry` gle
+            WHERE gle.account IN %(leaves)s
+                AND gle.posting_date <= %(date)s
+                AND gle.is_cancelled = 0
+            GROUP BY gle.account
+        """, values, as_dict=True)
+        return {row.account: row for row in rows}
+
+    latest_snapshots = """
+        SELECT account, MAX(period_end) AS period_end
+        FROM `tabZakaah Balance Snapshot`
+        WHERE company = %(company)s
+            AND account IN %(leaves)s
+            AND period_end <= %(date)s
+        GROUP BY account
+    """
+
+    snapshots = frappe.db.sql("""
+        SELECT
+            snap.account,
+            snap.debit - snap.credit AS balance,
+            snap.debit_in_account_currency - snap.credit_in_account_currency AS balance_in_account_currency
+        FROM `tabZakaah Balance Snapshot` snap
+        INNER JOIN ({latest}) latest
+            ON latest.account = snap.account AND latest.period_end = snap.period_end
+        WHERE snap.company = %(company)s
+    """.format(latest=latest_snapshots), values, as_dict=True)
+
+    for row in snapshots:
+        totals[row.account] = {
+            'balance': flt(row.balance),
+            'balance_in_account_currency': flt(row.balance_in_account_currency)
+        }
+
+    # Delta rows posted after each account's snapshot (or all rows if it has none)
+    deltas = frappe.db.sql("""
+        SELECT
+            gle.account,
+            SUM(gle.debit) - SUM(gle.credit) AS balance,
+            SUM(gle.debit_in_account_currency) - SUM(gle.credit_in_account_currency) AS balance_in_account_currency
+        FROM `tabGL Entry` gle
+        LEFT JOIN ({latest}) latest ON latest.account = gle.account
+        WHERE gle.account IN %(leaves)s
+            AND gle.company = %(company)s
+            AND gle.posting_date <= %(date)s
+            AND gle.is_cancelled = 0
+            AND (latest.period_end IS NULL OR gle.posting_date > latest.period_end)
+        GROUP BY gle.account
+    """.format(latest=latest_snapshots), values, as_dict=True)
+
+    for row in deltas:
+        account_totals = totals.setdefault(row.account, {'balance': 0.0, 'balance_in_account_currency': 0.0})
+        account_totals['balance'] += flt(row.balance)
+        account_totals['balance_in_account_currency'] += flt(row.balance_in_account_currency)
+
+    return totals
+
+
+def _get_period_totals(leaves, from_date, to_date, company=None):
+    """Return {account: totals} for ledger accounts between from_date and to_date (P&L rules)"""
+    conditions = ["gle.account IN %(leaves)s", "gle.posting_date BETWEEN %(from_date)s AND %(to_date)s",
+        "gle.is_cancelled = 0", "gle.voucher_type != 'Period Closing Voucher'"]
+    if company:
+        conditions.append("gle.company = %(company)s")
+
+    rows = frappe.db.sql("""
+        SELECT
+            gle.account,
+            SUM(gle.debit) - SUM(gle.credit) AS balance,
+            SUM(gle.debit_in_account_currency) - SUM(gle.credit_in_account_currency) AS balance_in_account_currency
+        FROM `tabGL Entry` gle
+        WHERE {conditions}
+        GROUP BY gle.account
+    """.format(conditions=" AND ".join(conditions)), {
+        'leaves': leaves,
+        'from_date': from_date,
+        'to_date': to_date,
+        'company': company
+    }, as_dict=True)
+
+    return {row.account: row for row in rows}
+
+
+def get_account_debits(accounts, from_date, to_date, company=None):
+    """Return {account: total debit} of ledger accounts between from_date and to_date in one query.
+
+    from_date may be None to sum from the first GL Entry.
+    """
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    if not accounts:
+        return {}
+
+    conditions = ["account IN %(accounts)s", "posting_date <= %(to_date)s", "is_cancelled = 0"]
+    if from_date:
+        conditions.append("posting_date >= %(from_date)s")
+    if company:
+        conditions.append("company = %(company)s")
+
+    debits = {account: 0.0 for account in accounts}
+    for account, debit in frappe.db.sql("""
+        SELECT account, SUM(debit)
+        FROM `tabGL Entry`
+        WHERE {conditions}
+        GROUP BY account
+    """.format(conditions=" AND ".join(conditions)), {
+        'accounts': accounts,
+        'from_date': getdate(from_date) if from_date else None,
+        'to_date': getdate(to_date),
+        'company': company
+    }):
+        debits[account] = flt(debit)
+
+    return debits
+
+
+def get_balances_at_dates(accounts, dates, company=None, period_starts=None):
+    """Return {date: {account: balance}} at every date with one GL Entry sweep.
+
+    Opening balances are taken the day before the first period start (from
+    the latest snapshot), then one query sums the GL rows of each account
+    into the period ending at each date; a running sum over the periods
+    gives the balance at every boundary. period_starts maps each date to the
+    start of its fiscal year (defaults to the day after the previous date)
+    so Profit and Loss accounts only count their own year, like
+    get_balance_on.
+    """
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    dates = sorted(set(getdate(d) for d in (dates or []) if d))
+    if not accounts or not dates:
+        return {}
+
+    period_starts = {getdate(d): getdate(start) for d, start in (period_starts or {}).items()}
+    for idx, date in enumerate(dates):
+        if date not in period_starts:
+            period_starts[date] = add_days(dates[idx - 1], 1) if idx else getdate(add_days(date, -364))
+
+    first_start = min(period_starts[date] for date in dates)
+    balances = {date: {account: 0.0 for account in accounts} for date in dates}
+
+    account_details = _get_account_details(accounts)
+    leaf_accounts = _get_leaf_accounts(account_details) if account_details else {}
+    all_leaves = sorted(set(leaf for leaves in leaf_accounts.values() for leaf in leaves))
+    if not all_leaves:
+        return balances
+
+    # Period index of each GL row: 0 for the first date, 1 for the second, ...
+    period_case = " ".join(
+        "WHEN posting_date <= '{0}' THEN {1}".format(date, idx) for idx, date in enumerate(dates)
+    )
+    conditions = ["account IN %(leaves)s", "posting_date BETWEEN %(from_date)s AND %(to_date)s",
+        "is_cancelled = 0"]
+    if company:
+        conditions.append("company = %(company)s")
+
+    rows = frappe.db.sql("""
+        SELECT
+            account,
+            CASE {period_case} END AS period,
+            SUM(debit) - SUM(credit) AS balance,
+            SUM(debit_in_account_currency) - SUM(credit_in_account_currency) AS balance_in_account_currency,
+            SUM(IF(voucher_type = 'Period Closing Voucher', 0, debit - credit)) AS pl_balance,
+            SUM(IF(voucher_type = 'Period Closing Voucher', 0,
+                debit_in_account_currency - credit_in_account_currency)) AS pl_balance_in_account_currency
+        FROM `tabGL Entry`
+        WHERE {conditions}
+        GROUP BY account, period
+    """.format(period_case=period_case, conditions=" AND ".join(conditions)), {
+        'leaves': all_leaves,
+        'from_date': first_start,
+        'to_date': dates[-1],
+        'company': company
+    }, as_dict=True)
+
+    # (leaves x periods) movement matrices
+    leaf_index = {leaf: idx for idx, leaf in enumerate(all_leaves)}
+    matrices = {}
+    for field in ("balance", "balance_in_account_currency", "pl_balance", "pl_balance_in_account_currency"):
+        matrix = np.zeros((len(all_leaves), len(dates)))
+        if rows:
+            np.add.at(matrix,
+                (np.array([leaf_index[row.account] for row in rows]), np.array([int(row.period) for row in rows])),
+                [flt(row.get(field)) for row in rows])
+        matrices[field] = matrix
+
+    opening = get_account_balances(accounts, add_days(first_start, -1), company)
+
+    for acc in account_details:
+        leaves = [leaf_index[leaf] for leaf in leaf_accounts.get(acc.name, []) if leaf in leaf_index]
+        in_account_currency = not acc.is_group and acc.account_currency != _get_company_currency(acc.company)
+        suffix = "_in_account_currency" if in_account_currency else ""
+
+        if acc.report_type == "Profit and Loss":
+            # Only the movements of each fiscal year (without closing vouchers)
+            movements = matrices["pl_balance" + suffix][leaves].sum(axis=0) if leaves else np.zeros(len(dates))
+            for idx, date in enumerate(dates):
+                balances[date][acc.name] = flt(movements[idx])
+        else:
+            movements = matrices["balance" + suffix][leaves].sum(axis=0) if leaves else np.zeros(len(dates))
+            running = flt(opening.get(acc.name)) + np.cumsum(movements)
+            for idx, date in enumerate(dates):
+                balances[date][acc.name] = flt(running[idx])
+
+    return balances
+
+
+def get_daily_balance_series(accounts, from_date, to_date, company=None, include_opening=False):
+    """Return {account: numpy array of the balance at the end of each day} from from_date to to_date.
+
+    The opening balance comes from get_account_balances (the day before
+    from_date) and the daily movements from one GL Entry query grouped by
+    account and posting date; the series is their cumulative sum, so the
+    cost does not depend on the number of days. Balances are signed
+    (debit minus credit). With include_opening the opening balance is
+    prepended as the first element.
+    """
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    from_date, to_date = getdate(from_date), getdate(to_date)
+    days = date_diff(to_date, from_date) + 1
+    if not accounts or days <= 0:
+        return {}
+
+    opening = get_account_balances(accounts, add_days(from_date, -1), company)
+    series = {account: np.full(days, flt(opening.get(account))) for account in accounts}
+
+    account_details = _get_account_details(accounts)
+    leaf_accounts = _get_leaf_accounts(account_details) if account_details else {}
+    all_leaves = sorted(set(leaf for leaves in leaf_accounts.values() for leaf in leaves))
+    if not all_leaves:
+        return _with_opening(series, opening) if include_opening else series
+
+    conditions = ["account IN %(leaves)s", "posting_date BETWEEN %(from_date)s AND %(to_date)s",
+        "is_cancelled = 0"]
+    if company:
+        conditions.append("company = %(company)s")
+
+    rows = frappe.db.sql("""
+        SELECT
+            account,
+            posting_date,
+            SUM(debit) - SUM(credit) AS balance,
+            SUM(debit_in_account_currency) - SUM(credit_in_account_currency) AS balance_in_account_currency
+        FROM `tabGL Entry`
+        WHERE {conditions}
+        GROUP BY account, posting_date
+    """.format(conditions=" AND ".join(conditions)), {
+        'leaves': all_leaves,
+        'from_date': from_date,
+        'to_date': to_date,
+        'company': company
+    }, as_dict=True)
+
+    if not rows:
+        return _with_opening(series, opening) if include_opening else series
+
+    # Daily deltas of every ledger account as a (leaves x days) matrix
+    leaf_index = {leaf: idx for idx, leaf in enumerate(all_leaves)}
+    row_leaves = np.array([leaf_index[row.account] for row in rows])
+    row_days = np.array([date_diff(row.posting_date, from_date) for row in rows])
+
+    deltas = {}
+    for field in ("balance", "balance_in_account_currency"):
+        matrix = np.zeros((len(all_leaves), days))
+        np.add.at(matrix, (row_leaves, row_days), [flt(row.get(field)) for row in rows])
+        deltas[field] = matrix
+
+    for acc in account_details:
+        leaves = [leaf_index[leaf] for leaf in leaf_accounts.get(acc.name, []) if leaf in leaf_index]
+        if not leaves:
+            continue
+        in_account_currency = not acc.is_group and acc.account_currency != _get_company_currency(acc.company)
+        field = "balance_in_account_currency" if in_account_currency else "balance"
+        series[acc.name] = series[acc.name] + np.cumsum(deltas[field][leaves].sum(axis=0))
+
+    return _with_opening(series, opening) if include_opening else series
+
+
+def _with_opening(series, opening):
+    return {
+        account: np.concatenate(([flt(opening.get(account))], values))
+        for account, values in series.items()
+    }
+
+
+def get_gl_watermark(accounts, date, company=None):
+    """Return a cheap change marker for the GL Entry rows behind accounts up to date.
+
+    Any insert or cancellation of a GL row for one of the accounts (or their
+    descendants) changes the row count or the latest modified timestamp.
+    """
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    account_details = _get_account_details(accounts) if accounts else []
+    leaves = sorted(set(
+        leaf for leaves in _get_leaf_accounts(account_details).values() for leaf in leaves
+    )) if account_details else []
+
+    if not leaves:
+        return "0:"
+
+    conditions = ["account IN %(leaves)s", "posting_date <= %(date)s"]
+    if company:
+        conditions.append("company = %(company)s")
+
+    row_count, last_modified = frappe.db.sql("""
+        SELECT COUNT(*), MAX(modified)
+        FROM `tabGL Entry`
+        WHERE {conditions}
+    """.format(conditions=" AND ".join(conditions)), {
+        'leaves': leaves,
+        'date': getdate(date),
+        'company': company
+    })[0]
+
+    return "{0}:{1}".format(row_count, last_modified or "")
+
+
+def get_changed_accounts(watermarks, date, company=None):
+    """Return the accounts with GL Entry rows modified after their watermark.
+
+    watermarks maps account -> modified timestamp of the last calculation.
+    Only rows modified since the oldest watermark are read (GL Entry is
+    indexed on modified), and group accounts are matched through their
+    descendant ledger accounts.
+    """
+    watermarks = {account: watermark for account, watermark in (watermarks or {}).items() if account}
+    if not watermarks:
+        return []
+
+    account_details = _get_account_details(list(watermarks))
+    leaf_accounts = _get_leaf_accounts(account_details) if account_details else {}
+    leaves = sorted(set(leaf for leaves in leaf_accounts.values() for leaf in leaves))
+    if not leaves:
+        return []
+
+    conditions = ["modified > %(since)s", "account IN %(leaves)s", "posting_date <= %(date)s"]
+    if company:
+        conditions.append("company = %(company)s")
+
+    last_modified = dict(frappe.db.sql("""
+        SELECT account, MAX(modified)
+        FROM `tabGL Entry`
+        WHERE {conditions}
+        GROUP BY account
+    """.format(conditions=" AND ".join(conditions)), {
+        'since': min(watermarks.values()),
+        'leaves': leaves,
+        'date': getdate(date),
+        'company': company
+    }))
+
+    return [
+        account for account, leaves in leaf_accounts.items()
+        if any(leaf in last_modified and str(last_modified[leaf]) > str(watermarks[account]) for leaf in leaves)
+    ]
+
+
+def get_account_currencies(accounts):
+    """Return {account: currency of the balance get_account_balances returns for it}.
+
+    Ledger accounts in a foreign currency are reported in account currency;
+    group accounts and company currency accounts in company currency.
+    """
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    if not accounts:
+        return {}
+
+    currencies = {}
+    for acc in _get_account_details(accounts):
+        company_currency = _get_company_currency(acc.company)
+        in_account_currency = not acc.is_group and acc.account_currency and acc.account_currency != company_currency
+        currencies[acc.name] = acc.account_currency if in_account_currency else company_currency
+
+    return currencies
+
+
+def get_subtree_accounts(accounts):
+    """Return accounts plus all their descendants, resolved through the lft/rgt tree"""
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    if not accounts:
+        return []
+
+    account_details = _get_account_details(accounts)
+    subtree = set(acc.name for acc in account_details)
+
+    groups = [acc for acc in account_details if acc.is_group]
+    if groups:
+        ranges = " OR ".join(
+            "(lft > {0} AND rgt < {1})".format(int(acc.lft), int(acc.rgt)) for acc in groups
+        )
+        subtree.update(frappe.db.sql_list("""
+            SELECT name
+            FROM `tabAccount`
+            WHERE {ranges}
+        """.format(ranges=ranges)))
+
+    return sorted(subtree)
+
+
+def _get_account_details(accounts):
+    return frappe.db.sql("""
+        SELECT name, lft, rgt, is_group, report_type, account_currency, company
+        FROM `tabAccount`
+        WHERE name IN %(accounts)s
+    """, {'accounts': accounts}, as_dict=True)
+
+
+def _get_leaf_accounts(account_details):
+    """Return {account: [ledger accounts]} resolving groups via lft/rgt"""
+    leaf_accounts = {}
+    groups = []
+    for acc in account_details:
+        if acc.is_group:
+            groups.append(acc)
+        else:
+            leaf_accounts[acc.name] = [acc.name]
+
+    if not groups:
+        return leaf_accounts
+
+    # One range query for the descendants of every group account
+    ranges = " OR ".join(
+        "(lft > {0} AND rgt < {1})".format(int(acc.lft), int(acc.rgt)) for acc in groups
+    )
+    descendants = frappe.db.sql("""
+        SELECT name, lft, rgt
+        FROM `tabAccount`
+        WHERE is_group = 0 AND ({ranges})
+    """.format(ranges=ranges), as_dict=True)
+
+    for acc in groups:
+        leaf_accounts[acc.name] = [
+            d.name for d in descendants if d.lft > acc.lft and d.rgt < acc.rgt
+        ]
+
+    return leaf_accounts
+
+
+def _get_pl_start_date(date, company):
+    """Start of the fiscal year containing date, as used by get_balance_on for P&L accounts"""
+    try:
+        from erpnext.accounts.utils import get_fiscal_year
+        return get_fiscal_year(date, company=company, verbose=0)[1]
+    except Exception:
+        return None
+
+
+def _get_company_currency(company):
+    return frappe.get_cached_value("Company", company, "default_currency")
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Cached lookups of Zakaah Assets Configuration and Fiscal Year dates.
+
+Results are memoized for the current request in frappe.local, and compiled
+configurations are also kept in Redis keyed by configuration name and
+modified, so a changed configuration is never served stale.
+"""
+from __future__ import unicode_literals
+import frappe
+
+CONFIG_CACHE_KEY = "zakaah_assets_config"
+CONFIG_LOOKUP_CACHE_KEY = "zakaah_assets_config_lookup"
+
+# Child tables of Zakaah Assets Configuration kept in the compiled configuration
+CONFIG_TABLES = (
+    'cash_accounts',
+    'inventory_accounts',
+    'receivable_accounts',
+    'liabilities_accounts',
+    'reserve_accounts',
+    'payment_accounts',
+)
+
+# Hawl valuation mode field of each asset table
+VALUATION_FIELDS = {
+    'cash_accounts': 'cash_valuation',
+    'inventory_accounts': 'inventory_valuation',
+    'receivable_accounts': 'receivable_valuation',
+    'liabilities_accounts': 'liabilities_valuation',
+    'reserve_accounts': 'reserve_valuation',
+}
+
+
+def get_fiscal_year_dates(fiscal_year):
+    """Return frappe._dict(year_start_date, year_end_date) of a Fiscal Year"""
+    local_cache = _get_local_cache()
+    key = ("fiscal_year", fiscal_year)
+    if key not in local_cache:
+        local_cache[key] = frappe.get_cached_value(
+            "Fiscal Year", fiscal_year, ["year_start_date", "year_end_date"], as_dict=True
+        )
+    return local_cache[key]
+
+
+def find_config_name(company, fiscal_year=None):
+    """Return (name, fallback) of the configuration for company and fiscal year.
+
+    fallback is None for an exact match, "company" when the fiscal year had no
+    configuration and "default" when the company had none either.
+    """
+    local_cache = _get_local_cache()
+    key = ("lookup", company, fiscal_year)
+    if key in local_cache:
+        return local_cache[key]
+
+    field = "{0}::{1}".format(company, fiscal_year or "")
+    result = frappe.cache().hget(CONFIG_LOOKUP_CACHE_KEY, field)
+    if result is None:
+        result = _find_config_name(company, fiscal_year)
+        frappe.cache().hset(CONFIG_LOOKUP_CACHE_KEY, field, result)
+
+    local_cache[key] = tuple(result)
+    return local_cache[key]
+
+
+def _find_config_name(company, fiscal_year=None):
+    filters = {"company": company}
+    if fiscal_year:
+        filters["fiscal_year"] = fiscal_year
+
+    # Try to find config by company and fiscal year
+    config_list = frappe.get_all("Zakaah Assets Configuration", filters=filters, limit=1)
+    if config_list:
+        return (config_list[0].name, None)
+
+    if fiscal_year:
+        # If not found with fiscal year, try without fiscal year
+        config_list = frappe.get_all("Zakaah Assets Configuration", filters={"company": company}, limit=1)
+        if config_list:
+            return (config_list[0].name, "company")
+
+    # Try to get any default config
+    config_list = frappe.get_all("Zakaah Assets Configuration", limit=1)
+    if config_list:
+        return (config_list[0].name, "default")
+
+    return (None, None)
+
+
+def get_compiled_config(name, modified=None):
+    """Return the configuration as {name, modified, company, fiscal_year, valuation, <table>: [row dicts]}.
+
+    Pass modified when it is already known to skip the lookup query.
+    """
+    if not name:
+        return None
+
+    if modified is None:
+        config = _get_local_cache().get(("config", name))
+        if config:
+            return config
+        modified = frappe.db.get_value("Zakaah Assets Configuration", name, "modified")
+        if modified is None:
+            return None
+
+    return _get_compiled_configs([(name, modified)]).get(name)
+
+
+def get_company_configs(company):
+    """Compiled configurations of every fiscal year of a company"""
+    rows = frappe.get_all("Zakaah Assets Configuration",
+                          filters={"company": company},
+                          fields=["name", "modified"])
+    configs = _get_compiled_configs([(row.name, row.modified) for row in rows])
+    return [configs[row.name] for row in rows if row.name in configs]
+
+
+def _get_compiled_configs(names_and_modified):
+    """Return {name: compiled configuration}, compiling the ones missing from both caches together"""
+    local_cache = _get_local_cache()
+    configs, stale = {}, []
+    for name, modified in names_and_modified:
+        config = local_cache.get(("config", name))
+        if not config or str(config['modified']) != str(modified):
+            config = frappe.cache().hget(CONFIG_CACHE_KEY, name)
+        if config and str(config['modified']) == str(modified):
+            configs[name] = local_cache[("config", name)] = config
+        else:
+            stale.append(name)
+
+    if stale:
+        for name, config in _compile_configs(stale).items():
+            frappe.cache().hset(CONFIG_CACHE_KEY, name, config)
+            configs[name] = local_cache[("config", name)] = config
+
+    return configs
+
+
+def _compile_configs(names):
+    """Compile configurations with one query for the parents and one per child doctype, whatever their number"""
+    parents = frappe.get_all("Zakaah Assets Configuration",
+                             filters={"name": ["in", names]},
+                             fields=["name", "modified", "company", "fiscal_year"] + list(VALUATION_FIELDS.values()))
+
+    configs = {}
+    for parent in parents:
+        config = {
+            'name': parent.name,
+            'modified': parent.modified,
+            'company': parent.company,
+            'fiscal_year': parent.fiscal_year
+        }
+        for table in CONFIG_TABLES:
+            config[table] = []
+        config['valuation'] = {
+            table: parent.get(field) or "Closing Balance" for table, field in VALUATION_FIELDS.items()
+        }
+        configs[parent.name] = config
+
+    if not configs:
+        return configs
+
+    meta = frappe.get_meta("Zakaah Assets Configuration")
+    tables_by_doctype = {}
+    for table in CONFIG_TABLES:
+        tables_by_doctype.setdefault(meta.get_field(table).options, []).append(table)
+
+    for child_doctype, tables in tables_by_doctype.items():
+        for row in frappe.get_all(child_doctype,
+                                  filters={
+                                      "parent": ["in", list(configs)],
+                                      "parenttype": "Zakaah Assets Configuration",
+                                      "parentfield": ["in", tables]
+                                  },
+                                  fields=["*"],
+                                  order_by="idx asc"):
+            row.doctype = child_doctype
+            configs[row.parent][row.parentfield].append(row)
+
+    # Fill account names that were not stored on the rows
+    rows = [row for config in configs.values() for table in CONFIG_TABLES for row in config[table]]
+    missing = list(set(row.account for row in rows if row.get('account') and not row.get('account_name')))
+    if missing:
+        account_names = dict(frappe.get_all("Account", filters={"name": ["in", missing]},
+                                            fields=["name", "account_name"], as_list=True))
+        for row in rows:
+            if row.get('account') and not row.get('account_name'):
+                row['account_name'] = account_names.get(row.account)
+
+    return configs
+
+
+def clear_config_cache(name=None):
+    """Drop cached configurations (all, or one by name) and the company/fiscal year lookups"""
+    if name:
+        frappe.cache().hdel(CONFIG_CACHE_KEY, name)
+    else:
+        frappe.cache().delete_value(CONFIG_CACHE_KEY)
+    frappe.cache().delete_value(CONFIG_LOOKUP_CACHE_KEY)
+
+    if hasattr(frappe.local, "zakaah_config_cache"):
+        frappe.local.zakaah_config_cache = {}
+
+
+def _get_local_cache():
+    if getattr(frappe.local, "zakaah_config_cache", None) is None:
+        frappe.local.zakaah_config_cache = {}
+    return frappe.local.zakaah_config_cache
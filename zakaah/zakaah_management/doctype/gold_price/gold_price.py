@@ -1,28 +1,221 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import csv
+import json
+import os
+from bisect import bisect_right
 from frappe.model.document import Document
 import frappe
+from frappe import _
+from frappe.utils import cint, date_diff, flt, getdate, now
+
+GOLD_PRICE_CACHE_KEY = "zakaah_gold_price_series"
+
+# Rows upserted per multi-row INSERT when importing price feeds
+IMPORT_BATCH_SIZE = 1000
+
+# Column names accepted for each field in imported feeds
+IMPORT_COLUMNS = {
+    "price_date": ("price_date", "date"),
+    "price_per_gram_24k": ("price_per_gram_24k", "price_24k", "price")
+}
+
+# Days a price may be older than the requested date (site config: zakaah_gold_price_tolerance_days)
+DEFAULT_TOLERANCE_DAYS = 7
 
 class GoldPrice(Document):
     def validate(self):
         # Set default source if not set
         if not self.source:
             self.source = "Manual Entry"
-        
+
         # Ensure price is manually entered
         if not self.price_per_gram_24k:
             frappe.throw("Please enter the gold price manually")
 
+    def on_update(self):
+        clear_gold_price_cache()
+
+    def on_trash(self):
+        clear_gold_price_cache()
+
+
+def clear_gold_price_cache():
+    frappe.cache().delete_value(GOLD_PRICE_CACHE_KEY)
+
+
+def get_gold_price_series():
+    """Sorted [(price_date, price, name)] of all gold prices, cached in Redis"""
+    series = frappe.cache().get_value(GOLD_PRICE_CACHE_KEY)
+    if series is None:
+        series = [
+            (str(row.price_date), row.price_per_gram_24k, row.name)
+            for row in frappe.get_all("Gold Price",
+                                      fields=["name", "price_date", "price_per_gram_24k"],
+                                      order_by="price_date asc")
+        ]
+        frappe.cache().set_value(GOLD_PRICE_CACHE_KEY, series)
+    return series
+
+
+def resolve_gold_price(date, tolerance_days=None):
+    """Find the price on date, or the nearest earlier price within tolerance_days.
+
+    Bisects the cached price series. Returns a dict with the price, the
+    price_date actually used and whether it was an exact match, or None.
+    """
+    if not date:
+        return None
+
+    if tolerance_days is None:
+        tolerance_days = frappe.conf.get("zakaah_gold_price_tolerance_days", DEFAULT_TOLERANCE_DAYS)
+
+    date = str(getdate(date))
+    series = get_gold_price_series()
+    idx = bisect_right(series, (date, float("inf"))) - 1
+    if idx < 0:
+        return None
+
+    price_date, price, name = series[idx]
+    age = date_diff(date, price_date)
+    if age > cint(tolerance_days):
+        return None
+
+    return {
+        "price": price,
+        "price_date": price_date,
+        "gold_price": name,
+        "exact": age == 0
+    }
+
+
 @frappe.whitelist()
-def get_gold_price_for_date(date):
+def get_gold_price_for_date(date, tolerance_days=None):
     """Get gold price for a specific date from database only (manual entry)
-    
-    Returns None if price not found in database
+
+    Falls back to the nearest earlier price within the tolerance.
+    Returns None if no price is found (no automatic fetching).
+    """
+    info = resolve_gold_price(date, tolerance_days)
+    return info["price"] if info else None
+
+
+@frappe.whitelist()
+def get_gold_price_details(date, tolerance_days=None):
+    """Like get_gold_price_for_date, but also reports which price date was used"""
+    return resolve_gold_price(date, tolerance_days)
+
+
+@frappe.whitelist()
+def import_gold_prices(file_url, source="Bulk Import"):
+    """Import gold prices from an uploaded CSV, JSON or JSON Lines file"""
+    frappe.only_for(["System Manager", "Zakaah Manager"])
+
+    file_doc = frappe.get_doc("File", {"file_url": file_url})
+    return import_gold_prices_from_file(file_doc.get_full_path(), source)
+
+
+def import_gold_prices_from_file(path, source="Bulk Import"):
+    """Stream a price feed, validate it and upsert it in batches.
+
+    Rows are deduplicated on price_date (the last row of a date wins).
+    Returns a report with inserted, updated (price changed), skipped
+    (unchanged or invalid) counts and the first invalid rows.
     """
-    # Check if exists in DB
-    existing = frappe.db.exists("Gold Price", {"price_date": date})
-    if existing:
-        return frappe.db.get_value("Gold Price", existing, "price_per_gram_24k")
-    
-    # Return None if not found (no automatic fetching)
-    return None
+    report = {"inserted": 0, "updated": 0, "skipped": 0, "errors": []}
+    prices = {}
+
+    for line_no, row in _read_price_feed(path):
+        try:
+            price_date = str(getdate(_get_import_value(row, "price_date")))
+            price = flt(_get_import_value(row, "price_per_gram_24k"))
+            if price <= 0:
+                raise ValueError(_("Price must be greater than zero"))
+        except Exception as e:
+            report["skipped"] += 1
+            if len(report["errors"]) < 100:
+                report["errors"].append({"row": line_no, "error": str(e)})
+            continue
+
+        if price_date in prices:
+            report["skipped"] += 1
+        prices[price_date] = price
+
+    dates = sorted(prices)
+    for start in range(0, len(dates), IMPORT_BATCH_SIZE):
+        batch = {price_date: prices[price_date] for price_date in dates[start:start + IMPORT_BATCH_SIZE]}
+        _upsert_gold_price_batch(batch, source, report)
+        frappe.db.commit()
+
+    clear_gold_price_cache()
+    return report
+
+
+def _read_price_feed(path):
+    """Yield (row number, row dict) from a CSV, JSON or JSON Lines file"""
+    extension = os.path.splitext(path)[1].lower()
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if extension == ".csv":
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                yield line_no, row
+        elif extension in (".jsonl", ".ndjson"):
+            for line_no, line in enumerate(f, start=1):
+                if line.strip():
+                    yield line_no, json.loads(line)
+        elif extension == ".json":
+            data = json.load(f)
+            if isinstance(data, dict):
+                data = data.get("prices") or data.get("data") or []
+            for line_no, row in enumerate(data, start=1):
+                yield line_no, row
+        else:
+            frappe.throw(_("Unsupported gold price feed {0}. Use a .csv, .json or .jsonl file.").format(path))
+
+
+def _get_import_value(row, fieldname):
+    for column in IMPORT_COLUMNS[fieldname]:
+        value = row.get(column)
+        if value not in (None, ""):
+            return value
+    raise ValueError(_("Missing {0}").format(fieldname))
+
+
+def _upsert_gold_price_batch(batch, source, report):
+    """Insert new dates and update changed prices of one batch with a single statement"""
+    existing = dict(frappe.db.sql("""
+        SELECT price_date, price_per_gram_24k
+        FROM `tabGold Price`
+        WHERE price_date IN %(dates)s
+    """, {"dates": list(batch)}))
+    existing = {str(price_date): flt(price) for price_date, price in existing.items()}
+
+    timestamp = now()
+    user = frappe.session.user
+    values = []
+    for price_date, price in batch.items():
+        if price_date in existing:
+            if flt(existing[price_date], 2) == flt(price, 2):
+                report["skipped"] += 1
+                continue
+            report["updated"] += 1
+        else:
+            report["inserted"] += 1
+        values.append((frappe.generate_hash(length=10), price_date, "EGP", price, source,
+            timestamp, timestamp, user, user))
+
+    if not values:
+        return
+
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, 0)"] * len(values))
+    frappe.db.sql("""
+        INSERT INTO `tabGold Price`
+            (name, price_date, currency, price_per_gram_24k, source,
+            creation, modified, owner, modified_by, docstatus)
+        VALUES {placeholders}
+        ON DUPLICATE KEY UPDATE
+            price_per_gram_24k = VALUES(price_per_gram_24k),
+            source = VALUES(source),
+            modified = VALUES(modified),
+            modified_by = VALUES(modified_by)
+    """.format(placeholders=placeholders), [value for row in values for value in row])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from zakaah.zakaah_management.doctype.zakaah_account_activity.zakaah_account_activity import (
+    get_account_activity,
+    rebuild_company_account_activity,
+)
+
+TEST_COMPANY = "_Test Company"
+DEBIT_ACCOUNT = "_Test Bank - _TC"
+CREDIT_ACCOUNT = "_Test Cash - _TC"
+
+
+class TestZakaahAccountActivity(FrappeTestCase):
+    """GL Entry hooks must keep the summary equal to a rebuild from GL Entry"""
+
+    def tearDown(self):
+        frappe.db.rollback()
+
+    def test_cancelled_entry_matches_rebuild(self):
+        from erpnext.accounts.doctype.journal_entry.test_journal_entry import make_journal_entry
+
+        rebuild_company_account_activity(TEST_COMPANY)
+        before = self.get_totals()
+
+        journal_entry = make_journal_entry(DEBIT_ACCOUNT, CREDIT_ACCOUNT, 1000, submit=True)
+        journal_entry.cancel()
+
+        maintained = self.get_totals()
+        self.assertEqual(maintained, before)
+
+        rebuild_company_account_activity(TEST_COMPANY)
+        self.assertEqual(maintained, self.get_totals())
+
+    def get_totals(self):
+        # An account without a summary row has no entries
+        activity = get_account_activity([DEBIT_ACCOUNT, CREDIT_ACCOUNT], TEST_COMPANY)
+        return {
+            account: (round(row.total_debit, 2), round(row.total_credit, 2), row.entry_count)
+            if row else (0, 0, 0)
+            for account, row in ((a, activity.get(a)) for a in (DEBIT_ACCOUNT, CREDIT_ACCOUNT))
+        }
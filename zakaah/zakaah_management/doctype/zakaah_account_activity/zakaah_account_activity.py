@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from frappe.model.document import Document
+import frappe
+from frappe.utils import flt, now
+
+
+class ZakaahAccountActivity(Document):
+    pass
+
+
+def on_doctype_update():
+    frappe.db.add_unique("Zakaah Account Activity", ["company", "account"],
+        constraint_name="unique_company_account")
+
+
+def update_activity_on_gl_insert(doc, method=None):
+    """GL Entry after_insert: add the row to its account's activity summary.
+
+    Reversal rows written on cancellation (is_cancelled = 1) carry the
+    original's debit as credit and its credit as debit: they are subtracted
+    with the columns swapped back, which removes the original's totals and
+    count like rebuild_company_account_activity (cancelled rows excluded).
+    """
+    if doc.get("is_cancelled"):
+        _apply_gl_entry(doc, -flt(doc.credit), -flt(doc.debit), -1)
+    else:
+        _apply_gl_entry(doc, flt(doc.debit), flt(doc.credit), 1)
+
+
+def update_activity_on_gl_cancel(doc, method=None):
+    """GL Entry on_cancel: remove the row from its account's activity summary"""
+    _apply_gl_entry(doc, -flt(doc.debit), -flt(doc.credit), -1)
+
+
+def _apply_gl_entry(doc, debit, credit, count):
+    if not (doc.company and doc.account and doc.posting_date):
+        return
+
+    # Totals are exact; the date range only widens (rebuild_company_account_activity narrows it again)
+    frappe.db.sql("""
+        INSERT INTO `tabZakaah Account Activity`
+            (name, company, account, first_posting_date, last_posting_date,
+            total_debit, total_credit, entry_count,
+            creation, modified, owner, modified_by, docstatus)
+        VALUES
+            (%(name)s, %(company)s, %(account)s, %(posting_date)s, %(posting_date)s,
+            %(debit)s, %(credit)s, %(count)s,
+            %(timestamp)s, %(timestamp)s, %(user)s, %(user)s, 0)
+        ON DUPLICATE KEY UPDATE
+            first_posting_date = LEAST(IFNULL(first_posting_date, VALUES(first_posting_date)), VALUES(first_posting_date)),
+            last_posting_date = GREATEST(IFNULL(last_posting_date, VALUES(last_posting_date)), VALUES(last_posting_date)),
+            total_debit = total_debit + VALUES(total_debit),
+            total_credit = total_credit + VALUES(total_credit),
+            entry_count = entry_count + VALUES(entry_count),
+            modified = VALUES(modified)
+    """, {
+        'name': frappe.generate_hash(length=10),
+        'company': doc.company,
+        'account': doc.account,
+        'posting_date': doc.posting_date,
+        'debit': debit,
+        'credit': credit,
+        'count': count,
+        'timestamp': now(),
+        'user': frappe.session.user
+    })
+
+
+def rebuild_company_account_activity(company):
+    """Drop and recompute the activity summary of every account of a company from GL Entry"""
+    frappe.db.sql("""
+        DELETE FROM `tabZakaah Account Activity`
+        WHERE company = %s
+    """, company)
+
+    frappe.db.sql("""
+        INSERT INTO `tabZakaah Account Activity`
+            (name, company, account, first_posting_date, last_posting_date,
+            total_debit, total_credit, entry_count,
+            creation, modified, owner, modified_by, docstatus)
+        SELECT
+            SUBSTRING(MD5(CONCAT(company, account)), 1, 10), company, account,
+            MIN(posting_date), MAX(posting_date),
+            SUM(debit), SUM(credit), COUNT(*),
+            %(timestamp)s, %(timestamp)s, %(user)s, %(user)s, 0
+        FROM `tabGL Entry`
+        WHERE company = %(company)s
+            AND is_cancelled = 0
+        GROUP BY company, account
+    """, {
+        'company': company,
+        'timestamp': now(),
+        'user': frappe.session.user
+    })
+
+
+@frappe.whitelist()
+def rebuild_account_activity(company):
+    """Recompute the activity summary of every account of a company from GL Entry"""
+    frappe.only_for("System Manager")
+
+    rebuild_company_account_activity(company)
+    frappe.db.commit()
+
+    return {"company": company, "accounts": frappe.db.count("Zakaah Account Activity", {"company": company})}
+
+
+def get_account_activity(accounts, company):
+    """Return {account: activity row} for ledger accounts of a company, without touching GL Entry"""
+    accounts = list(dict.fromkeys(a for a in (accounts or []) if a))
+    if not accounts:
+        return {}
+
+    return {
+        row.account: row
+        for row in frappe.db.sql("""
+            SELECT account, first_posting_date, last_posting_date, total_debit, total_credit, entry_count
+            FROM `tabZakaah Account Activity`
+            WHERE company = %(company)s
+                AND account IN %(accounts)s
+        """, {'company': company, 'accounts': accounts}, as_dict=True)
+    }
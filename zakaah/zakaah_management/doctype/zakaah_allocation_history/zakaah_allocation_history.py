@@ -4,6 +4,7 @@ from frappe.model.document import Document
 import frappe
 from frappe import _
 from frappe.utils import flt
+from zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger import update_ledger_allocations
 
 class ZakaahAllocationHistory(Document):
 	def before_insert(self):
@@ -40,6 +41,11 @@ class ZakaahAllocationHistory(Document):
 		if not self.journal_entry:
 			return
 
+		# Lock the run, then the journal entry (same order as allocate_payments) until this allocation commits
+		if self.zakaah_calculation_run:
+			frappe.db.get_value("Zakaah Calculation Run", self.zakaah_calculation_run, "name", for_update=True)
+		frappe.db.get_value("Journal Entry", self.journal_entry, "name", for_update=True)
+
 		# Get total journal entry amount from GL Entry
 		je_amount = frappe.db.sql("""
 			SELECT SUM(debit) as total_debit
@@ -77,13 +83,22 @@ class ZakaahAllocationHistory(Document):
 				self.allocated_amount
 			))
 
+	def on_update(self):
+		# Drafts count as allocated too (docstatus != 2)
+		update_ledger_allocations([self.journal_entry])
+
+	def after_delete(self):
+		update_ledger_allocations([self.journal_entry])
+
 	def on_submit(self):
 		"""Update calculation run outstanding amount when submitted"""
 		self.update_calculation_run_status()
+		update_ledger_allocations([self.journal_entry])
 
 	def on_cancel(self):
 		"""Reverse calculation run updates when cancelled"""
 		self.update_calculation_run_status(reverse=True)
+		update_ledger_allocations([self.journal_entry])
 
 	def update_calculation_run_status(self, reverse=False):
 		"""Update the Zakaah Calculation Run's paid and outstanding amounts"""
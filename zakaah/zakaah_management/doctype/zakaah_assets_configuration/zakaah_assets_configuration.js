@@ -2,6 +2,9 @@
 // Copyright (c) 2025, Zakaah Team and contributors
 // For license information, please see license.txt
 
+const ACCOUNT_TABLES = ['cash_accounts', 'inventory_accounts', 'receivable_accounts',
+	'liabilities_accounts', 'reserve_accounts', 'payment_accounts'];
+
 frappe.ui.form.on("Zakaah Assets Configuration", {
 	refresh(frm) {
 		// Add custom buttons
@@ -81,9 +84,7 @@ frappe.ui.form.on("Zakaah Assets Configuration", {
 			
 			// Use the Calculate All Balances function which handles fiscal year
 			// This will update both Balance and Account Adjustment for all rows
-			setTimeout(() => {
-				calculate_all_balances(frm);
-			}, 500);
+			calculate_all_balances(frm);
 		}
 	}
 });
@@ -237,27 +238,7 @@ frappe.ui.form.on("Zakaah Account Configuration", {
 		let row = locals[cdt][cdn];
 
 		if (row.account && row.parentfield === 'payment_accounts') {
-			// If fiscal year is selected, use its date range
-			if (frm.doc.fiscal_year) {
-				frappe.call({
-					method: 'frappe.client.get_value',
-					args: {
-						doctype: 'Fiscal Year',
-						filters: { name: frm.doc.fiscal_year },
-						fieldname: ['year_start_date', 'year_end_date']
-					},
-					callback: function(r) {
-						if (r.message && r.message.year_end_date) {
-							// Use fiscal year range (BETWEEN start and end)
-							calculate_payment_account_debit_for_fy_range(frm, row, r.message.year_start_date, r.message.year_end_date);
-						} else {
-							calculate_payment_account_debit(frm, row);
-						}
-					}
-				});
-			} else {
-				calculate_payment_account_debit(frm, row);
-			}
+			calculate_payment_account_debit(frm, row);
 		}
 	},
 	
@@ -284,32 +265,8 @@ frappe.ui.form.on("Zakaah Account Configuration", {
 function calculate_account_balance(frm, row) {
 	if (!row.account) return;
 
-	// If fiscal year is selected, use fiscal year end date; otherwise use today
-	let balance_date = frappe.datetime.get_today();
-	
-	if (frm.doc.fiscal_year) {
-		// Get fiscal year end date
-		frappe.call({
-			method: 'frappe.client.get_value',
-			args: {
-				doctype: 'Fiscal Year',
-				filters: { name: frm.doc.fiscal_year },
-				fieldname: 'year_end_date'
-			},
-			callback: function(r) {
-				if (r.message && r.message.year_end_date) {
-					// Use fiscal year end date
-					calculate_account_balance_for_date(frm, row, r.message.year_end_date);
-				} else {
-					// Fallback to today
-					calculate_account_balance_for_date(frm, row, balance_date);
-				}
-			}
-		});
-	} else {
-		// No fiscal year selected, use today
-		calculate_account_balance_for_date(frm, row, balance_date);
-	}
+	// Balance as of the fiscal year end (today without a fiscal year) and Account Adjustment
+	fetch_account_values(frm, { [row.parentfield]: [row] });
 }
 
 function calculate_zakaah_value(row) {
@@ -377,157 +334,11 @@ function calculate_zakaah_value_for_payment(row) {
 	frappe.model.set_value(row.doctype, row.name, 'calculated_zakaah_value', zakaah_value);
 }
 
-function calculate_account_balance_for_date(frm, row, date) {
-	if (!row.account) return;
-
-	frappe.call({
-		method: 'erpnext.accounts.utils.get_balance_on',
-		args: {
-			account: row.account,
-			date: date,
-			company: frm.doc.company
-		},
-		callback: function(r) {
-			if (r.message !== undefined) {
-				frappe.model.set_value(row.doctype, row.name, 'balance', r.message);
-				
-				// IMPORTANT: Wait for the balance to be set, then recalculate zakaah value
-				setTimeout(() => {
-					// Update the row object with the latest data
-					let updated_row = locals[row.doctype][row.name];
-					
-					// Calculate zakaah value for all account types (even if margin_profit is 0 or empty)
-					if (['cash_accounts', 'inventory_accounts', 'receivable_accounts', 'liabilities_accounts', 'reserve_accounts'].includes(updated_row.parentfield)) {
-						calculate_zakaah_value(updated_row);
-					}
-				}, 100);
-			}
-		}
-	});
-}
-
 function calculate_payment_account_debit(frm, row) {
 	if (!row.account) return;
 
-	// If fiscal year is selected, use fiscal year date range
-	if (frm.doc.fiscal_year) {
-		frappe.call({
-			method: 'frappe.client.get_value',
-			args: {
-				doctype: 'Fiscal Year',
-				filters: { name: frm.doc.fiscal_year },
-				fieldname: ['year_start_date', 'year_end_date']
-			},
-			callback: function(r) {
-				if (r.message && r.message.year_end_date) {
-					// Use fiscal year range
-					calculate_payment_account_debit_for_fy_range(frm, row, r.message.year_start_date, r.message.year_end_date);
-				} else {
-					// Fallback to all-time debit
-					calculate_payment_account_debit_all_time(frm, row);
-				}
-			}
-		});
-	} else {
-		// No fiscal year selected, calculate all-time debit
-		calculate_payment_account_debit_all_time(frm, row);
-	}
-}
-
-function calculate_payment_account_debit_all_time(frm, row) {
-	if (!row.account) return;
-
-	// For payment accounts, we need GL Entry debit, not balance
-	frappe.call({
-		method: 'frappe.client.get_list',
-		args: {
-			doctype: 'GL Entry',
-			filters: {
-				account: row.account,
-				company: frm.doc.company
-			},
-			fields: ['sum(debit) as total_debit'],
-		},
-		callback: function(r) {
-			if (r.message && r.message.length > 0) {
-				let debit = r.message[0].total_debit || 0;
-				frappe.model.set_value(row.doctype, row.name, 'debit', debit);
-				
-				// IMPORTANT: Wait for the debit to be set, then recalculate zakaah value
-				setTimeout(() => {
-					let updated_row = locals[row.doctype][row.name];
-					calculate_zakaah_value_for_payment(updated_row);
-				}, 100);
-				
-				frappe.show_alert({
-					message: __("Debit amount updated: {0}", [format_currency(debit)]),
-					indicator: "green"
-				}, 3);
-			}
-		}
-	});
-}
-
-function calculate_payment_account_debit_for_date(frm, row, date) {
-	if (!row.account) return;
-
-	// For payment accounts, we need GL Entry debit up to the date, not balance
-	frappe.call({
-		method: 'frappe.client.get_list',
-		args: {
-			doctype: 'GL Entry',
-			filters: {
-				account: row.account,
-				company: frm.doc.company,
-				posting_date: ['<=', date]
-			},
-			fields: ['sum(debit) as total_debit'],
-		},
-		callback: function(r) {
-			if (r.message && r.message.length > 0) {
-				let debit = r.message[0].total_debit || 0;
-				frappe.model.set_value(row.doctype, row.name, 'debit', debit);
-				
-				// IMPORTANT: Wait for the debit to be set, then recalculate zakaah value
-				setTimeout(() => {
-					let updated_row = locals[row.doctype][row.name];
-					calculate_zakaah_value_for_payment(updated_row);
-				}, 100);
-			}
-		}
-	});
-}
-
-function calculate_payment_account_debit_for_fy_range(frm, row, from_date, to_date) {
-	if (!row.account) return;
-
-	// For payment accounts, sum debits WITHIN the fiscal year range (BETWEEN)
-	// This matches the Python logic: BETWEEN from_date AND to_date
-	frappe.call({
-		method: 'frappe.client.get_list',
-		args: {
-			doctype: 'GL Entry',
-			filters: {
-				account: row.account,
-				company: frm.doc.company,
-				posting_date: ['between', [from_date, to_date]],
-				is_cancelled: 0
-			},
-			fields: ['sum(debit) as total_debit'],
-		},
-		callback: function(r) {
-			if (r.message && r.message.length > 0) {
-				let debit = r.message[0].total_debit || 0;
-				frappe.model.set_value(row.doctype, row.name, 'debit', debit);
-				
-				// IMPORTANT: Wait for the debit to be set, then recalculate zakaah value
-				setTimeout(() => {
-					let updated_row = locals[row.doctype][row.name];
-					calculate_zakaah_value_for_payment(updated_row);
-				}, 100);
-			}
-		}
-	});
+	// Debit over the fiscal year (all time without a fiscal year) and Account Adjustment
+	fetch_account_values(frm, { payment_accounts: [row] });
 }
 
 function calculate_all_balances(frm) {
@@ -542,119 +353,83 @@ function calculate_all_balances(frm) {
 		return;
 	}
 
-	// Get the fiscal year's start and end dates
-	frappe.call({
-		method: 'frappe.client.get_value',
-		args: {
-			doctype: 'Fiscal Year',
-			filters: { name: frm.doc.fiscal_year },
-			fieldname: ['year_start_date', 'year_end_date']
-		},
-		callback: function(r) {
-			if (r.message && r.message.year_end_date) {
-				let fiscal_year_start = r.message.year_start_date;
-				let fiscal_year_end = r.message.year_end_date;
-				frappe.show_alert({
-					message: __("Calculating balances for {0} to {1}...", [
-						frappe.datetime.str_to_user(fiscal_year_start),
-						frappe.datetime.str_to_user(fiscal_year_end)
-					]),
-					indicator: "blue"
-				});
-				calculate_balances_for_date(frm, fiscal_year_start, fiscal_year_end);
-			} else {
-				frappe.msgprint(__("Could not get fiscal year dates"));
-			}
-		}
+	let rows_by_table = {};
+	ACCOUNT_TABLES.forEach(table => {
+		rows_by_table[table] = (frm.doc[table] || []).filter(row => row.account);
 	});
-}
 
-function calculate_balances_for_date(frm, fiscal_year_start, fiscal_year_end) {
-	let calculated = 0;
-	let total = 0;
-
-	// Count total accounts
-	['cash_accounts', 'inventory_accounts', 'receivable_accounts',
-	 'liabilities_accounts', 'reserve_accounts', 'payment_accounts'].forEach(table => {
-		if (frm.doc[table]) {
-			total += frm.doc[table].length;
-		}
+	frappe.show_alert({
+		message: __("Calculating balances for fiscal year {0}...", [frm.doc.fiscal_year]),
+		indicator: "blue"
 	});
 
-	// Calculate cash accounts
-	if (frm.doc.cash_accounts) {
-		frm.doc.cash_accounts.forEach(row => {
-			if (row.account) {
-				calculate_account_balance_for_date(frm, row, fiscal_year_end);
-				calculated++;
-			}
-		});
-	}
-
-	// Calculate inventory accounts
-	if (frm.doc.inventory_accounts) {
-		frm.doc.inventory_accounts.forEach(row => {
-			if (row.account) {
-				calculate_account_balance_for_date(frm, row, fiscal_year_end);
-				calculated++;
-			}
-		});
-	}
-
-	// Calculate receivable accounts
-	if (frm.doc.receivable_accounts) {
-		frm.doc.receivable_accounts.forEach(row => {
-			if (row.account) {
-				calculate_account_balance_for_date(frm, row, fiscal_year_end);
-				calculated++;
-			}
-		});
-	}
-
-	// Calculate liability accounts
-	if (frm.doc.liabilities_accounts) {
-		frm.doc.liabilities_accounts.forEach(row => {
-			if (row.account) {
-				calculate_account_balance_for_date(frm, row, fiscal_year_end);
-				calculated++;
-			}
-		});
-	}
-
-	// Calculate reserve accounts
-	if (frm.doc.reserve_accounts) {
-		frm.doc.reserve_accounts.forEach(row => {
-			if (row.account) {
-				calculate_account_balance_for_date(frm, row, fiscal_year_end);
-				calculated++;
-			}
-		});
-	}
-
-	// Calculate payment accounts (debit) - use fiscal year RANGE
-	if (frm.doc.payment_accounts) {
-		frm.doc.payment_accounts.forEach(row => {
-			if (row.account) {
-				calculate_payment_account_debit_for_fy_range(frm, row, fiscal_year_start, fiscal_year_end);
-				calculated++;
-			}
-		});
-	}
-
-	setTimeout(() => {
+	fetch_account_values(frm, rows_by_table, (calculated) => {
+		let total = ACCOUNT_TABLES.reduce((sum, table) => sum + (frm.doc[table] || []).length, 0);
 		frappe.show_alert({
 			message: __("Calculated balances for {0} of {1} accounts", [calculated, total]),
 			indicator: "green"
 		}, 5);
+	});
+}
 
-		// Refresh all child tables to show updated values
-		frm.refresh_fields();
-		
-		// Extra refresh after a short delay to ensure all async calculations complete
-		setTimeout(() => {
+function fetch_account_values(frm, rows_by_table, callback) {
+	// Balances, debits and Account Adjustments of all given rows in one request
+	let rows = {};
+	Object.keys(rows_by_table).forEach(table => {
+		rows[table] = rows_by_table[table]
+			.filter(row => row.account)
+			.map(row => ({ name: row.name, account: row.account, margin_profit: row.margin_profit }));
+	});
+
+	frappe.call({
+		method: 'zakaah.zakaah_management.doctype.zakaah_assets_configuration.zakaah_assets_configuration.get_account_values',
+		args: {
+			company: frm.doc.company,
+			fiscal_year: frm.doc.fiscal_year,
+			rows: rows
+		},
+		callback: function(r) {
+			if (!r.message) return;
+
+			// Apply every value first, then refresh the form once
+			let calculated = 0;
+			let mismatches = [];
+			Object.keys(r.message).forEach(table => {
+				r.message[table].forEach(values => {
+					let row = locals['Zakaah Account Configuration'][values.name];
+					if (!row || row.account !== values.account) return;
+
+					if (table === 'payment_accounts') {
+						row.debit = values.debit;
+						if (values.available_from) {
+							mismatches.push(__("{0}: no debit in this period, entries from {1} to {2} (total debit {3})", [
+								values.account,
+								frappe.datetime.str_to_user(values.available_from),
+								frappe.datetime.str_to_user(values.available_to),
+								format_currency(values.lifetime_debit)
+							]));
+						}
+					} else {
+						row.balance = values.balance;
+					}
+					row.calculated_zakaah_value = values.calculated_zakaah_value;
+					calculated++;
+				});
+			});
+
+			frm.dirty();
 			frm.refresh_fields();
-		}, 500);
-	}, 1500);
+
+			if (mismatches.length) {
+				frappe.show_alert({
+					message: mismatches.join('<br>'),
+					indicator: 'orange'
+				}, 10);
+			}
+
+			if (callback) callback(calculated);
+		}
+	});
 }
 
 function validate_configuration(frm) {
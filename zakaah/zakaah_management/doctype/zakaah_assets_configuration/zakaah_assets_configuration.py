@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import json
 from frappe.model.document import Document
 import frappe
-from frappe.utils import getdate
+from frappe import _
+from frappe.utils import flt, fmt_money, formatdate, getdate, nowdate
+from zakaah.zakaah_management.balance_engine import get_account_balances, get_account_debits
+from zakaah.zakaah_management.config_cache import CONFIG_TABLES, clear_config_cache, get_fiscal_year_dates
+from zakaah.zakaah_management.doctype.zakaah_account_activity.zakaah_account_activity import get_account_activity
+
+# Keys of compute_account_values that describe the account, not fields of the row
+ACTIVITY_KEYS = ('available_from', 'available_to', 'lifetime_debit')
 
 class ZakaahAssetsConfiguration(Document):
     def validate(self):
@@ -19,7 +27,7 @@ class ZakaahAssetsConfiguration(Document):
         """
         if self.company and self.fiscal_year:
             # Get fiscal year dates
-            fiscal_year_doc = frappe.get_doc("Fiscal Year", self.fiscal_year)
+            fiscal_year_doc = get_fiscal_year_dates(self.fiscal_year)
             balance_date = fiscal_year_doc.year_end_date
             fiscal_year_start = fiscal_year_doc.year_start_date
             fiscal_year_end = fiscal_year_doc.year_end_date
@@ -27,177 +35,201 @@ class ZakaahAssetsConfiguration(Document):
             # Calculate balances for all child tables
             self._calculate_balances(balance_date, fiscal_year_start, fiscal_year_end)
     
-    def _calculate_balances(self, balance_date, fiscal_year_start, fiscal_year_end):
-        """Calculate account balances as of given date"""
-        from frappe.utils import flt
-        
-        # Calculate balances for all account tables
-        account_tables = [
-            'cash_accounts',
-            'inventory_accounts',
-            'receivable_accounts',
-            'liabilities_accounts',
-            'reserve_accounts',
-            'payment_accounts'
-        ]
+    def on_update(self):
+        # Compiled configurations are cached per name and modified; lookups per company/fiscal year
+        clear_config_cache(self.name)
         
-        for table_name in account_tables:
-            if hasattr(self, table_name):
-                for row in getattr(self, table_name):
-                    if row.account:
-                        if table_name == 'payment_accounts':
-                            # For payment accounts, calculate Debit from GL Entry
-                            # Don't calculate balance - it should not appear
-                            debit = self._get_payment_account_debit(
-                                row.account, 
-                                fiscal_year_start, 
-                                fiscal_year_end
-                            )
-                            row.debit = debit
-                            # Calculate zakaah value based on debit
-                            row.calculated_zakaah_value = self._calculate_zakaah_value(debit, row.margin_profit)
-                            # Don't set balance at all for payment accounts
-                        else:
-                            # For other accounts, calculate Balance using Trial Balance logic
-                            balance = self._get_account_balance(row.account, balance_date)
-                            row.balance = balance
-                            # Calculate zakaah value based on balance
-                            row.calculated_zakaah_value = self._calculate_zakaah_value(balance, row.margin_profit)
+        before = self.get_doc_before_save()
+        if not before or _payment_accounts(before) != _payment_accounts(self):
+            enqueue_payment_ledger_rebuild(self.company)
     
-    def _calculate_zakaah_value(self, base_amount, margin_profit):
-        """
-        Calculate zakaah value (Account Adjustment) based on margin profit.
-        If margin_profit is empty/None, return base_amount.
-        If margin_profit contains %, apply percentage.
-        Otherwise, add/subtract the fixed amount.
-        """
-        from frappe.utils import flt
-        
-        # If no margin_profit or empty string, return base_amount
-        if not margin_profit or str(margin_profit).strip() == '':
-            return flt(base_amount)
+    def on_trash(self):
+        clear_config_cache(self.name)
+        if self.get("payment_accounts"):
+            enqueue_payment_ledger_rebuild(self.company)
+    
+    def _calculate_balances(self, balance_date, fiscal_year_start, fiscal_year_end):
+        """Calculate account balances as of given date, for all tables with grouped queries"""
+        rows_by_table = {
+            table: [row for row in (self.get(table) or []) if row.account]
+            for table in CONFIG_TABLES
+        }
         
-        margin = str(margin_profit).strip()
-        zakaah_value = flt(base_amount)
+        values = compute_account_values(self.company, fiscal_year_start, balance_date, rows_by_table)
         
-        # Check if it's a percentage (contains % sign)
-        if '%' in margin:
-            # Remove % sign and parse
-            try:
-                percent = flt(margin.replace('%', ''))
-                # Apply percentage: base_amount × (1 + percent/100)
-                zakaah_value = base_amount * (1 + (percent / 100))
-            except:
-                # If parsing fails, return base_amount
-                zakaah_value = base_amount
-        else:
-            # It's a fixed amount (can be positive or negative)
-            try:
-                amount = flt(margin)
-                # Simply add (positive or negative)
-                zakaah_value = base_amount + amount
-            except:
-                # If parsing fails, return base_amount
-                zakaah_value = base_amount
+        for table, rows in rows_by_table.items():
+            for row, row_values in zip(rows, values[table]):
+                # Payment accounts carry Debit (money paid out); the others carry Balance
+                row.update({key: value for key, value in row_values.items()
+                            if key not in ('name', 'account') + ACTIVITY_KEYS})
         
-        return flt(zakaah_value)
+        # Payment accounts with debits only outside the fiscal year are shown on save, not logged
+        mismatches = [
+            _("{0}: no debit in this period, entries from {1} to {2} (total debit {3})").format(
+                row_values['account'], formatdate(row_values['available_from']),
+                formatdate(row_values['available_to']), fmt_money(row_values['lifetime_debit']))
+            for row_values in values.get('payment_accounts', []) if row_values.get('available_from')
+        ]
+        if mismatches:
+            frappe.msgprint("<br>".join(mismatches), title=_("Payment Account Date Range"), indicator='orange')
     
-    def _get_account_balance(self, account, date):
-        """Get account balance as of date - using Trial Balance logic"""
-        try:
-            from erpnext.accounts.utils import get_balance_on
-            
-            # Get balance using ERPNext's built-in function (same as Trial Balance)
-            # This respects fiscal year, company, and all ERPNext rules
-            balance = get_balance_on(
-                account=account,
-                date=date,
-                company=self.company
-            )
-            
-            # Return absolute value for summation
-            return abs(balance or 0)
-            
-        except Exception as e:
-            frappe.log_error(f"Error getting balance for {account}: {str(e)}", "Balance Calculation")
-            return 0.0
+    def _calculate_zakaah_value(self, base_amount, margin_profit):
+        """Calculate zakaah value (Account Adjustment) based on margin profit"""
+        return calculate_zakaah_value(base_amount, margin_profit)
+
+
+def _payment_accounts(doc):
+    return sorted(set(row.account for row in (doc.get("payment_accounts") or []) if row.account))
+
+
+def enqueue_payment_ledger_rebuild(company):
+    """The Zakaah Payment Ledger holds entries of the company's payment accounts: rebuild it after they change"""
+    if not company:
+        return
+    frappe.enqueue(
+        "zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger.rebuild_company_payment_ledger",
+        queue="long",
+        job_name=f"zakaah_payment_ledger::{company}",
+        enqueue_after_commit=True,
+        company=company
+    )
+
+
+@frappe.whitelist()
+def get_account_values(company, rows, fiscal_year=None):
+    """Balances, payment account debits and Account Adjustments of a whole form in one call.
+
+    rows is {table: [{name, account, margin_profit}]} for the six account
+    tables. Balances are taken at the fiscal year end and debits over the
+    fiscal year (today and all time without a fiscal year).
+    """
+    frappe.has_permission("Zakaah Assets Configuration", "read", throw=True)
     
-    def _get_payment_account_debit(self, account, from_date, to_date):
-        """Get total Debit from GL Entry for payment accounts according to Fiscal Year"""
-        try:
-            from frappe.utils import flt, getdate
-            
-            # Ensure dates are date objects
-            from_date = getdate(from_date)
-            to_date = getdate(to_date)
+    if isinstance(rows, str):
+        rows = json.loads(rows)
+    
+    from_date, to_date = None, nowdate()
+    if fiscal_year:
+        fiscal_year_dates = get_fiscal_year_dates(fiscal_year)
+        if not fiscal_year_dates:
+            frappe.throw(_("Fiscal Year {0} not found").format(fiscal_year))
+        from_date, to_date = fiscal_year_dates.year_start_date, fiscal_year_dates.year_end_date
+    
+    return compute_account_values(company, from_date, to_date, {
+        table: [row for row in (rows.get(table) or []) if row.get('account')]
+        for table in CONFIG_TABLES
+    })
+
+
+def compute_account_values(company, from_date, to_date, rows_by_table):
+    """Return {table: [values]} in the order of rows_by_table's rows.
+
+    Every balance comes from one grouped get_account_balances call (as of
+    to_date) and every payment account debit from one grouped GL query
+    (from_date to to_date). Payment accounts without a debit in the period
+    but with debits on other dates also get available_from, available_to
+    and lifetime_debit from Zakaah Account Activity.
+    """
+    balance_accounts = [
+        row.get('account') for table, rows in rows_by_table.items() if table != 'payment_accounts'
+        for row in rows
+    ]
+    payment_accounts = [row.get('account') for row in rows_by_table.get('payment_accounts', [])]
+    
+    balances = {}
+    try:
+        balances = get_account_balances(balance_accounts, to_date, company) if balance_accounts else {}
+    except Exception as e:
+        frappe.log_error(f"Error getting balances: {str(e)}", "Balance Calculation")
+    
+    debits, mismatches = {}, {}
+    try:
+        debits = get_account_debits(payment_accounts, from_date, to_date, company) if payment_accounts else {}
+        mismatches = get_payment_date_mismatches(company, [a for a in payment_accounts if not debits.get(a)], from_date, to_date)
+    except Exception as e:
+        frappe.log_error(f"Error getting debit for payment accounts {payment_accounts}: {str(e)}", "Payment Account Debit Error")
+    
+    values = {}
+    for table, rows in rows_by_table.items():
+        values[table] = []
+        for row in rows:
+            account = row.get('account')
+            if table == 'payment_accounts':
+                # Debit from GL Entry over the period; balance does not apply
+                amount = flt(debits.get(account))
+                row_values = {'debit': amount}
+                if account in mismatches:
+                    activity = mismatches[account]
+                    row_values.update({
+                        'available_from': activity.first_posting_date,
+                        'available_to': activity.last_posting_date,
+                        'lifetime_debit': flt(activity.total_debit)
+                    })
+            else:
+                # Absolute value for summation (Trial Balance logic)
+                amount = abs(flt(balances.get(account)))
+                row_values = {'balance': amount}
             
-            # Sum all debit amounts from GL Entry for the fiscal year period
-            # Payment accounts are always debit side (money paid out)
-            debit_result = frappe.db.sql("""
-                SELECT 
-                    SUM(gle.debit) as total_debit,
-                    COUNT(*) as entry_count
-                FROM `tabGL Entry` gle
-                WHERE gle.account = %(account)s
-                    AND gle.company = %(company)s
-                    AND gle.posting_date BETWEEN %(from_date)s AND %(to_date)s
-                    AND gle.is_cancelled = 0
-            """, {
+            row_values.update({
+                'name': row.get('name'),
                 'account': account,
-                'company': self.company,
-                'from_date': from_date,
-                'to_date': to_date
-            }, as_dict=True)
-            
-            total_debit = flt(debit_result[0].total_debit) if debit_result and debit_result[0] and debit_result[0].total_debit else 0.0
-            entry_count = debit_result[0].entry_count if debit_result and debit_result[0] and debit_result[0].entry_count else 0
-            
-            # If no debit found in date range, check all dates to see what's available
-            if total_debit == 0:
-                date_range_check = frappe.db.sql("""
-                    SELECT 
-                        MIN(gle.posting_date) as min_date,
-                        MAX(gle.posting_date) as max_date,
-                        SUM(gle.debit) as total_all_debit,
-                        SUM(ABS(gle.debit - gle.credit)) as net_debit
-                    FROM `tabGL Entry` gle
-                    WHERE gle.account = %(account)s
-                        AND gle.company = %(company)s
-                        AND gle.is_cancelled = 0
-                """, {
-                    'account': account,
-                    'company': self.company
-                }, as_dict=True)
-                
-                if date_range_check and date_range_check[0] and date_range_check[0].total_all_debit:
-                    # Use short title and detailed message
-                    message = (
-                        f"Account: {account}\n"
-                        f"Company: {self.company}\n"
-                        f"Requested: {from_date} to {to_date}\n"
-                        f"Available: {date_range_check[0].min_date} to {date_range_check[0].max_date}\n"
-                        f"Total Debit (all dates): {date_range_check[0].total_all_debit}\n"
-                        f"Net Movement: {date_range_check[0].net_debit}"
-                    )
-                    frappe.log_error(
-                        message,
-                        "Payment Account Debit - Date Range Mismatch"
-                    )
-            
-            # Only log for debugging if there's an issue or if needed
-            # Removed automatic logging to avoid truncation errors
-            
-            return total_debit
-            
-        except Exception as e:
-            # Use short title and detailed message
-            message = (
-                f"Error getting debit for payment account: {account}\n"
-                f"Company: {getattr(self, 'company', 'N/A')}\n"
-                f"Date Range: {from_date} to {to_date}\n"
-                f"Error: {str(e)}"
-            )
-            frappe.log_error(message, "Payment Account Debit Error")
-            return 0.0
+                'calculated_zakaah_value': calculate_zakaah_value(amount, row.get('margin_profit'))
+            })
+            values[table].append(row_values)
+    
+    return values
+
+
+def get_payment_date_mismatches(company, accounts, from_date, to_date):
+    """Payment accounts that have no debit in the period but do have debits on other dates.
+
+    Reads the per account summary in Zakaah Account Activity instead of
+    scanning GL Entry. Returns {account: activity row} of those accounts.
+    """
+    if not accounts or not from_date:
+        return {}
+    
+    return {
+        account: row
+        for account, row in get_account_activity(accounts, company).items()
+        if flt(row.total_debit)
+    }
 
 
+def calculate_zakaah_value(base_amount, margin_profit):
+    """
+    Calculate zakaah value (Account Adjustment) based on margin profit.
+    If margin_profit is empty/None, return base_amount.
+    If margin_profit contains %, apply percentage.
+    Otherwise, add/subtract the fixed amount.
+    """
+    from frappe.utils import flt
+    
+    # If no margin_profit or empty string, return base_amount
+    if not margin_profit or str(margin_profit).strip() == '':
+        return flt(base_amount)
+    
+    margin = str(margin_profit).strip()
+    zakaah_value = flt(base_amount)
+    
+    # Check if it's a percentage (contains % sign)
+    if '%' in margin:
+        # Remove % sign and parse
+        try:
+            percent = flt(margin.replace('%', ''))
+            # Apply percentage: base_amount × (1 + percent/100)
+            zakaah_value = base_amount * (1 + (percent / 100))
+        except:
+            # If parsing fails, return base_amount
+            zakaah_value = base_amount
+    else:
+        # It's a fixed amount (can be positive or negative)
+        try:
+            amount = flt(margin)
+            # Simply add (positive or negative)
+            zakaah_value = base_amount + amount
+        except:
+            # If parsing fails, return base_amount
+            zakaah_value = base_amount
+    
+    return flt(zakaah_value)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from frappe.model.document import Document
+import frappe
+from frappe.utils import add_days, add_months, flt, get_last_day, getdate, now, nowdate
+
+SNAPSHOT_FIELDS = ("debit", "credit", "debit_in_account_currency", "credit_in_account_currency")
+
+class ZakaahBalanceSnapshot(Document):
+    pass
+
+
+def on_doctype_update():
+    frappe.db.add_unique("Zakaah Balance Snapshot", ["company", "account", "period_end"],
+        constraint_name="unique_company_account_period_end")
+
+
+def update_snapshots_on_gl_insert(doc, method=None):
+    """GL Entry after_insert: add the new row to every snapshot on or after its posting date.
+
+    Reversal rows written on cancellation carry swapped debit/credit, so adding
+    them removes the original row's contribution again.
+    """
+    _apply_gl_entry(doc, 1)
+
+
+def update_snapshots_on_gl_cancel(doc, method=None):
+    """GL Entry on_cancel: remove the row from every snapshot on or after its posting date"""
+    _apply_gl_entry(doc, -1)
+
+
+def _apply_gl_entry(doc, sign):
+    if not (doc.company and doc.account and doc.posting_date):
+        return
+
+    frappe.db.sql("""
+        UPDATE `tabZakaah Balance Snapshot`
+        SET
+            debit = debit + %(debit)s,
+            credit = credit + %(credit)s,
+            debit_in_account_currency = debit_in_account_currency + %(debit_in_account_currency)s,
+            credit_in_account_currency = credit_in_account_currency + %(credit_in_account_currency)s
+        WHERE company = %(company)s
+            AND account = %(account)s
+            AND period_end >= %(posting_date)s
+    """, {
+        'debit': sign * flt(doc.debit),
+        'credit': sign * flt(doc.credit),
+        'debit_in_account_currency': sign * flt(doc.debit_in_account_currency),
+        'credit_in_account_currency': sign * flt(doc.credit_in_account_currency),
+        'company': doc.company,
+        'account': doc.account,
+        'posting_date': doc.posting_date
+    })
+
+
+@frappe.whitelist()
+def rebuild_balance_snapshots(company, upto=None):
+    """Drop and rebuild the month-end snapshots of a company from GL Entry (backfill)"""
+    frappe.only_for("System Manager")
+
+    frappe.db.sql("""
+        DELETE FROM `tabZakaah Balance Snapshot`
+        WHERE company = %s
+    """, company)
+
+    created = extend_balance_snapshots(company, upto)
+    frappe.db.commit()
+
+    return {"company": company, "snapshots_created": created}
+
+
+def create_month_end_snapshots():
+    """Scheduler (monthly): roll every company's snapshots forward to the last closed month"""
+    companies = frappe.db.sql_list("""
+        SELECT DISTINCT company
+        FROM `tabZakaah Balance Snapshot`
+    """)
+
+    for company in companies:
+        try:
+            extend_balance_snapshots(company)
+            frappe.db.commit()
+        except Exception as e:
+            frappe.db.rollback()
+            frappe.log_error(f"Error creating balance snapshots for {company}: {str(e)}", "Balance Snapshot Error")
+
+
+def extend_balance_snapshots(company, upto=None):
+    """Create month-end snapshots after the company's latest one, up to upto.
+
+    upto defaults to the end of the previous month. Each new snapshot is the
+    previous one plus the month's GL Entry totals, so one grouped GL query
+    covers every missing month.
+    """
+    upto = get_last_day(upto) if upto else get_last_day(add_months(nowdate(), -1))
+    if getdate(upto) > getdate(nowdate()):
+        upto = get_last_day(add_months(nowdate(), -1))
+
+    latest = frappe.db.sql("""
+        SELECT MAX(period_end)
+        FROM `tabZakaah Balance Snapshot`
+        WHERE company = %s
+    """, company)[0][0]
+
+    totals = {}
+    if latest:
+        if getdate(latest) >= getdate(upto):
+            return 0
+
+        for row in frappe.db.sql("""
+            SELECT account, debit, credit, debit_in_account_currency, credit_in_account_currency
+            FROM `tabZakaah Balance Snapshot`
+            WHERE company = %s AND period_end = %s
+        """, (company, latest), as_dict=True):
+            totals[row.account] = [flt(row.get(field)) for field in SNAPSHOT_FIELDS]
+
+    conditions = ["company = %(company)s", "posting_date <= %(upto)s", "is_cancelled = 0"]
+    if latest:
+        conditions.append("posting_date > %(latest)s")
+
+    movements = frappe.db.sql("""
+        SELECT
+            account,
+            LAST_DAY(posting_date) AS period_end,
+            SUM(debit) AS debit,
+            SUM(credit) AS credit,
+            SUM(debit_in_account_currency) AS debit_in_account_currency,
+            SUM(credit_in_account_currency) AS credit_in_account_currency
+        FROM `tabGL Entry`
+        WHERE {conditions}
+        GROUP BY account, LAST_DAY(posting_date)
+    """.format(conditions=" AND ".join(conditions)), {
+        'company': company,
+        'upto': upto,
+        'latest': latest
+    }, as_dict=True)
+
+    if not movements and not totals:
+        return 0
+
+    movements_by_period = {}
+    for row in movements:
+        movements_by_period.setdefault(getdate(row.period_end), []).append(row)
+
+    if latest:
+        period_end = get_last_day(add_days(latest, 1))
+    else:
+        period_end = min(movements_by_period)
+
+    timestamp = now()
+    user = frappe.session.user
+    values = []
+
+    # Running sum: each month-end snapshot carries every account seen so far
+    while getdate(period_end) <= getdate(upto):
+        for row in movements_by_period.get(getdate(period_end), []):
+            account_totals = totals.setdefault(row.account, [0.0] * len(SNAPSHOT_FIELDS))
+            for idx, field in enumerate(SNAPSHOT_FIELDS):
+                account_totals[idx] += flt(row.get(field))
+
+        for account, account_totals in totals.items():
+            values.append((
+                frappe.generate_hash(length=10), company, account, period_end,
+                *account_totals, timestamp, timestamp, user, user
+            ))
+
+        period_end = get_last_day(add_days(period_end, 1))
+
+    if values:
+        frappe.db.bulk_insert(
+            "Zakaah Balance Snapshot",
+            fields=["name", "company", "account", "period_end", *SNAPSHOT_FIELDS,
+                "creation", "modified", "owner", "modified_by"],
+            values=values
+        )
+
+    return len(values)
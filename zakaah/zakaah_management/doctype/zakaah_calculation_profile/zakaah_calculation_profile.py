@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from frappe.model.document import Document
+
+class ZakaahCalculationProfile(Document):
+    pass
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import nowdate
+
+from zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run import CALCULATION_QUERY_BUDGET
+from zakaah.zakaah_management.profiler import assert_query_budget
+
+TEST_COMPANY = "_Test Company"
+
+
+class TestZakaahCalculationRunQueryBudget(FrappeTestCase):
+    def setUp(self):
+        from erpnext.accounts.utils import get_fiscal_year
+
+        self.fiscal_year, self.from_date, self.to_date = get_fiscal_year(nowdate(), company=TEST_COMPANY)[:3]
+
+        if not frappe.db.exists("Gold Price", {"price_date": self.to_date}):
+            frappe.get_doc({
+                "doctype": "Gold Price",
+                "price_date": self.to_date,
+                "price_per_gram_24k": 3000
+            }).insert(ignore_permissions=True)
+
+        self.config = frappe.get_doc({
+            "doctype": "Zakaah Assets Configuration",
+            "company": TEST_COMPANY,
+            "fiscal_year": self.fiscal_year
+        })
+
+    def tearDown(self):
+        frappe.db.rollback()
+
+    def test_calculate_zakaah_query_count_does_not_grow_with_accounts(self):
+        accounts = frappe.get_all("Account",
+                                  filters={"company": TEST_COMPANY, "root_type": "Asset", "is_group": 0},
+                                  limit=6, pluck="name")
+        self.assertGreater(len(accounts), 1)
+
+        small = self.count_calculation_queries(accounts[:1])
+        large = self.count_calculation_queries(accounts)
+
+        self.assertEqual(small, large)
+
+    def count_calculation_queries(self, accounts):
+        self.config.set("cash_accounts", [{"account": account} for account in accounts])
+        self.config.save(ignore_permissions=True)
+
+        run = frappe.get_doc({
+            "doctype": "Zakaah Calculation Run",
+            "company": TEST_COMPANY,
+            "fiscal_year": self.fiscal_year,
+            "from_date": self.from_date,
+            "to_date": self.to_date
+        })
+        run.flags.force_recalculation = True
+
+        with assert_query_budget(CALCULATION_QUERY_BUDGET, "calculate_zakaah") as counter:
+            run.calculate_zakaah()
+
+        return counter.count
@@ -50,10 +50,24 @@ frappe.ui.form.on('Zakaah Calculation Run', {
         calculate_nisab(frm);
     },
     
+    onload: function(frm) {
+        // Background calculation progress (see run_calculation_job)
+        frappe.realtime.off('zakaah_calculation_progress');
+        frappe.realtime.on('zakaah_calculation_progress', function(data) {
+            if (!data || data.name !== frm.doc.name) return;
+            show_calculation_progress(frm, data);
+        });
+    },
+    
     refresh: function(frm) {
         // Add Calculate button
         if (frm.doc.status === 'Draft' && frm.doc.company && frm.doc.to_date) {
             frm.add_custom_button(__('Calculate Zakaah'), function() {
+                if (frm.doc.run_in_background) {
+                    enqueue_calculation(frm);
+                    return;
+                }
+                
                 frm.call({
                     method: 'zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run.calculate_zakaah_for_run',
                     args: {
@@ -76,51 +90,10 @@ frappe.ui.form.on('Zakaah Calculation Run', {
             }, __('Actions'));
         }
         
-        // Add Load Journal Entries button (show always)
-        frm.add_custom_button(__('Load Journal Entries'), function() {
-            // Check if document is saved
-            if (!frm.doc.name || frm.doc.name.startsWith('New')) {
-                frappe.msgprint(__('Please save the document first before loading journal entries.'));
-                return;
-            }
-            
-            if (!frm.doc.payment_accounts || frm.doc.payment_accounts.length === 0) {
-                frappe.msgprint(__('Please add accounts in "Zakaah Payment Accounts" section first.'));
-                return;
-            }
-            
-            frm.call({
-                method: 'zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run.get_journal_entries_for_calculation_run',
-                args: {
-                    calculation_run_name: frm.doc.name
-                },
-                callback: function(r) {
-                    if (r.message && r.message.length > 0) {
-                        frm.clear_table('journal_entries');
-                        r.message.forEach(function(entry) {
-                            let row = frm.add_child('journal_entries');
-                            row.journal_entry = entry.journal_entry;
-                            row.posting_date = entry.posting_date;
-                            row.account = entry.account;
-                            row.total_debit = entry.debit || 0;  // Map 'debit' to 'total_debit'
-                        });
-                        frm.refresh_field('journal_entries');
-                        frappe.show_alert({
-                            message: __('Loaded {0} journal entries', [r.message.length]),
-                            indicator: 'green'
-                        }, 5);
-                    } else {
-                        frappe.show_alert({
-                            message: __('No journal entries found'),
-                            indicator: 'orange'
-                        }, 3);
-                    }
-                },
-                error: function() {
-                    frappe.msgprint(__('Error loading journal entries.'));
-                }
-            });
-        }, __('Actions'));
+        // Journal entries are not stored on the run - show them in a paged panel
+        if (!frm.is_new()) {
+            render_journal_entries_panel(frm);
+        }
         
         // Add Debug button
         if (frm.doc.status === 'Draft' && frm.doc.company && frm.doc.to_date) {
@@ -236,6 +209,191 @@ function load_payment_accounts(frm) {
     });
 }
 
+function enqueue_calculation(frm) {
+    if (frm.is_dirty()) {
+        frappe.msgprint(__('Please save the document before calculating in the background.'));
+        return;
+    }
+    
+    frm.call({
+        method: 'zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run.enqueue_calculation_for_run',
+        args: {
+            name: frm.doc.name
+        },
+        callback: function(r) {
+            frappe.show_alert({
+                message: __('Zakaah calculation queued in the background'),
+                indicator: 'blue'
+            }, 5);
+            frappe.show_progress(__('Calculating Zakaah'), 0, 100, __('Queued'));
+        }
+    });
+}
+
+function show_calculation_progress(frm, data) {
+    const phase_labels = {
+        config: __('Loading configuration'),
+        balances: __('Calculating account balances'),
+        gold_price: __('Fetching gold price'),
+        nisab: __('Calculating nisab and zakaah'),
+        saving: __('Saving results')
+    };
+    
+    if (data.status === 'completed') {
+        frappe.hide_progress();
+        frm.reload_doc();
+        frappe.show_alert({
+            message: __('Zakaah calculation completed!'),
+            indicator: 'green'
+        }, 5);
+    } else if (data.status === 'failed') {
+        frappe.hide_progress();
+        frappe.msgprint({
+            title: __('Zakaah Calculation Failed'),
+            message: data.message || __('See Error Log for details.'),
+            indicator: 'red'
+        });
+    } else {
+        frappe.show_progress(__('Calculating Zakaah'), data.progress, 100, phase_labels[data.phase] || data.phase);
+    }
+}
+
+function render_journal_entries_panel(frm) {
+    const $wrapper = frm.get_field('journal_entries_html').$wrapper;
+    const state = frm.__journal_entries_state = frm.__journal_entries_state || {
+        start: 0,
+        page_length: 20,
+        sort_by: 'posting_date',
+        sort_order: 'desc',
+        search: '',
+        // Keyset pages of the posting date sort: cursor of this page and of the pages before it
+        cursor: null,
+        previous_cursors: [],
+        next_cursor: null,
+        total_count: 0
+    };
+    const reset = function() {
+        state.start = 0;
+        state.cursor = null;
+        state.previous_cursors = [];
+    };
+    
+    $wrapper.html(`
+        <div class="zakaah-je-panel">
+            <div class="flex" style="gap: 8px; margin-bottom: 8px;">
+                <input type="text" class="form-control input-xs je-search" style="max-width: 260px;"
+                    placeholder="${__('Search journal entry or remarks')}">
+            </div>
+            <div class="je-table"></div>
+            <div class="flex justify-between align-center" style="margin-top: 8px;">
+                <span class="text-muted je-count"></span>
+                <div>
+                    <button class="btn btn-xs btn-default je-prev">${__('Previous')}</button>
+                    <button class="btn btn-xs btn-default je-next">${__('Next')}</button>
+                </div>
+            </div>
+        </div>
+    `);
+    $wrapper.find('.je-search').val(state.search);
+    
+    const load = function() {
+        frappe.call({
+            method: 'zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run.get_journal_entries_for_calculation_run',
+            args: {
+                calculation_run_name: frm.doc.name,
+                start: state.start,
+                page_length: state.page_length,
+                sort_by: state.sort_by,
+                sort_order: state.sort_order,
+                search: state.search,
+                cursor: state.cursor ? JSON.stringify(state.cursor) : null
+            },
+            callback: function(r) {
+                const data = r.message || {entries: [], total_count: 0};
+                // total_count is only sent with the first page
+                if (data.total_count !== null && data.total_count !== undefined) {
+                    state.total_count = data.total_count;
+                }
+                state.page_length = data.page_length || state.page_length;
+                state.next_cursor = data.next_cursor || null;
+                render_journal_entries_page($wrapper, state, data);
+            }
+        });
+    };
+    
+    $wrapper.off('click', '.je-sort').on('click', '.je-sort', function() {
+        const sort_by = $(this).attr('data-sort');
+        state.sort_order = (state.sort_by === sort_by && state.sort_order === 'desc') ? 'asc' : 'desc';
+        state.sort_by = sort_by;
+        reset();
+        load();
+    });
+    $wrapper.find('.je-search').on('input', frappe.utils.debounce(function() {
+        state.search = $(this).val();
+        reset();
+        load();
+    }, 300));
+    $wrapper.find('.je-prev').on('click', function() {
+        state.start = Math.max(0, state.start - state.page_length);
+        if (state.sort_by === 'posting_date') {
+            state.cursor = state.previous_cursors.pop() || null;
+        }
+        load();
+    });
+    $wrapper.find('.je-next').on('click', function() {
+        state.start += state.page_length;
+        if (state.sort_by === 'posting_date') {
+            state.previous_cursors.push(state.cursor);
+            state.cursor = state.next_cursor;
+        }
+        load();
+    });
+    
+    load();
+}
+
+function render_journal_entries_page($wrapper, state, data) {
+    const columns = [
+        ['posting_date', __('Posting Date')],
+        ['journal_entry', __('Journal Entry')],
+        ['account', __('Account')],
+        ['debit', __('Debit')],
+        ['credit', __('Credit')]
+    ];
+    
+    const header = columns.map(function(col) {
+        const arrow = state.sort_by === col[0] ? (state.sort_order === 'asc' ? ' ▲' : ' ▼') : '';
+        return `<th class="je-sort" data-sort="${col[0]}" style="cursor: pointer;">${col[1]}${arrow}</th>`;
+    }).join('') + `<th>${__('Remarks')}</th>`;
+    
+    const rows = data.entries.map(function(entry) {
+        return `<tr>
+            <td>${frappe.datetime.str_to_user(entry.posting_date)}</td>
+            <td><a href="/app/journal-entry/${encodeURIComponent(entry.journal_entry)}">${frappe.utils.escape_html(entry.journal_entry)}</a></td>
+            <td>${frappe.utils.escape_html(entry.account)}</td>
+            <td class="text-right">${format_currency(entry.debit || 0)}</td>
+            <td class="text-right">${format_currency(entry.credit || 0)}</td>
+            <td>${frappe.utils.escape_html(entry.remarks || '')}</td>
+        </tr>`;
+    }).join('') || `<tr><td colspan="6" class="text-muted text-center">${__('No journal entries found')}</td></tr>`;
+    
+    $wrapper.find('.je-table').html(`
+        <table class="table table-bordered table-condensed">
+            <thead><tr>${header}</tr></thead>
+            <tbody>${rows}</tbody>
+        </table>
+    `);
+    
+    const end = Math.min(state.start + data.entries.length, state.total_count);
+    $wrapper.find('.je-count').text(state.total_count
+        ? __('{0} - {1} of {2}', [state.start + 1, end, state.total_count])
+        : '');
+    $wrapper.find('.je-prev').prop('disabled', state.start === 0);
+    $wrapper.find('.je-next').prop('disabled', state.sort_by === 'posting_date'
+        ? !state.next_cursor
+        : end >= state.total_count);
+}
+
 function calculate_nisab(frm) {
     if (frm.doc.gold_price_per_gram_24k && frm.doc.owners_count) {
         const nisab_grams = frm.doc.owners_count * 85;
@@ -251,24 +409,21 @@ function fetch_gold_price_for_date(frm, date) {
     }, 3);
     
     frappe.call({
-        method: 'frappe.client.get_list',
+        method: 'zakaah.zakaah_management.doctype.gold_price.gold_price.get_gold_price_details',
         args: {
-            doctype: 'Gold Price',
-            filters: {'price_date': date},
-            fields: ['name', 'price_date', 'price_per_gram_24k'],
-            limit_page_length: 1
+            date: date
         },
         callback: function(r) {
-            // Debug: show what we got
-            frappe.log_error('Gold price query result for date ' + date + ': ' + JSON.stringify(r.message), 'Gold Price Debug');
-            
-            if (r.message && r.message.length > 0) {
-                // Gold price exists for this date
-                const gold_price = r.message[0];
-                frm.set_value('gold_price_per_gram_24k', gold_price.price_per_gram_24k);
+            if (r.message) {
+                // Gold price exists for this date (or the nearest earlier date within tolerance)
+                const gold_price = r.message;
+                frm.set_value('gold_price_per_gram_24k', gold_price.price);
+                frm.set_value('gold_price_used_date', gold_price.price_date);
                 frappe.show_alert({
-                    message: __('Gold price loaded: ' + gold_price.price_per_gram_24k + ' EGP'),
-                    indicator: 'green'
+                    message: gold_price.exact
+                        ? __('Gold price loaded: ' + gold_price.price + ' EGP')
+                        : __('Gold price of {0} loaded: {1} EGP', [gold_price.price_date, gold_price.price]),
+                    indicator: gold_price.exact ? 'green' : 'orange'
                 }, 3);
                 // Auto-calculate nisab
                 calculate_nisab(frm);
@@ -1,9 +1,51 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import hashlib
+import json
+import time
+from contextlib import nullcontext
 from frappe.model.document import Document
 import frappe
 from frappe import _
-from frappe.utils import flt
+from frappe.utils import add_to_date, cint, flt, getdate, now, now_datetime
+from zakaah.zakaah_management.balance_engine import (
+    get_account_balances,
+    get_account_currencies,
+    get_balances_at_dates,
+    get_changed_accounts,
+    get_daily_balance_series,
+    get_gl_watermark,
+    get_subtree_accounts,
+)
+from zakaah.zakaah_management.config_cache import find_config_name, get_compiled_config, get_fiscal_year_dates
+from zakaah.zakaah_management.doctype.gold_price.gold_price import resolve_gold_price
+from zakaah.zakaah_management.doctype.zakaah_assets_configuration.zakaah_assets_configuration import calculate_zakaah_value
+from zakaah.zakaah_management.exchange_rates import get_exchange_rates
+from zakaah.zakaah_management.profiler import CalculationProfiler
+
+# (configuration table, assets key, item category) for each asset category
+ASSET_CATEGORIES = (
+    ('cash_accounts', 'cash', 'Cash'),
+    ('inventory_accounts', 'inventory', 'Inventory'),
+    ('receivable_accounts', 'receivables', 'Receivables'),
+    ('liabilities_accounts', 'liabilities', 'Liabilities'),
+    ('reserve_accounts', 'reserves', 'Reserves'),
+)
+
+# Categories whose normal balance is a credit (the others are debit balance assets)
+CREDIT_BALANCE_CATEGORIES = ('liabilities_accounts',)
+
+# Safety margin subtracted from per-account GL watermarks
+WATERMARK_MARGIN_MINUTES = 10
+
+# Bulk calculation results are kept in cache for a day
+BULK_RESULTS_EXPIRY = 24 * 60 * 60
+
+# Backfilled runs written per commit
+BACKFILL_COMMIT_SIZE = 20
+
+# SQL queries calculate_zakaah may run, whatever the number of configured accounts
+CALCULATION_QUERY_BUDGET = 60
 
 class ZakaahCalculationRun(Document):
     def validate(self):
@@ -12,7 +54,7 @@ class ZakaahCalculationRun(Document):
         
         # Auto-populate dates from fiscal year if not set
         if self.fiscal_year and (not self.from_date or not self.to_date):
-            fiscal_year_doc = frappe.get_doc("Fiscal Year", self.fiscal_year)
+            fiscal_year_doc = get_fiscal_year_dates(self.fiscal_year)
             if not self.from_date:
                 self.from_date = fiscal_year_doc.year_start_date
             if not self.to_date:
@@ -32,7 +74,7 @@ class ZakaahCalculationRun(Document):
         if self.company and self.fiscal_year and not self.payment_accounts:
             self._load_payment_accounts()
         
-        # Auto-load journal entries if payment accounts exist
+        # Journal entry totals for the payment accounts (details are paged on demand)
         if self.payment_accounts and len(self.payment_accounts) > 0:
             self._load_journal_entries()
     
@@ -40,120 +82,114 @@ class ZakaahCalculationRun(Document):
         """Load payment accounts from Zakaah Assets Configuration"""
         try:
             # Get configuration for this company and fiscal year
-            config = frappe.db.get_value("Zakaah Assets Configuration", 
+            config_name = frappe.db.get_value("Zakaah Assets Configuration", 
                                         {"company": self.company, "fiscal_year": self.fiscal_year}, 
-                                        "name")
-            if not config:
+                                        ["name", "modified"], as_dict=True)
+            if not config_name:
                 return
             
-            # Get the configuration document
-            config_doc = frappe.get_doc("Zakaah Assets Configuration", config)
+            # Get the (cached) configuration
+            config = get_compiled_config(config_name.name, config_name.modified)
             
             # Load payment accounts (these are the liabilities accounts)
-            if config_doc.payment_accounts:
+            if config.get('payment_accounts'):
                 self.payment_accounts = []
-                for acc in config_doc.payment_accounts:
+                for acc in config['payment_accounts']:
                     self.append("payment_accounts", {
-                        "account": acc.account,
-                        "debit": acc.debit if hasattr(acc, 'debit') else 0
+                        "account": acc.get('account'),
+                        "debit": acc.get('debit') or 0
                     })
         except Exception as e:
             frappe.log_error(f"Error loading payment accounts: {str(e)}", "Load Payment Accounts Error")
     
     def _load_journal_entries(self):
-        """Load journal entries based on payment accounts"""
+        """Store aggregate totals of the journal entries on the payment accounts.
+
+        The entries themselves are not persisted on the run; the form pages
+        through them with get_journal_entries_for_calculation_run.
+        """
         try:
-            # Skip if already loaded (to avoid reloading)
-            if self.journal_entries and len(self.journal_entries) > 0:
-                return
-            
             # Get payment account names
             payment_accounts = [row.account for row in self.payment_accounts if row.account]
             
-            if not payment_accounts:
-                return
-            
-            # Query Journal Entries - include child accounts too
-            journal_entries = frappe.db.sql("""
-                SELECT DISTINCT
-                    je.name as journal_entry,
-                    je.posting_date,
-                    jea.account,
-                    SUM(jea.debit) as total_debit
-                FROM `tabJournal Entry` je
-                INNER JOIN `tabJournal Entry Account` jea ON jea.parent = je.name
-                INNER JOIN `tabAccount` acc ON acc.name = jea.account
-                WHERE je.docstatus = 1
-                    AND je.posting_date BETWEEN %(from_date)s AND %(to_date)s
-                    AND (
-                        jea.account IN %(accounts)s
-                        OR acc.parent_account LIKE %(parent_like)s
-                        OR REPLACE(acc.parent_account, ' - ', '-') LIKE %(parent_like2)s
-                    )
-                GROUP BY je.name, je.posting_date, jea.account
-                HAVING SUM(jea.debit) > 0
-                ORDER BY je.posting_date DESC
-            """, {
-                'accounts': payment_accounts,
-                'from_date': self.from_date,
-                'to_date': self.to_date,
-                'parent_like': f"%/{payment_accounts[0]}",
-                'parent_like2': f"%%{payment_accounts[0]}%%"
-            }, as_dict=True)
-            
-            # Add journal entries to child table
-            for entry in journal_entries:
-                self.append("journal_entries", {
-                    "journal_entry": entry.journal_entry,
-                    "posting_date": entry.posting_date,
-                    "account": entry.account,
-                    "total_debit": entry.total_debit or 0
-                })
+            totals = get_journal_entry_totals(payment_accounts, self.from_date, self.to_date)
+            self.journal_entries_count = totals.count
+            self.journal_entries_total_debit = totals.total_debit
                 
         except Exception as e:
             frappe.log_error(f"Error loading journal entries: {str(e)}", "Load Journal Entries Error")
     
     def before_save(self):
         """Calculate Zakaah before saving if status is Draft"""
+        if self.run_in_background or self.flags.skip_zakaah_calculation:
+            # Calculated by the background job enqueued in on_update
+            return
+        
         if self.status == "Draft" and self.company and self.to_date:
             try:
+                if not self.needs_recalculation():
+                    # Inputs unchanged since the last calculation (e.g. only a remark was edited)
+                    return
                 self.calculate_zakaah()
             except Exception as e:
                 # Don't throw error, just log it
                 frappe.log_error(f"Error calculating zakaah: {str(e)}")
     
+    def on_update(self):
+        """Enqueue the calculation when the run is calculated in the background"""
+        if (self.run_in_background and not self.flags.skip_zakaah_calculation
+                and self.status == "Draft" and self.company and self.to_date
+                and self.needs_recalculation()):
+            enqueue_calculation_job(self.name, enqueue_after_commit=True)
+    
     def on_submit(self):
         """Calculate Zakaah when submitted"""
         if self.status == "Draft":
-            self.calculate_zakaah()
+            if self.run_in_background:
+                enqueue_calculation_job(self.name, enqueue_after_commit=True)
+            else:
+                self.calculate_zakaah()
     
     def calculate_zakaah(self):
         """Main calculation method"""
-        frappe.msgprint(_("Calculating Zakaah... This may take a few moments."))
+        in_background = self.flags.in_background_calculation
+        if not in_background:
+            frappe.msgprint(_("Calculating Zakaah... This may take a few moments."))
         
         try:
             # Check if dates are set
             if not self.to_date:
                 frappe.throw(_("To Date is required. Please select a fiscal year or set the dates manually."))
             
+            self._profiler = CalculationProfiler()
+            
             # Get assets configuration for company and fiscal year
-            config = get_zakaah_assets_config(self.company, self.fiscal_year)
+            self.publish_progress("config", 10)
+            with self.profile_phase("fingerprint"):
+                fingerprint = self.get_input_fingerprint()
+            with self.profile_phase("config"):
+                config = get_zakaah_assets_config(self.company, self.fiscal_year)
             
             # Clear existing items
             self.items = []
             
             # Calculate all assets AND populate items table
+            self.publish_progress("balances", 30)
             assets = self.calculate_assets(config, self.company)
             
             # Show warning if assets are 0
-            if assets['total_in_egp'] == 0:
+            if assets['total_in_egp'] == 0 and not in_background:
                 frappe.msgprint(_("⚠️ Warning: Total assets calculated as 0. This might mean:\n- No GL Entries for the selected date range\n- Accounts have no balance\n- Wrong account names in configuration"), indicator='orange')
             
             # Get gold price
-            gold_info = self.get_gold_price_info()
+            self.publish_progress("gold_price", 70)
+            with self.profile_phase("gold_price"):
+                gold_info = self.get_gold_price_info()
             
             # Calculate Nisab and Zakaah
-            zakaah_info = self.calculate_nisab_and_zakaah(assets['total_in_egp'], gold_info['price'])
+            self.publish_progress("nisab", 85)
+            with self.profile_phase("nisab"):
+                zakaah_info = self.calculate_nisab_and_zakaah(assets['total_in_egp'], gold_info['price'])
             
             # Update fields
             self.update_asset_fields(assets)
@@ -163,6 +199,15 @@ class ZakaahCalculationRun(Document):
             # Update outstanding
             self.outstanding_zakaah = self.total_zakaah - self.paid_zakaah
             
+            # Inputs the results were calculated from (see needs_recalculation)
+            self.calculation_fingerprint = fingerprint
+            
+            # Per-phase timings of this calculation
+            self.set("profile", self._profiler.phases)
+            
+            if in_background:
+                return
+            
             frappe.msgprint(_("Zakaah calculation completed successfully!"))
             
             # Show dedication message for 10 seconds
@@ -186,9 +231,80 @@ class ZakaahCalculationRun(Document):
             frappe.msgprint(_(dedication_msg), title=_(""), indicator='green', as_list=False)
             
         except Exception as e:
-            frappe.msgprint(f"Calculation error: {str(e)}", indicator='red')
+            if not in_background:
+                frappe.msgprint(f"Calculation error: {str(e)}", indicator='red')
             raise
     
+    def needs_recalculation(self):
+        """True unless the inputs match the fingerprint of the last calculation"""
+        if self.flags.force_recalculation or not self.calculation_fingerprint:
+            return True
+        
+        try:
+            return self.get_input_fingerprint() != self.calculation_fingerprint
+        except Exception:
+            return True
+    
+    def get_input_fingerprint(self):
+        """Hash of everything calculate_zakaah reads: configuration, GL, gold price, exchange rates and run inputs"""
+        config_name, fallback = find_zakaah_assets_config(self.company, self.fiscal_year)
+        config_modified = None
+        accounts = []
+        config = get_compiled_config(config_name)
+        if config:
+            config_modified = config['modified']
+            accounts = [
+                row.get('account')
+                for config_key, asset_key, category in ASSET_CATEGORIES
+                for row in config.get(config_key, [])
+            ]
+        
+        price_date = self.gold_price_date or self.to_date
+        gold_price = resolve_gold_price(price_date)
+        
+        company_currency = frappe.get_cached_value("Company", self.company, "default_currency")
+        exchange_rates = get_exchange_rates(
+            set(get_account_currencies(accounts).values()), company_currency, self.to_date
+        )
+        
+        inputs = {
+            "company": self.company,
+            "fiscal_year": self.fiscal_year,
+            "from_date": self.from_date,
+            "to_date": self.to_date,
+            "gold_price_date": price_date,
+            "owners_count": self.owners_count,
+            "config": (config_name, config_modified),
+            "gl_watermark": get_gl_watermark(accounts, self.to_date, self.company),
+            "gold_price": gold_price,
+            "exchange_rates": exchange_rates
+        }
+        
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+    
+    def profile_phase(self, phase):
+        """Time a calculation phase when a profiler is active"""
+        profiler = getattr(self, "_profiler", None)
+        return profiler.phase(phase) if profiler else nullcontext()
+    
+    def publish_progress(self, phase, progress, status="running", message=None):
+        """Push calculation progress to the open form (background calculation only)"""
+        if not self.flags.in_background_calculation:
+            return
+        
+        frappe.publish_realtime(
+            "zakaah_calculation_progress",
+            {
+                "name": self.name,
+                "phase": phase,
+                "progress": progress,
+                "status": status,
+                "message": message
+            },
+            doctype=self.doctype,
+            docname=self.name
+        )
+    
     def calculate_assets(self, config, company=None):
         """Calculate all assets based on configuration"""
         assets = {
@@ -199,174 +315,198 @@ class ZakaahCalculationRun(Document):
             'reserves': 0
         }
         
-        # frappe.log_error(f"Dates: {self.to_date}, Company: {company}", "Zakaah Calc")  # Debug logging removed
+        # Resolve every configured account once, in a single grouped GL query
+        account_names = [
+            row.get('account')
+            for config_key, asset_key, category in ASSET_CATEGORIES
+            for row in config.get(config_key, [])
+            if isinstance(row, dict) and row.get('account')
+        ]
+        try:
+            with self.profile_phase("balances"):
+                if self.flags.precomputed_balances is not None:
+                    # Computed for many fiscal years at once (see backfill_calculation_runs)
+                    balances = self.flags.precomputed_balances
+                else:
+                    balances = self._get_incremental_balances(config, account_names, company)
+        except Exception as e:
+            frappe.log_error(f"Error getting balances: {str(e)[:100]}", "Account Balance")
+            balances = {}
+        
+        # Categories valued over the hawl use the daily balance series instead
+        with self.profile_phase("hawl"):
+            balances, revalued = self._apply_hawl_valuation(config, balances, company)
+        
+        # Balances of foreign currency ledger accounts are in account currency
+        with self.profile_phase("exchange_rates"):
+            company_currency = frappe.get_cached_value("Company", company or self.company, "default_currency")
+            currencies = get_account_currencies(account_names)
+            rates = get_exchange_rates(set(currencies.values()), company_currency, self.to_date)
+        
+        with self.profile_phase("items"):
+            self._append_asset_items(config, balances, assets, currencies, rates, company_currency, revalued)
+        
+        # Calculate total
+        assets['total_in_egp'] = (
+            assets['cash'] +
+            assets['inventory'] +
+            assets['receivables'] -
+            assets['liabilities'] +
+            assets['reserves']
+        )
 
-        # Cash accounts - Use Account Adjustment from configuration
-        for idx, row in enumerate(config.get('cash_accounts', [])):
-            # Now row should be a dict, access with .get()
-            account_name = row.get('account') if isinstance(row, dict) else None
-            # frappe.log_error(f"Cash row {idx}: account={account_name}", "Zakaah Config")  # Debug logging removed
-            if account_name:
-                balance = get_account_balance(account_name, self.to_date, company)
+        return assets
+    
+    def _append_asset_items(self, config, balances, assets, currencies=None, rates=None, company_currency=None,
+                            revalued=None):
+        """Add category totals (in company currency) and item rows for every configured account"""
+        currencies = currencies or {}
+        rates = rates or {}
+        revalued = revalued or set()
+        missing_rates = []
+        
+        for config_key, asset_key, category in ASSET_CATEGORIES:
+            for row in config.get(config_key, []):
+                account_name = row.get('account') if isinstance(row, dict) else None
+                if not account_name:
+                    continue
+                
+                # Positive values representing the asset amount (in the account's currency)
+                balance = flt(abs(balances.get(account_name) or 0))
+                currency = currencies.get(account_name) or company_currency
+                exchange_rate = flt(rates.get(currency)) if currency != company_currency else 1
                 
-                # For Cash: Use Account Adjustment (calculated_zakaah_value)
+                # Use Account Adjustment (calculated_zakaah_value) from configuration
                 # If calculated_zakaah_value is None or empty string, use balance
                 calc_value = row.get('calculated_zakaah_value')
                 zakaah_value = flt(calc_value if calc_value not in [None, ''] else balance)
+                if account_name in revalued:
+                    # The stored adjustment is based on the closing balance
+                    zakaah_value = calculate_zakaah_value(balance, row.get('margin_profit'))
+                if not exchange_rate:
+                    # Valuing the account at face value would misstate the total
+                    if zakaah_value:
+                        missing_rates.append(f"{account_name} ({currency})")
+                    continue
+                sub_total = flt(zakaah_value * exchange_rate)
                 
-                # frappe.log_error(f"Cash: {account_name} = {balance:.0f}, zakaah_value={zakaah_value:.0f}", "Zakaah Calc")  # Debug logging removed
-                assets['cash'] += zakaah_value
+                # Liabilities are accumulated here and deducted in calculate_assets
+                assets[asset_key] += sub_total
                 
                 # Add to items table
                 if balance > 0:
                     self.append("items", {
-                        "asset_category": "Cash",
+                        "asset_category": category,
                         "account": account_name,
                         "balance": balance,
-                        "currency": "EGP",
-                        "exchange_rate": 1,
-                        "sub_total": zakaah_value  # Use Account Adjustment
+                        "currency": currency,
+                        "exchange_rate": exchange_rate,
+                        "sub_total": sub_total  # Account Adjustment in company currency
                     })
-            # else:
-                # frappe.log_error(f"Err: No account in row {idx}", "Zakaah Calc")  # Debug logging removed
+        
+        if missing_rates:
+            frappe.throw(_("No exchange rate to {0} on {1} for: {2}. Add a Currency Exchange and calculate again.").format(
+                company_currency, self.to_date, ", ".join(missing_rates)), title=_("Missing Exchange Rate"))
+    
+    def _apply_hawl_valuation(self, config, balances, company):
+        """Replace closing balances of hawl-valued categories with their hawl value.
 
-        # Inventory accounts - Use Account Adjustment from configuration
-        for idx, row in enumerate(config.get('inventory_accounts', [])):
-            account_name = row.get('account') if isinstance(row, dict) else None
-            if account_name:
-                balance = get_account_balance(account_name, self.to_date, company)
-                
-                # Read Account Adjustment (calculated_zakaah_value) from configuration
-                # If calculated_zakaah_value is None or empty string, use balance
-                calc_value = row.get('calculated_zakaah_value')
-                zakaah_value = flt(calc_value if calc_value not in [None, ''] else balance)
-                
-                # frappe.log_error(f"Inv: {account_name} = {balance:.0f}, zakaah_value={zakaah_value:.0f}", "Zakaah Calc")  # Debug logging removed
-                assets['inventory'] += zakaah_value
-                
-                if balance > 0:
-                    self.append("items", {
-                        "asset_category": "Inventory",
-                        "account": account_name,
-                        "balance": balance,
-                        "currency": "EGP",
-                        "exchange_rate": 1,
-                        "sub_total": zakaah_value  # Use Account Adjustment value
-                    })
+        The signed daily balance series (one grouped GL query) is oriented by
+        the category's normal balance, so a balance that crosses zero counts
+        as nothing held. Minimum Held Balance is the lowest end-of-day balance
+        between from_date and to_date, Hawl Start Balance the opening balance
+        (as of the day before from_date).
+        Returns (balances, set of revalued accounts).
+        """
+        valuation = config.get('valuation') or {}
+        hawl_accounts = {}
+        for config_key, asset_key, category in ASSET_CATEGORIES:
+            mode = valuation.get(config_key) or "Closing Balance"
+            if mode == "Closing Balance":
+                continue
+            sign = -1 if config_key in CREDIT_BALANCE_CATEGORIES else 1
+            for row in config.get(config_key, []):
+                if isinstance(row, dict) and row.get('account'):
+                    hawl_accounts[row['account']] = (mode, sign)
         
-        # Receivables - Use Account Adjustment from configuration
-        for idx, row in enumerate(config.get('receivable_accounts', [])):
-            account_name = row.get('account') if isinstance(row, dict) else None
-            if account_name:
-                balance = get_account_balance(account_name, self.to_date, company)
-                
-                # For Receivables: Use Account Adjustment (calculated_zakaah_value)
-                # If calculated_zakaah_value is None or empty string, use balance
-                calc_value = row.get('calculated_zakaah_value')
-                zakaah_value = flt(calc_value if calc_value not in [None, ''] else balance)
-                
-                # frappe.log_error(f"Recv: {account_name} = {balance:.0f}, zakaah_value={zakaah_value:.0f}", "Zakaah Calc")  # Debug logging removed
-                assets['receivables'] += zakaah_value
-                
-                if balance > 0:
-                    self.append("items", {
-                        "asset_category": "Receivables",
-                        "account": account_name,
-                        "balance": balance,
-                        "currency": "EGP",
-                        "exchange_rate": 1,
-                        "sub_total": zakaah_value  # Use Account Adjustment
-                    })
+        if not hawl_accounts or not self.from_date or not self.to_date:
+            return balances, set()
         
-        # Liabilities (subtract from assets) - Use Account Adjustment from configuration
-        for idx, row in enumerate(config.get('liabilities_accounts', [])):
-            account_name = row.get('account') if isinstance(row, dict) else None
-            if account_name:
-                balance = get_account_balance(account_name, self.to_date, company)
-                
-                # For Liabilities: Use Account Adjustment (calculated_zakaah_value)
-                # If calculated_zakaah_value is None or empty string, use balance
-                calc_value = row.get('calculated_zakaah_value')
-                zakaah_value = flt(calc_value if calc_value not in [None, ''] else balance)
-                
-                # frappe.log_error(f"Liab: {account_name} = {balance:.0f}, zakaah_value={zakaah_value:.0f}", "Zakaah Calc")  # Debug logging removed
-                # Liabilities, add to deduct from assets
-                assets['liabilities'] += zakaah_value
-                
-                if balance > 0:
-                    self.append("items", {
-                        "asset_category": "Liabilities",
-                        "account": account_name,
-                        "balance": balance,
-                        "currency": "EGP",
-                        "exchange_rate": 1,
-                        "sub_total": zakaah_value  # Use Account Adjustment
-                    })
+        series = get_daily_balance_series(list(hawl_accounts), self.from_date, self.to_date, company,
+                                          include_opening=True)
         
-        # Reserves - Use Account Adjustment from configuration
-        for idx, row in enumerate(config.get('reserve_accounts', [])):
-            account_name = row.get('account') if isinstance(row, dict) else None
-            if account_name:
-                balance = get_account_balance(account_name, self.to_date, company)
-                
-                # For Reserves: Use Account Adjustment (calculated_zakaah_value)
-                # If calculated_zakaah_value is None or empty string, use balance
-                calc_value = row.get('calculated_zakaah_value')
-                zakaah_value = flt(calc_value if calc_value not in [None, ''] else balance)
-                
-                # frappe.log_error(f"Resv: {account_name} = {balance:.0f}, zakaah_value={zakaah_value:.0f}", "Zakaah Calc")  # Debug logging removed
-                assets['reserves'] += zakaah_value
-                
-                if balance > 0:
-                    self.append("items", {
-                        "asset_category": "Reserves",
-                        "account": account_name,
-                        "balance": balance,
-                        "currency": "EGP",
-                        "exchange_rate": 1,
-                        "sub_total": zakaah_value  # Use Account Adjustment
-                    })
+        balances = dict(balances)
+        for account, (mode, sign) in hawl_accounts.items():
+            held = series.get(account)
+            if held is None or len(held) < 2:
+                continue
+            held = sign * held
+            opening, closing = held[0], held[-1]
+            if mode == "Minimum Held Balance":
+                balances[account] = max(0, flt(held[1:].min()))
+            elif mode == "Hawl Start Balance":
+                balances[account] = max(0, flt(opening))
+            else:
+                balances[account] = max(0, flt(min(opening, closing)))
         
-        # Calculate total
-        assets['total_in_egp'] = (
-            assets['cash'] +
-            assets['inventory'] +
-            assets['receivables'] -
-            assets['liabilities'] +
-            assets['reserves']
-        )
-
-        # Log summary (Debug logging removed)
-        # frappe.log_error(f"Total: c={assets['cash']:.0f} i={assets['inventory']:.0f} tot={assets['total_in_egp']:.0f}", "Zakaah Calc")
+        return balances, set(hawl_accounts)
+    
+    def _get_incremental_balances(self, config, account_names, company):
+        """Balances of the configured accounts, re-aggregating only accounts with new GL activity.
 
-        return assets
+        calculation_basis keeps each account's last balance and GL watermark.
+        When the configuration, company and to_date are unchanged, accounts
+        without GL rows modified after their watermark reuse the stored
+        balance. A forced recalculation always refetches everything.
+        """
+        basis_key = {
+            "config": [config.get('name'), str(config.get('modified'))],
+            "company": company,
+            "to_date": str(self.to_date)
+        }
+        
+        basis = json.loads(self.calculation_basis or "{}")
+        stored = {}
+        if not self.flags.force_recalculation and all(basis.get(k) == v for k, v in basis_key.items()):
+            stored = {
+                account: values for account, values in basis.get("accounts", {}).items()
+                if account in account_names
+            }
+        
+        # Rows committed shortly before the watermark may not have been visible yet
+        watermark = str(add_to_date(now_datetime(), minutes=-WATERMARK_MARGIN_MINUTES))
+        
+        changed = get_changed_accounts(
+            {account: values["watermark"] for account, values in stored.items()},
+            self.to_date, company
+        )
+        to_fetch = [account for account in account_names if account not in stored or account in changed]
+        
+        balances = {account: values["balance"] for account, values in stored.items()}
+        if to_fetch:
+            balances.update(get_account_balances(to_fetch, self.to_date, company))
+            for account in to_fetch:
+                stored[account] = {"balance": flt(balances.get(account)), "watermark": watermark}
+        
+        self.calculation_basis = json.dumps(dict(basis_key, accounts=stored), sort_keys=True)
+        return balances
     
     def get_gold_price_info(self):
-        """Get gold price for calculation date"""
+        """Get gold price for calculation date (or the nearest earlier price within tolerance)"""
         # Use the selected gold price date, or fall back to to_date
         price_date = self.gold_price_date or self.to_date
         
-        price = frappe.db.get_value("Gold Price", 
-                                   {"price_date": price_date}, 
-                                   "price_per_gram_24k")
+        gold_price = resolve_gold_price(price_date)
+        if not gold_price:
+            frappe.throw(_("No Gold Price found on or shortly before {0}. Please enter it in the Gold Price doctype.").format(price_date))
         
-        # If not found, try to fetch it from the website
-        if not price:
-            try:
-                # Import the whitelist function to fetch price
-                from zakaah.zakaah_management.doctype.gold_price.gold_price import get_gold_price_for_date
-                price = get_gold_price_for_date(price_date)
-                
-                # If still not found, use default
-                if not price:
-                    price = 6171
-            except Exception as e:
-                frappe.log_error(f"Error fetching gold price: {str(e)}")
-                price = 6171
+        if not gold_price['exact'] and not self.flags.in_background_calculation:
+            frappe.msgprint(_("No Gold Price on {0}; using the price of {1}.").format(price_date, gold_price['price_date']), indicator='orange')
         
         return {
             'date': price_date,
-            'price': price
+            'price_date': gold_price['price_date'],
+            'price': gold_price['price']
         }
     
     def calculate_nisab_and_zakaah(self, total_assets, gold_price):
@@ -406,6 +546,7 @@ class ZakaahCalculationRun(Document):
     
     def update_gold_fields(self, gold_info, zakaah_info):
         self.gold_price_date = gold_info['date']
+        self.gold_price_used_date = gold_info['price_date']
         self.gold_price_per_gram_24k = gold_info['price']
         self.nisab_value = zakaah_info['nisab_value']
         self.assets_in_gold_grams = zakaah_info['assets_in_gold_grams']
@@ -417,94 +558,46 @@ class ZakaahCalculationRun(Document):
         self.status = zakaah_info['status']
 
 # Helper functions
+def find_zakaah_assets_config(company, fiscal_year=None):
+    """Return (name, fallback) of the assets configuration used for company and fiscal year.
+
+    fallback is None for an exact match, "company" when the fiscal year had no
+    configuration and "default" when the company had none either.
+    """
+    return find_config_name(company, fiscal_year)
+
 def get_zakaah_assets_config(company, fiscal_year=None):
     """Get assets configuration for company and fiscal year"""
     try:
-        filters = {"company": company}
-        if fiscal_year:
-            filters["fiscal_year"] = fiscal_year
-        
-        # Try to find config by company and fiscal year
-        config_list = frappe.get_all("Zakaah Assets Configuration", 
-                                     filters=filters, 
-                                     limit=1)
-        
-        if not config_list and fiscal_year:
-            # If not found with fiscal year, try without fiscal year
-            config_list = frappe.get_all("Zakaah Assets Configuration", 
-                                        filters={"company": company}, 
-                                        limit=1)
-            if config_list:
-                frappe.msgprint(_("Warning: No Zakaah Assets Configuration found for company {0} and fiscal year {1}. Using configuration without fiscal year.").format(company, fiscal_year), indicator='orange')
-        
-        if not config_list:
-            # Try to get any default config
-            config_list = frappe.get_all("Zakaah Assets Configuration", limit=1)
-            if config_list:
-                frappe.msgprint(_("Warning: No Zakaah Assets Configuration found for company {0}. Using default configuration.").format(company), indicator='orange')
-        
-        if not config_list:
-            frappe.throw(_("No Zakaah Assets Configuration found. Please create one in Zakaah Assets Configuration DocType."))
+        config_name, fallback = find_zakaah_assets_config(company, fiscal_year)
         
-        config_doc = frappe.get_doc("Zakaah Assets Configuration", config_list[0].name)
-        
-        # Get child tables as dicts for easier access
-        cash_accounts = []
-        for row in (config_doc.cash_accounts or []):
-            if isinstance(row, dict):
-                cash_accounts.append(row)
-            else:
-                # Convert child doc to dict
-                cash_accounts.append(row.as_dict())
-        
-        inventory_accounts = []
-        for row in (config_doc.inventory_accounts or []):
-            if isinstance(row, dict):
-                inventory_accounts.append(row)
-            else:
-                inventory_accounts.append(row.as_dict())
+        if fallback == "company":
+            frappe.msgprint(_("Warning: No Zakaah Assets Configuration found for company {0} and fiscal year {1}. Using configuration without fiscal year.").format(company, fiscal_year), indicator='orange')
+        elif fallback == "default":
+            frappe.msgprint(_("Warning: No Zakaah Assets Configuration found for company {0}. Using default configuration.").format(company), indicator='orange')
         
-        receivable_accounts = []
-        for row in (config_doc.receivable_accounts or []):
-            if isinstance(row, dict):
-                receivable_accounts.append(row)
-            else:
-                receivable_accounts.append(row.as_dict())
-        
-        payable_accounts = []
-        for row in (config_doc.liabilities_accounts or []):
-            if isinstance(row, dict):
-                payable_accounts.append(row)
-            else:
-                payable_accounts.append(row.as_dict())
+        if not config_name:
+            frappe.throw(_("No Zakaah Assets Configuration found. Please create one in Zakaah Assets Configuration DocType."))
         
-        reserve_accounts = []
-        for row in (config_doc.reserve_accounts or []):
-            if isinstance(row, dict):
-                reserve_accounts.append(row)
-            else:
-                reserve_accounts.append(row.as_dict())
+        # Compiled configuration, cached per request and in Redis (keyed by modified)
+        config = get_compiled_config(config_name)
         
-        # Log actual account names (Debug logging removed)
-        # cash_names = [row.get('account') for row in cash_accounts if row.get('account')]
-        # inventory_names = [row.get('account') for row in inventory_accounts if row.get('account')]
-        # frappe.log_error(f"Cash accounts configured: {cash_names}", "Zakaah Config")
-        # frappe.log_error(f"Inventory accounts configured: {inventory_names}", "Zakaah Config")
-
         # Check if any accounts are configured
-        total_accounts = (len(cash_accounts) + len(inventory_accounts) + 
-                         len(receivable_accounts) + len(payable_accounts) + 
-                         len(reserve_accounts))
+        total_accounts = sum(len(config[config_key]) for config_key, asset_key, category in ASSET_CATEGORIES)
         
         if total_accounts == 0:
             frappe.throw(_("No accounts configured in Zakaah Assets Configuration. Please add accounts in the configuration document."))
         
         return {
-            'cash_accounts': cash_accounts,
-            'inventory_accounts': inventory_accounts,
-            'receivable_accounts': receivable_accounts,
-            'liabilities_accounts': payable_accounts,
-            'reserve_accounts': reserve_accounts
+            'name': config['name'],
+            'modified': config['modified'],
+            'cash_accounts': list(config['cash_accounts']),
+            'inventory_accounts': list(config['inventory_accounts']),
+            'receivable_accounts': list(config['receivable_accounts']),
+            'liabilities_accounts': list(config['liabilities_accounts']),
+            'reserve_accounts': list(config['reserve_accounts']),
+            'payment_accounts': list(config['payment_accounts']),
+            'valuation': dict(config.get('valuation') or {})
         }
     except Exception as e:
         frappe.log_error(f"Error getting config", "Zakaah Config")
@@ -512,29 +605,551 @@ def get_zakaah_assets_config(company, fiscal_year=None):
 
 @frappe.whitelist()
 def calculate_zakaah_for_run(name):
-    """Calculate zakaah for a specific run"""
+    """Calculate zakaah for a specific run (always recalculates, ignoring the input fingerprint)"""
     doc = frappe.get_doc("Zakaah Calculation Run", name)
+    doc.flags.force_recalculation = True
     doc.calculate_zakaah()
+    
+    # Results are fresh; don't recalculate again in before_save
+    doc.flags.force_recalculation = False
     doc.save()
     return doc
 
 @frappe.whitelist()
-def get_journal_entries_for_calculation_run(calculation_run_name):
-    """Get Journal Entries that involve Zakaah payment accounts"""
+def enqueue_calculation_for_run(name):
+    """Calculate zakaah for a run in a background job and return the job id.
+
+    Progress is pushed to the form through the zakaah_calculation_progress
+    realtime event.
+    """
+    doc = frappe.get_doc("Zakaah Calculation Run", name)
+    doc.check_permission("write")
+    if doc.docstatus != 0:
+        frappe.throw(_("Submitted Zakaah Calculation Run {0} cannot be recalculated").format(name))
+    return enqueue_calculation_job(name)
+
+def enqueue_calculation_job(name, enqueue_after_commit=False):
+    """Enqueue run_calculation_job on the long queue"""
+    job = frappe.enqueue(
+        "zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run.run_calculation_job",
+        queue="long",
+        timeout=3600,
+        job_name=f"zakaah_calculation::{name}",
+        enqueue_after_commit=enqueue_after_commit,
+        name=name
+    )
+    return job.id if job else None
+
+def run_calculation_job(name):
+    """Background job: calculate a run and write the results back in one transaction"""
+    doc = frappe.get_doc("Zakaah Calculation Run", name)
+    doc.flags.in_background_calculation = True
+    
+    try:
+        doc.calculate_zakaah()
+        
+        # The run may have been submitted while the job was queued or running
+        if frappe.db.get_value("Zakaah Calculation Run", name, "docstatus") != 0:
+            frappe.throw(_("Submitted Zakaah Calculation Run {0} cannot be recalculated").format(name))
+        
+        doc.publish_progress("saving", 95)
+        write_calculation_results(doc)
+        
+        doc.notify_update()
+        doc.publish_progress("completed", 100, status="completed")
+    
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Zakaah Calculation Job")
+        doc.publish_progress("failed", 100, status="failed", message=str(e))
+        raise
+
+def write_calculation_results(doc, commit=True):
+    """Write parent fields and the items table together, then commit once"""
+    if doc.docstatus != 0:
+        frappe.throw(_("Submitted Zakaah Calculation Run {0} cannot be recalculated").format(doc.name))
+    doc.db_update()
+    doc.update_child_table("items")
+    doc.update_child_table("profile")
+    if commit:
+        frappe.db.commit()
+
+@frappe.whitelist()
+def get_calculation_profile_summary(company=None, limit=500):
+    """p50/p95 wall time, queries and rows scanned per phase over the latest runs the user may read"""
+    import numpy as np
+    
+    frappe.has_permission("Zakaah Calculation Run", "read", throw=True)
+    filters = {}
+    if company:
+        frappe.has_permission("Company", "read", doc=company, throw=True)
+        filters["company"] = company
+    
+    # get_list applies role and user permissions (e.g. per company) to the runs
+    runs = frappe.get_list("Zakaah Calculation Run", filters=filters, order_by="modified desc",
+                           limit_page_length=cint(limit) or 500, pluck="name")
+    if not runs:
+        return []
+    
+    rows = frappe.db.sql("""
+        SELECT phase, wall_time_ms, query_count, rows_scanned
+        FROM `tabZakaah Calculation Profile`
+        WHERE parenttype = 'Zakaah Calculation Run'
+            AND parent IN %(runs)s
+    """, {"runs": runs}, as_dict=True)
+    
+    by_phase = {}
+    for row in rows:
+        by_phase.setdefault(row.phase, []).append(row)
+    
+    summary = []
+    for phase, phase_rows in by_phase.items():
+        stats = {"phase": phase, "runs": len(phase_rows)}
+        for field in ("wall_time_ms", "query_count", "rows_scanned"):
+            values = np.array([flt(row[field]) for row in phase_rows])
+            stats[f"{field}_p50"] = round(float(np.percentile(values, 50)), 1)
+            stats[f"{field}_p95"] = round(float(np.percentile(values, 95)), 1)
+        summary.append(stats)
+    
+    return sorted(summary, key=lambda stats: stats["wall_time_ms_p95"], reverse=True)
+
+@frappe.whitelist()
+def bulk_calculate_zakaah(pairs, workers=4):
+    """Recalculate runs for many (company, fiscal_year) pairs on RQ workers.
+
+    Pairs are sharded by company so no two workers touch the same company.
+    Returns a batch id; use get_bulk_calculation_results to read the
+    consolidated result table.
+    """
+    frappe.only_for(["System Manager", "Zakaah Manager"])
+    
+    pairs = parse_calculation_pairs(pairs)
+    if not pairs:
+        frappe.throw(_("Please provide at least one (company, fiscal year) pair."))
+    
+    shards = shard_pairs_by_company(pairs, cint(workers) or 1)
+    batch_id = frappe.generate_hash(length=12)
+    
+    jobs = []
+    for shard, shard_pairs in enumerate(shards):
+        job = frappe.enqueue(
+            "zakaah.zakaah_management.doctype.zakaah_calculation_run.zakaah_calculation_run.run_bulk_calculation_shard",
+            queue="long",
+            timeout=7200,
+            job_name=f"zakaah_bulk_calculation::{batch_id}::{shard}",
+            batch_id=batch_id,
+            shard=shard,
+            pairs=shard_pairs
+        )
+        jobs.append(getattr(job, "id", None))
+    
+    # RQ job ids let get_bulk_calculation_results tell failed shards from running ones
+    frappe.cache().set_value(
+        f"zakaah_bulk_calculation:{batch_id}",
+        {"shards": len(shards), "runs": len(pairs), "started": now(), "jobs": jobs},
+        expires_in_sec=BULK_RESULTS_EXPIRY
+    )
+    
+    return {"batch_id": batch_id, "shards": len(shards), "runs": len(pairs)}
+
+@frappe.whitelist()
+def get_bulk_calculation_results(batch_id):
+    """Consolidated result table of a bulk calculation batch.
+
+    Shards without results are reported in failed_shards when their RQ job
+    failed, was stopped or no longer exists, and in pending_shards while it
+    is queued or running.
+    """
+    batch = frappe.cache().get_value(f"zakaah_bulk_calculation:{batch_id}")
+    if not batch:
+        frappe.throw(_("Bulk calculation {0} not found or expired.").format(batch_id))
+    
+    jobs = batch.get("jobs") or []
+    results = []
+    completed_shards = 0
+    failed_shards, pending_shards = [], []
+    for shard in range(batch["shards"]):
+        shard_results = frappe.cache().get_value(f"zakaah_bulk_calculation:{batch_id}:{shard}")
+        if shard_results is not None:
+            completed_shards += 1
+            results.extend(shard_results)
+            continue
+        
+        status = get_job_status(jobs[shard] if shard < len(jobs) else None)
+        if status in ("failed", "stopped", "canceled", "missing", "finished"):
+            # A finished job without results lost them (cache expired or flushed)
+            failed_shards.append({"shard": shard, "status": status})
+        else:
+            pending_shards.append({"shard": shard, "status": status})
+    
+    results.sort(key=lambda row: (row["company"], row["fiscal_year"]))
+    
+    return {
+        "batch_id": batch_id,
+        "runs": batch["runs"],
+        "started": batch["started"],
+        "completed": completed_shards == batch["shards"],
+        "failed_shards": failed_shards,
+        "pending_shards": pending_shards,
+        "results": results
+    }
+
+def get_job_status(job_id):
+    """RQ status of a background job ("missing" once RQ no longer knows it, "unknown" without an id)"""
+    if not job_id:
+        return "unknown"
+    
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+    from frappe.utils.background_jobs import get_redis_conn
+    
+    try:
+        status = Job.fetch(job_id, connection=get_redis_conn()).get_status()
+    except NoSuchJobError:
+        return "missing"
+    
+    return str(getattr(status, "value", status) or "missing")
+
+def run_bulk_calculation_shard(batch_id, shard, pairs):
+    """Background job: calculate one shard of a bulk batch, committing per run"""
+    results = [calculate_run_for_fiscal_year(company, fiscal_year) for company, fiscal_year in pairs]
+    
+    frappe.cache().set_value(
+        f"zakaah_bulk_calculation:{batch_id}:{shard}",
+        results,
+        expires_in_sec=BULK_RESULTS_EXPIRY
+    )
+    return results
+
+def calculate_run_for_fiscal_year(company, fiscal_year):
+    """Create or recalculate the run of a company and fiscal year; return a result row"""
+    start = time.monotonic()
+    result = {"company": company, "fiscal_year": fiscal_year, "run": None}
+    
+    try:
+        run = frappe.db.get_value("Zakaah Calculation Run",
+                                  {"company": company, "fiscal_year": fiscal_year, "docstatus": ["<", 2]},
+                                  ["name", "docstatus"], as_dict=True)
+        if run and run.docstatus == 1:
+            # Submitted runs carry payments (paid/outstanding/status): never recalculate them
+            result.update({
+                "run": run.name,
+                "status": "Skipped",
+                "error": _("Submitted run is not recalculated")
+            })
+            result["seconds"] = round(time.monotonic() - start, 3)
+            return result
+        
+        if run:
+            doc = frappe.get_doc("Zakaah Calculation Run", run.name)
+        else:
+            doc = frappe.new_doc("Zakaah Calculation Run")
+            doc.company = company
+            doc.fiscal_year = fiscal_year
+            doc.flags.skip_zakaah_calculation = True
+            doc.insert()
+        
+        doc.flags.in_background_calculation = True
+        doc.calculate_zakaah()
+        write_calculation_results(doc)
+        
+        result.update({
+            "run": doc.name,
+            "status": doc.status,
+            "total_assets": doc.total_assets,
+            "total_zakaah": doc.total_zakaah,
+            "error": None
+        })
+    
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Zakaah Bulk Calculation")
+        result.update({"status": "Failed", "error": str(e)})
+    
+    result["seconds"] = round(time.monotonic() - start, 3)
+    return result
+
+@frappe.whitelist()
+def backfill_calculation_runs(company, from_fiscal_year, to_fiscal_year):
+    """Create or update the runs of a company for every fiscal year in a range.
+
+    The balances at all fiscal year ends come from one GL sweep per assets
+    configuration (get_balances_at_dates) instead of one balance query per
+    account and year. Runs are written with one commit per BACKFILL_COMMIT_SIZE.
+    Returns a result row per fiscal year, like calculate_run_for_fiscal_year.
+    """
+    frappe.only_for(["System Manager", "Zakaah Manager"])
+    
+    fiscal_years = get_fiscal_years_in_range(company, from_fiscal_year, to_fiscal_year)
+    if not fiscal_years:
+        frappe.throw(_("No fiscal years found between {0} and {1} for {2}.").format(
+            from_fiscal_year, to_fiscal_year, company))
+    
+    # Years sharing a configuration share one sweep over its accounts
+    years_by_config = {}
+    for fiscal_year in fiscal_years:
+        config_name, fallback = find_zakaah_assets_config(company, fiscal_year.name)
+        if config_name:
+            years_by_config.setdefault(config_name, []).append(fiscal_year)
+    
+    balances_by_year = {}
+    for config_name, config_years in years_by_config.items():
+        config = get_compiled_config(config_name)
+        account_names = [
+            row.get('account')
+            for config_key, asset_key, category in ASSET_CATEGORIES
+            for row in config.get(config_key, [])
+            if row.get('account')
+        ]
+        year_end_balances = get_balances_at_dates(
+            account_names,
+            [fiscal_year.year_end_date for fiscal_year in config_years],
+            company,
+            {fiscal_year.year_end_date: fiscal_year.year_start_date for fiscal_year in config_years}
+        )
+        for fiscal_year in config_years:
+            balances_by_year[fiscal_year.name] = year_end_balances.get(getdate(fiscal_year.year_end_date), {})
+    
+    existing_runs = {
+        row.fiscal_year: row
+        for row in frappe.get_all("Zakaah Calculation Run",
+                                  filters={
+                                      "company": company,
+                                      "fiscal_year": ["in", [fy.name for fy in fiscal_years]],
+                                      "docstatus": ["<", 2]
+                                  },
+                                  fields=["fiscal_year", "name", "docstatus"],
+                                  order_by="creation asc")
+    }
+    
+    results = []
+    for idx, fiscal_year in enumerate(fiscal_years, 1):
+        start = time.monotonic()
+        result = {"company": company, "fiscal_year": fiscal_year.name, "run": None}
+        
+        existing_run = existing_runs.get(fiscal_year.name)
+        if existing_run and existing_run.docstatus == 1:
+            # Submitted runs carry payments (paid/outstanding/status): never recalculate them
+            result.update({
+                "run": existing_run.name,
+                "status": "Skipped",
+                "error": _("Submitted run is not recalculated")
+            })
+            result["seconds"] = round(time.monotonic() - start, 3)
+            results.append(result)
+            continue
+        
+        # A failed year must not roll back the uncommitted years before it
+        frappe.db.savepoint("zakaah_backfill")
+        try:
+            if existing_run:
+                doc = frappe.get_doc("Zakaah Calculation Run", existing_run.name)
+            else:
+                doc = frappe.new_doc("Zakaah Calculation Run")
+                doc.company = company
+                doc.fiscal_year = fiscal_year.name
+                doc.from_date = fiscal_year.year_start_date
+                doc.to_date = fiscal_year.year_end_date
+                doc.flags.skip_zakaah_calculation = True
+                doc.insert()
+            
+            # Runs with custom dates are calculated normally
+            if fiscal_year.name in balances_by_year and getdate(doc.to_date) == getdate(fiscal_year.year_end_date):
+                doc.flags.precomputed_balances = balances_by_year[fiscal_year.name]
+            
+            doc.flags.in_background_calculation = True
+            doc.calculate_zakaah()
+            write_calculation_results(doc, commit=False)
+            
+            result.update({
+                "run": doc.name,
+                "status": doc.status,
+                "total_assets": doc.total_assets,
+                "total_zakaah": doc.total_zakaah,
+                "error": None
+            })
+        
+        except Exception as e:
+            frappe.db.rollback(save_point="zakaah_backfill")
+            frappe.log_error(frappe.get_traceback(), "Zakaah Backfill")
+            result.update({"status": "Failed", "error": str(e)})
+        
+        result["seconds"] = round(time.monotonic() - start, 3)
+        results.append(result)
+        
+        if idx % BACKFILL_COMMIT_SIZE == 0:
+            frappe.db.commit()
+    
+    frappe.db.commit()
+    return results
+
+def get_fiscal_years_in_range(company, from_fiscal_year, to_fiscal_year):
+    """Fiscal years of company (or shared ones) from from_fiscal_year to to_fiscal_year, oldest first"""
+    from_dates = get_fiscal_year_dates(from_fiscal_year)
+    to_dates = get_fiscal_year_dates(to_fiscal_year)
+    if not from_dates or not to_dates:
+        frappe.throw(_("Fiscal Year {0} not found.").format(to_fiscal_year if from_dates else from_fiscal_year))
+    
+    from_start = from_dates.year_start_date
+    to_start = to_dates.year_start_date
+    
+    return frappe.db.sql("""
+        SELECT fy.name, fy.year_start_date, fy.year_end_date
+        FROM `tabFiscal Year` fy
+        WHERE fy.year_start_date BETWEEN %(from_start)s AND %(to_start)s
+            AND IFNULL(fy.disabled, 0) = 0
+            AND (
+                NOT EXISTS (SELECT 1 FROM `tabFiscal Year Company` fyc WHERE fyc.parent = fy.name)
+                OR EXISTS (SELECT 1 FROM `tabFiscal Year Company` fyc
+                    WHERE fyc.parent = fy.name AND fyc.company = %(company)s)
+            )
+        ORDER BY fy.year_start_date
+    """, {
+        'from_start': from_start,
+        'to_start': to_start,
+        'company': company
+    }, as_dict=True)
+
+def parse_calculation_pairs(pairs):
+    """Normalize pairs given as JSON, [company, fiscal_year] lists or dicts"""
+    if isinstance(pairs, str):
+        pairs = json.loads(pairs)
+    
+    normalized = []
+    for pair in pairs or []:
+        if isinstance(pair, dict):
+            company, fiscal_year = pair.get("company"), pair.get("fiscal_year")
+        else:
+            company, fiscal_year = pair
+        if company and fiscal_year and (company, fiscal_year) not in normalized:
+            normalized.append((company, fiscal_year))
+    
+    return normalized
+
+def shard_pairs_by_company(pairs, workers):
+    """Split pairs into at most `workers` shards; all runs of a company stay in one shard"""
+    by_company = {}
+    for company, fiscal_year in pairs:
+        by_company.setdefault(company, []).append((company, fiscal_year))
+    
+    shards = [[] for _i in range(min(workers, len(by_company)))]
+    
+    # Largest companies first, each to the least loaded shard
+    for company_pairs in sorted(by_company.values(), key=len, reverse=True):
+        min(shards, key=len).extend(sorted(company_pairs))
+    
+    return shards
+
+# Rows per page of the journal entries panel (default and upper limit)
+JOURNAL_ENTRY_PAGE_LENGTH = 20
+MAX_JOURNAL_ENTRY_PAGE_LENGTH = 100
+
+# Sortable columns of the journal entries panel
+JOURNAL_ENTRY_SORT_FIELDS = {
+    "posting_date": "je.posting_date",
+    "journal_entry": "je.name",
+    "account": "jea.account",
+    "debit": "debit",
+    "credit": "credit"
+}
+
+def _journal_entry_conditions(accounts, from_date, to_date, account=None, search=None):
+    """WHERE clause and values for journal entries on accounts or any of their descendants"""
+    subtree = get_subtree_accounts(accounts)
+    if account:
+        subtree = [acc for acc in subtree if acc == account]
+    
+    conditions = """
+            jea.account IN %(accounts)s
+            AND je.docstatus = 1
+            AND je.posting_date BETWEEN %(from_date)s AND %(to_date)s"""
+    values = {
+        'accounts': subtree,
+        'from_date': from_date,
+        'to_date': to_date
+    }
+    if search:
+        conditions += """
+            AND (je.name LIKE %(search)s OR je.user_remark LIKE %(search)s)"""
+        values['search'] = f"%{search}%"
+    
+    return subtree, conditions, values
+
+def get_journal_entry_totals(accounts, from_date, to_date):
+    """Number of journal entries and total debit on accounts (and descendants) in the period"""
+    subtree, conditions, values = _journal_entry_conditions(accounts, from_date, to_date)
+    if not subtree:
+        return frappe._dict(count=0, total_debit=0)
+    
+    # Only (journal entry, account) rows with a debit, like the rows the form lists
+    return frappe.db.sql("""
+        SELECT
+            COUNT(DISTINCT journal_entry) as count,
+            COALESCE(SUM(debit), 0) as total_debit
+        FROM (
+            SELECT jea.parent as journal_entry, SUM(jea.debit) as debit
+            FROM `tabJournal Entry Account` jea
+            INNER JOIN `tabJournal Entry` je ON je.name = jea.parent
+            WHERE {conditions}
+            GROUP BY jea.parent, jea.account
+            HAVING SUM(jea.debit) > 0
+        ) grouped
+    """.format(conditions=conditions), values, as_dict=True)[0]
+
+@frappe.whitelist()
+def get_journal_entries_for_calculation_run(calculation_run_name, start=0, page_length=JOURNAL_ENTRY_PAGE_LENGTH,
+                                            sort_by="posting_date", sort_order="desc",
+                                            account=None, search=None, cursor=None):
+    """Get one page of Journal Entries that involve the run's Zakaah payment accounts.
+
+    Rows are grouped per (journal entry, account) and include entries on
+    descendants of group payment accounts. Sorting and filtering happen in SQL.
+    The default posting_date sort pages with a keyset cursor on
+    (posting_date, journal_entry, account): pass the returned next_cursor
+    back for the following page. Other sorts page with start. total_count is
+    only counted for the first page.
+    """
+    page_length = min(cint(page_length) or JOURNAL_ENTRY_PAGE_LENGTH, MAX_JOURNAL_ENTRY_PAGE_LENGTH)
+    empty = {"entries": [], "total_count": 0, "start": cint(start), "page_length": page_length, "next_cursor": None}
     try:
         # Get the calculation run document
         calc_run = frappe.get_doc("Zakaah Calculation Run", calculation_run_name)
-        
-        if not calc_run.payment_accounts or len(calc_run.payment_accounts) == 0:
-            return []
+        calc_run.check_permission("read")
         
         # Get payment account names
         payment_accounts = [row.account for row in calc_run.payment_accounts if row.account]
         
         if not payment_accounts:
-            return []
+            return empty
+        
+        subtree, conditions, values = _journal_entry_conditions(
+            payment_accounts, calc_run.from_date, calc_run.to_date, account, search
+        )
+        if not subtree:
+            return empty
+        
+        sort_field = JOURNAL_ENTRY_SORT_FIELDS.get(sort_by, "je.posting_date")
+        sort_order = "ASC" if str(sort_order).lower() == "asc" else "DESC"
+        
+        if isinstance(cursor, str):
+            cursor = json.loads(cursor) if cursor else None
+        keyset = sort_field == "je.posting_date"
+        page_conditions = conditions
+        if keyset and cursor:
+            # Resume after the last row of the previous page, whatever its depth
+            page_conditions += """
+            AND (
+                je.posting_date {op} %(cursor_date)s
+                OR (je.posting_date = %(cursor_date)s AND jea.parent {op} %(cursor_name)s)
+                OR (je.posting_date = %(cursor_date)s AND jea.parent = %(cursor_name)s AND jea.account {op} %(cursor_account)s)
+            )""".format(op=">" if sort_order == "ASC" else "<")
+            values = dict(values,
+                cursor_date=cursor.get("posting_date"),
+                cursor_name=cursor.get("journal_entry"),
+                cursor_account=cursor.get("account")
+            )
         
-        # Query Journal Entries that have these accounts
+        # One extra row tells whether there is a next page
         journal_entries = frappe.db.sql("""
             SELECT
                 jea.parent as journal_entry,
@@ -545,22 +1160,53 @@ def get_journal_entries_for_calculation_run(calculation_run_name):
                 je.user_remark as remarks
             FROM `tabJournal Entry Account` jea
             INNER JOIN `tabJournal Entry` je ON jea.parent = je.name
-            WHERE je.docstatus = 1
-                AND jea.account IN %(accounts)s
-                AND je.posting_date BETWEEN %(from_date)s AND %(to_date)s
+            WHERE {conditions}
             GROUP BY jea.parent, je.posting_date, jea.account, je.user_remark
-            ORDER BY je.posting_date DESC
-        """, {
-            'accounts': payment_accounts,
-            'from_date': calc_run.from_date,
-            'to_date': calc_run.to_date
-        }, as_dict=True)
+            HAVING SUM(jea.debit) > 0
+            ORDER BY {sort_field} {sort_order}, jea.parent {sort_order}, jea.account {sort_order}
+            LIMIT {offset}%(page_length)s
+        """.format(
+            conditions=page_conditions,
+            sort_field=sort_field,
+            sort_order=sort_order,
+            offset="" if keyset else "%(start)s, "
+        ), dict(
+            values,
+            start=cint(start),
+            page_length=page_length + 1
+        ), as_dict=True)
         
-        return journal_entries
+        next_cursor = None
+        if len(journal_entries) > page_length:
+            journal_entries = journal_entries[:page_length]
+            if keyset:
+                last = journal_entries[-1]
+                next_cursor = {
+                    "posting_date": str(last.posting_date),
+                    "journal_entry": last.journal_entry,
+                    "account": last.account
+                }
         
+        total_count = None
+        if not cursor:
+            total_count = frappe.db.sql("""
+                SELECT COUNT(*) FROM (
+                    SELECT 1
+                    FROM `tabJournal Entry Account` jea
+                    INNER JOIN `tabJournal Entry` je ON jea.parent = je.name
+                    WHERE {conditions}
+                    GROUP BY jea.parent, jea.account
+                    HAVING SUM(jea.debit) > 0
+                ) grouped
+            """.format(conditions=conditions), values)[0][0]
+        
+        return dict(empty, entries=journal_entries, total_count=total_count, next_cursor=next_cursor)
+        
+    except frappe.PermissionError:
+        raise
     except Exception as e:
         frappe.log_error(f"Error getting journal entries: {str(e)}", "Journal Entries Error")
-        return []
+        return empty
 
 @frappe.whitelist()
 def debug_all_config_accounts(company, fiscal_year, to_date):
@@ -578,17 +1224,25 @@ def debug_all_config_accounts(company, fiscal_year, to_date):
         
         # Try to get dates from fiscal year
         if fiscal_year:
-            fy_doc = frappe.get_doc("Fiscal Year", fiscal_year)
+            fy_doc = get_fiscal_year_dates(fiscal_year)
             results['dates'] = {
                 'from': str(fy_doc.year_start_date),
                 'to': str(fy_doc.year_end_date)
             }
         
+        account_names = [
+            row.get('account')
+            for key in ('cash_accounts', 'inventory_accounts')
+            for row in config.get(key, [])
+            if isinstance(row, dict) and row.get('account')
+        ]
+        balances = get_account_balances(account_names, to_date, company)
+        
         # Check ALL cash accounts
         for row in config.get('cash_accounts', []):
             account_name = row.get('account') if isinstance(row, dict) else None
             if account_name:
-                balance = get_account_balance(account_name, to_date, company)
+                balance = flt(abs(balances.get(account_name) or 0))
                 results['cash_accounts'].append({
                     'account': account_name,
                     'balance': balance
@@ -599,7 +1253,7 @@ def debug_all_config_accounts(company, fiscal_year, to_date):
         for row in config.get('inventory_accounts', []):
             account_name = row.get('account') if isinstance(row, dict) else None
             if account_name:
-                balance = get_account_balance(account_name, to_date, company)
+                balance = flt(abs(balances.get(account_name) or 0))
                 results['inventory_accounts'].append({
                     'account': account_name,
                     'balance': balance
@@ -611,32 +1265,18 @@ def debug_all_config_accounts(company, fiscal_year, to_date):
         return {"error": str(e)}
 
 def get_account_balance(account, date, company=None):
-    """Get account balance as of date using ERPNext's get_balance_on.
+    """Get account balance as of date.
 
-    This function works for both group accounts and single accounts.
-    ERPNext's get_balance_on automatically handles group accounts correctly.
+    Works for both group accounts and single accounts, returning the same
+    numbers as ERPNext's get_balance_on (see balance_engine).
     """
     try:
-        from frappe.utils import flt
-        from erpnext.accounts.utils import get_balance_on
-
-        # Use ERPNext's built-in function (same as Trial Balance)
-        # This automatically handles group accounts by summing all children
-        # It respects fiscal year, company, and all ERPNext rules
-        balance = get_balance_on(
-            account=account,
-            date=date,
-            company=company
-        )
+        balance = get_account_balances([account], date, company).get(account)
 
         # For Zakaah calculation, we need positive values representing the asset amount
         # Return absolute value for summation
-        balance_value = abs(balance or 0)
-
-        return flt(balance_value)
+        return flt(abs(balance or 0))
 
     except Exception as e:
         frappe.log_error(f"Error getting balance for {account}: {str(e)[:100]}", "Account Balance")
         return 0
-
-
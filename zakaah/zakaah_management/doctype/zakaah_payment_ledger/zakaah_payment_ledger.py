@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from frappe.model.document import Document
+import frappe
+from frappe.utils import now
+from zakaah.zakaah_management.config_cache import get_company_configs
+
+
+class ZakaahPaymentLedger(Document):
+    pass
+
+
+def on_doctype_update():
+    # One row per journal entry and payment account it touches
+    frappe.db.add_unique("Zakaah Payment Ledger", ["journal_entry", "payment_account"],
+        constraint_name="unique_journal_entry_payment_account")
+    # import_journal_entries reads unallocated entries per company; pages follow (posting_date, journal_entry)
+    frappe.db.add_index("Zakaah Payment Ledger", ["company", "unallocated_amount"])
+    frappe.db.add_index("Zakaah Payment Ledger", ["company", "posting_date", "journal_entry"])
+
+
+def get_company_payment_accounts(company):
+    """Payment accounts of every Zakaah Assets Configuration of the company"""
+    return list(dict.fromkeys(
+        row.get("account")
+        for config in get_company_configs(company)
+        for row in config.get("payment_accounts", [])
+        if row.get("account")
+    ))
+
+
+def update_ledger_on_je_submit(doc, method=None):
+    """Journal Entry on_submit: add the entry if it touches a payment account of its company"""
+    accounts = get_company_payment_accounts(doc.company)
+    if not accounts or not any(row.account in accounts for row in (doc.get("accounts") or [])):
+        return
+
+    build_payment_ledger(doc.company, accounts, [doc.name])
+
+
+def update_ledger_on_je_cancel(doc, method=None):
+    """Journal Entry on_cancel: a cancelled entry can no longer be allocated"""
+    frappe.db.sql("""
+        DELETE FROM `tabZakaah Payment Ledger`
+        WHERE journal_entry = %s
+    """, doc.name)
+
+
+def build_payment_ledger(company, accounts=None, journal_entries=None):
+    """Insert or refresh ledger rows from GL Entry and Zakaah Allocation History in one statement.
+
+    Each row holds one journal entry's debit and credit on one payment
+    account. allocated_amount and unallocated_amount are per journal entry
+    (over all its payment accounts) and repeated on each of its rows.
+    Without journal_entries every submitted journal entry of the company that
+    touches one of its payment accounts is (re)written.
+    """
+    if accounts is None:
+        accounts = get_company_payment_accounts(company)
+    if not accounts:
+        return
+
+    conditions = ""
+    allocation_conditions = ""
+    if journal_entries:
+        conditions = "AND gle.voucher_no IN %(journal_entries)s"
+        allocation_conditions = "AND journal_entry IN %(journal_entries)s"
+
+    frappe.db.sql("""
+        INSERT INTO `tabZakaah Payment Ledger`
+            (name, company, journal_entry, payment_account, posting_date, remarks,
+            debit, credit, allocated_amount, unallocated_amount,
+            creation, modified, owner, modified_by, docstatus)
+        SELECT
+            SUBSTRING(MD5(CONCAT(je.name, '::', gle.account)), 1, 10), je.company, je.name, gle.account,
+            je.posting_date, je.user_remark,
+            SUM(gle.debit), SUM(gle.credit),
+            COALESCE(alloc.total_allocated, 0),
+            SUM(SUM(gle.debit)) OVER (PARTITION BY je.name) - COALESCE(alloc.total_allocated, 0),
+            %(timestamp)s, %(timestamp)s, %(user)s, %(user)s, 0
+        FROM `tabGL Entry` gle
+        INNER JOIN `tabJournal Entry` je ON je.name = gle.voucher_no
+        LEFT JOIN (
+            SELECT journal_entry, SUM(allocated_amount) as total_allocated
+            FROM `tabZakaah Allocation History`
+            WHERE docstatus != 2
+            {allocation_conditions}
+            GROUP BY journal_entry
+        ) alloc ON alloc.journal_entry = je.name
+        WHERE gle.company = %(company)s
+            AND gle.voucher_type = 'Journal Entry'
+            AND gle.account IN %(accounts)s
+            AND gle.is_cancelled = 0
+            AND je.docstatus = 1
+            {conditions}
+        GROUP BY je.name, gle.account, je.company, je.posting_date, je.user_remark, alloc.total_allocated
+        ON DUPLICATE KEY UPDATE
+            posting_date = VALUES(posting_date),
+            remarks = VALUES(remarks),
+            debit = VALUES(debit),
+            credit = VALUES(credit),
+            allocated_amount = VALUES(allocated_amount),
+            unallocated_amount = VALUES(unallocated_amount),
+            modified = VALUES(modified)
+    """.format(conditions=conditions, allocation_conditions=allocation_conditions), {
+        'company': company,
+        'accounts': accounts,
+        'journal_entries': journal_entries,
+        'timestamp': now(),
+        'user': frappe.session.user
+    })
+
+
+def update_ledger_allocations(journal_entries):
+    """Recompute allocated and unallocated amounts of journal entries from Zakaah Allocation History"""
+    journal_entries = list(dict.fromkeys(je for je in (journal_entries or []) if je))
+    if not journal_entries:
+        return
+
+    frappe.db.sql("""
+        UPDATE `tabZakaah Payment Ledger` ledger
+        INNER JOIN (
+            SELECT journal_entry, SUM(debit) as total_debit
+            FROM `tabZakaah Payment Ledger`
+            WHERE journal_entry IN %(journal_entries)s
+            GROUP BY journal_entry
+        ) je_debit ON je_debit.journal_entry = ledger.journal_entry
+        LEFT JOIN (
+            SELECT journal_entry, SUM(allocated_amount) as total_allocated
+            FROM `tabZakaah Allocation History`
+            WHERE journal_entry IN %(journal_entries)s
+            AND docstatus != 2
+            GROUP BY journal_entry
+        ) alloc ON alloc.journal_entry = ledger.journal_entry
+        SET
+            ledger.allocated_amount = COALESCE(alloc.total_allocated, 0),
+            ledger.unallocated_amount = je_debit.total_debit - COALESCE(alloc.total_allocated, 0)
+        WHERE ledger.journal_entry IN %(journal_entries)s
+    """, {"journal_entries": journal_entries})
+
+
+def rebuild_company_payment_ledger(company):
+    """Drop and rebuild the ledger of a company (payment accounts changed, or backfill)"""
+    frappe.db.sql("""
+        DELETE FROM `tabZakaah Payment Ledger`
+        WHERE company = %s
+    """, company)
+    build_payment_ledger(company)
+
+
+@frappe.whitelist()
+def rebuild_payment_ledger(company):
+    """Rebuild the Zakaah Payment Ledger of a company from GL Entry and Zakaah Allocation History"""
+    frappe.only_for("System Manager")
+
+    rebuild_company_payment_ledger(company)
+    frappe.db.commit()
+
+    return {"company": company, "journal_entries": frappe.db.count("Zakaah Payment Ledger", {"company": company})}
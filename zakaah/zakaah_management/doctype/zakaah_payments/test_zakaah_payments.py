@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import nowdate
+
+from zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments import (
+	ALLOCATION_QUERY_BUDGET,
+	QUERY_BUDGETS,
+	allocate_payments,
+	get_calculation_runs,
+	get_payment_accounts_from_settings,
+	import_journal_entries,
+	import_journal_entries_page,
+	plan_allocations,
+	update_stale_calculation_run_totals,
+)
+from zakaah.zakaah_management.config_cache import clear_config_cache
+from zakaah.zakaah_management.profiler import QueryCounter, assert_query_budget
+
+TEST_COMPANY = "_Test Company"
+PAYMENT_ACCOUNT = "_Test Bank - _TC"
+CONTRA_ACCOUNT = "_Test Cash - _TC"
+
+
+class TestZakaahPaymentsQueryBudget(FrappeTestCase):
+	"""The query count of each endpoint must stay within its budget and not grow with input size"""
+
+	def setUp(self):
+		from erpnext.accounts.utils import get_fiscal_year
+
+		self.fiscal_year = get_fiscal_year(nowdate(), company=TEST_COMPANY)[0]
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_get_calculation_runs(self):
+		self.make_runs(1)
+		small = self.count_queries("get_calculation_runs", get_calculation_runs, TEST_COMPANY)
+
+		self.make_runs(10)
+		large = self.count_queries("get_calculation_runs", get_calculation_runs, TEST_COMPANY)
+
+		self.assertEqual(small, large)
+
+	def test_get_calculation_runs_is_read_only(self):
+		# Stale stored amounts are corrected in the result, but only the maintenance path writes them
+		run = self.make_runs(1)[0]
+		frappe.db.set_value("Zakaah Calculation Run", run, "outstanding_zakaah", 5)
+
+		with QueryCounter() as counter:
+			runs = get_calculation_runs(TEST_COMPANY, show_unreconciled_only=False)
+
+		self.assertFalse([query for query in counter.queries if query.lstrip().upper().startswith("UPDATE")])
+		self.assertEqual([row.outstanding_zakaah for row in runs if row.name == run], [1000])
+		self.assertEqual(frappe.db.get_value("Zakaah Calculation Run", run, "outstanding_zakaah"), 5)
+
+		update_stale_calculation_run_totals(TEST_COMPANY)
+		self.assertEqual(frappe.db.get_value("Zakaah Calculation Run", run, "outstanding_zakaah"), 1000)
+
+	def test_get_payment_accounts_from_settings(self):
+		self.make_configurations(1)
+		small = self.count_queries("get_payment_accounts_from_settings",
+			get_payment_accounts_from_settings, TEST_COMPANY)
+
+		self.make_configurations(5)
+		large = self.count_queries("get_payment_accounts_from_settings",
+			get_payment_accounts_from_settings, TEST_COMPANY)
+
+		self.assertEqual(small, large)
+
+	def test_import_journal_entries(self):
+		# Entries are read from the Zakaah Payment Ledger: more entries must not cost more queries
+		self.make_configurations(1)
+		args = (TEST_COMPANY, "2000-01-01", nowdate(), [PAYMENT_ACCOUNT])
+
+		self.make_journal_entry(1000)
+		small = self.count_queries("import_journal_entries", import_journal_entries, *args)
+
+		journal_entries = [self.make_journal_entry(1000) for _ in range(5)]
+		large = self.count_queries("import_journal_entries", import_journal_entries, *args)
+
+		self.assertEqual(small, large)
+		imported = [row["journal_entry"] for row in import_journal_entries(*args)["journal_entry_records"]]
+		self.assertTrue(set(journal_entries) <= set(imported))
+
+	def test_import_journal_entries_page(self):
+		# Keyset pages return every unallocated entry exactly once, in import order
+		self.make_configurations(1)
+		args = (TEST_COMPANY, "2000-01-01", nowdate(), [PAYMENT_ACCOUNT])
+		for _ in range(5):
+			self.make_journal_entry(1000)
+
+		expected = [row["journal_entry"] for row in import_journal_entries(*args)["journal_entry_records"]]
+
+		pages, cursor = [], None
+		while True:
+			with assert_query_budget(QUERY_BUDGETS["import_journal_entries_page"], "import_journal_entries_page"):
+				page = import_journal_entries_page(*args, cursor=cursor, page_size=2)
+			if cursor is None:
+				self.assertEqual(page["total_count"], len(expected))
+			pages.extend(row["journal_entry"] for row in page["journal_entry_records"])
+			cursor = page["next_cursor"]
+			if not cursor:
+				break
+
+		self.assertEqual(pages, expected)
+
+	def test_allocate_payments(self):
+		# Journal entries spread over many runs are written in one chunk: the count must not grow
+		counts = []
+		for count in (1, 10):
+			runs = self.make_runs(count, total_zakaah=500)
+			journal_entries = [self.make_journal_entry(1000) for _ in range(count)]
+
+			with QueryCounter() as counter:
+				result = allocate_payments(
+					[{"zakaah_calculation_run": run} for run in runs],
+					[{"journal_entry": je, "debit": 1000, "unallocated_amount": 1000} for je in journal_entries]
+				)
+
+			self.assertTrue(result["success"])
+			self.assertEqual(len(result["allocated_records"]), count)
+			self.assertLessEqual(counter.count, QUERY_BUDGETS["allocate_payments"] + ALLOCATION_QUERY_BUDGET)
+			counts.append(counter.count)
+
+			for run in runs:
+				self.assertEqual(frappe.db.get_value("Zakaah Calculation Run", run, "status"), "Paid")
+
+		self.assertEqual(counts[0], counts[1])
+
+	def test_allocate_payments_idempotency_key(self):
+		# A retry with the same key returns the first attempt's allocations and writes nothing
+		runs = self.make_runs(2, total_zakaah=1000)
+		journal_entry = self.make_journal_entry(1500)
+		args = (
+			[{"zakaah_calculation_run": run} for run in runs],
+			[{"journal_entry": journal_entry, "debit": 1500, "unallocated_amount": 1500}]
+		)
+
+		first = allocate_payments(*args, idempotency_key="test-retry")
+		retry = allocate_payments(*args, idempotency_key="test-retry")
+
+		self.assertTrue(retry["success"])
+		self.assertEqual(
+			[(r["zakaah_calculation_run"], r["allocated_amount"]) for r in retry["allocated_records"]],
+			[(r["zakaah_calculation_run"], r["allocated_amount"]) for r in first["allocated_records"]]
+		)
+		self.assertEqual(frappe.db.count("Zakaah Allocation History", {"journal_entry": journal_entry}), 2)
+
+	def count_queries(self, endpoint, fn, *args):
+		"""Return (cold, warm) query counts: with the configuration cache cleared, then filled"""
+		# Warm up (first call fills the metadata caches)
+		fn(*args)
+
+		clear_config_cache()
+		with QueryCounter() as cold:
+			fn(*args)
+
+		with assert_query_budget(QUERY_BUDGETS[endpoint], endpoint) as warm:
+			fn(*args)
+		return cold.count, warm.count
+
+	def make_runs(self, count, total_zakaah=1000):
+		runs = []
+		for _ in range(count):
+			run = frappe.get_doc({
+				"doctype": "Zakaah Calculation Run",
+				"company": TEST_COMPANY,
+				"fiscal_year": self.fiscal_year,
+				"total_zakaah": total_zakaah,
+				"outstanding_zakaah": total_zakaah,
+				"status": "Calculated"
+			})
+			run.flags.skip_zakaah_calculation = True
+			run.insert(ignore_permissions=True)
+			runs.append(run.name)
+		return runs
+
+	def make_configurations(self, count):
+		for _ in range(count):
+			frappe.get_doc({
+				"doctype": "Zakaah Assets Configuration",
+				"company": TEST_COMPANY,
+				"fiscal_year": self.fiscal_year,
+				"cash_accounts": [{"account": CONTRA_ACCOUNT}],
+				"payment_accounts": [{"account": PAYMENT_ACCOUNT}]
+			}).insert(ignore_permissions=True)
+
+	def make_journal_entry(self, amount):
+		from erpnext.accounts.doctype.journal_entry.test_journal_entry import make_journal_entry
+
+		return make_journal_entry(PAYMENT_ACCOUNT, CONTRA_ACCOUNT, amount, submit=True).name
+
+
+class TestZakaahPaymentsAllocationPlan(FrappeTestCase):
+	"""plan_allocations fills the oldest runs first, without touching the database"""
+
+	def test_fifo(self):
+		allocations, summary = plan_allocations(
+			[("2022", 100), ("2023", 0), ("2024", 300)],
+			[("JE-1", 250, 0, 250), ("JE-2", 400, 100, 300)]
+		)
+
+		self.assertEqual(
+			[(a.journal_entry, a.zakaah_calculation_run, a.allocated_amount, a.unallocated_amount) for a in allocations],
+			[("JE-1", "2022", 100, 150), ("JE-1", "2024", 150, 0), ("JE-2", "2024", 150, 150)]
+		)
+		self.assertEqual(summary, [{"journal_entry": "JE-2", "still_unallocated": 150}])
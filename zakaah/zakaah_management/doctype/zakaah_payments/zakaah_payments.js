@@ -34,6 +34,11 @@ frappe.ui.form.on("Zakaah Payments", {
 			}
 		}, 500);
 
+		// Fetch the next page of journal entries when the table's end scrolls into view
+		$(window).off('scroll.zakaah_payments').on('scroll.zakaah_payments', frappe.utils.debounce(() => {
+			load_next_journal_entry_page(frm);
+		}, 150));
+
 		// Show checkboxes for calculation_runs and payment_entries (for reconciliation)
 		// But hide for allocation_history (read-only history)
 		frm.trigger('setup_checkboxes');
@@ -236,72 +241,13 @@ frappe.ui.form.on("Zakaah Payments", {
 				// Load calculation runs (unreconciled only)
 				frm.trigger('load_calculation_runs');
 				
-				// Load journal entries (unreconciled only)
-				frappe.call({
-					method: 'zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments.import_journal_entries',
-					args: {
-						company: frm.doc.company,
-						from_date: frm.doc.from_date,
-						to_date: frm.doc.to_date,
-						selected_accounts: selected_accounts
-					},
-					callback: function(r) {
-						if (r.message) {
-							let journal_entry_records = r.message.journal_entry_records || [];
-							let skipped_count = r.message.skipped_count || 0;
-							
-							// Remove placeholder rows before clearing
-							if (frm.doc.payment_entries) {
-								frm.doc.payment_entries.forEach((row, idx) => {
-									if (row._placeholder) {
-										frm.get_field('payment_entries').grid.grid_rows[idx].remove();
-									}
-								});
-							}
-							
-							frm.clear_table('payment_entries');
-
-							let total_unreconciled = 0;
-							if (journal_entry_records && journal_entry_records.length > 0) {
-								journal_entry_records.forEach(function(record) {
-									let row = frm.add_child('payment_entries');
-									row.posting_date = record.posting_date;
-									row.journal_entry = record.journal_entry;
-									row.debit = record.debit;
-									row.credit = record.credit;
-									row.balance = record.balance;
-									row.remarks = record.remarks || '';
-									row.allocated_amount = record.allocated_amount || 0;
-									row.unallocated_amount = record.unallocated_amount || record.debit || 0;
-
-									// Add to total unreconciled
-									total_unreconciled += (row.unallocated_amount || 0);
-								});
-							} else {
-								// If no records, add placeholder to keep table visible
-								let placeholder = frm.add_child('payment_entries');
-								placeholder.journal_entry = '';
-								placeholder._placeholder = true;
-							}
-
-							frm.refresh_field('payment_entries');
-
-							// Set total journal entries unreconciled
-							frm.set_value('total_journal_entries', total_unreconciled);
-
-							frm.trigger('refresh');
-							
-							let message = __('Loaded {0} unreconciled entries', [journal_entry_records.length]);
-							if (skipped_count > 0) {
-								message += '. ' + __('Skipped {0} already fully allocated', [skipped_count]);
-							}
-							frappe.show_alert({
-								message: message,
-								indicator: 'green'
-							}, 5);
-						}
-					}
-				});
+				// Load journal entries (unreconciled only), one page now and the next ones on scroll
+				frm._journal_entry_pages = {
+					selected_accounts: selected_accounts,
+					next_cursor: null,
+					loading: false
+				};
+				load_journal_entry_page(frm, true);
 			}
 		});
 	},
@@ -488,6 +434,20 @@ frappe.ui.form.on("Zakaah Payments", {
 			<strong>Do you want to proceed with the allocation?</strong>
 		</div>`;
 		
+		// Same selection keeps its idempotency key until it succeeds, so a retry
+		// after a timeout or error cannot allocate the same journal entries twice
+		let selection = JSON.stringify([
+			selected_runs.map(run => run.zakaah_calculation_run),
+			selected_entries.map(entry => entry.journal_entry)
+		]);
+		if (!frm._allocation_request || frm._allocation_request.selection !== selection) {
+			frm._allocation_request = {
+				selection: selection,
+				idempotency_key: frappe.utils.get_random(20)
+			};
+		}
+		let idempotency_key = frm._allocation_request.idempotency_key;
+		
 		// Confirm allocation
 		frappe.confirm(
 			message,
@@ -501,10 +461,12 @@ frappe.ui.form.on("Zakaah Payments", {
 					method: 'zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments.allocate_payments',
 					args: {
 						calculation_run_items: selected_runs,
-						journal_entries: selected_entries
+						journal_entries: selected_entries,
+						idempotency_key: idempotency_key
 					},
 					callback: function(r) {
 						if (r.message && r.message.success) {
+							frm._allocation_request = null;
 							frappe.show_alert({
 								message: __('Allocation completed successfully'),
 								indicator: 'green'
@@ -582,6 +544,100 @@ frappe.ui.form.on("Zakaah Payments", {
 	}
 });
 
+function load_journal_entry_page(frm, first_page) {
+	let pages = frm._journal_entry_pages;
+	if (!pages || pages.loading) return;
+	pages.loading = true;
+
+	frappe.call({
+		method: 'zakaah.zakaah_management.doctype.zakaah_payments.zakaah_payments.import_journal_entries_page',
+		args: {
+			company: frm.doc.company,
+			from_date: frm.doc.from_date,
+			to_date: frm.doc.to_date,
+			selected_accounts: pages.selected_accounts,
+			cursor: first_page ? null : pages.next_cursor
+		},
+		callback: function(r) {
+			pages.loading = false;
+			if (!r.message || frm._journal_entry_pages !== pages) return;
+
+			let journal_entry_records = r.message.journal_entry_records || [];
+			pages.next_cursor = r.message.next_cursor;
+
+			if (first_page) {
+				// Remove placeholder rows before clearing
+				if (frm.doc.payment_entries) {
+					frm.doc.payment_entries.forEach((row, idx) => {
+						if (row._placeholder) {
+							frm.get_field('payment_entries').grid.grid_rows[idx].remove();
+						}
+					});
+				}
+
+				frm.clear_table('payment_entries');
+			}
+
+			journal_entry_records.forEach(function(record) {
+				let row = frm.add_child('payment_entries');
+				row.posting_date = record.posting_date;
+				row.journal_entry = record.journal_entry;
+				row.debit = record.debit;
+				row.credit = record.credit;
+				row.balance = record.balance;
+				row.remarks = record.remarks || '';
+				row.allocated_amount = record.allocated_amount || 0;
+				row.unallocated_amount = record.unallocated_amount || record.debit || 0;
+			});
+
+			if (first_page && journal_entry_records.length === 0) {
+				// If no records, add placeholder to keep table visible
+				let placeholder = frm.add_child('payment_entries');
+				placeholder.journal_entry = '';
+				placeholder._placeholder = true;
+			}
+
+			frm.refresh_field('payment_entries');
+
+			if (!first_page) return;
+
+			// Totals cover every page, from the server's aggregate
+			pages.total_count = r.message.total_count || 0;
+			frm.set_value('total_journal_entries', r.message.total_unallocated || 0);
+
+			frm.trigger('refresh');
+
+			let skipped_count = r.message.skipped_count || 0;
+			let message = pages.next_cursor
+				? __('Loaded {0} of {1} unreconciled entries (scroll for more)', [journal_entry_records.length, pages.total_count])
+				: __('Loaded {0} unreconciled entries', [journal_entry_records.length]);
+			if (skipped_count > 0) {
+				message += '. ' + __('Skipped {0} already fully allocated', [skipped_count]);
+			}
+			frappe.show_alert({
+				message: message,
+				indicator: 'green'
+			}, 5);
+		},
+		error: function() {
+			pages.loading = false;
+		}
+	});
+}
+
+function load_next_journal_entry_page(frm) {
+	let pages = frm._journal_entry_pages;
+	if (!pages || !pages.next_cursor || pages.loading) return;
+
+	let grid = frm.fields_dict.payment_entries && frm.fields_dict.payment_entries.grid;
+	if (!grid || !grid.wrapper.is(':visible')) return;
+
+	// Within a screen of the table's end
+	if (grid.wrapper[0].getBoundingClientRect().bottom - window.innerHeight < window.innerHeight) {
+		load_journal_entry_page(frm, false);
+	}
+}
+
 function format_currency(amount) {
 	return frappe.format(amount, {
 		fieldtype: "Currency",
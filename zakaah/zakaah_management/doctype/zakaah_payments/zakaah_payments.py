@@ -3,7 +3,33 @@ from __future__ import unicode_literals
 from frappe.model.document import Document
 import frappe
 from frappe import _
-from frappe.utils import now
+from frappe.utils import cint, flt, now, sbool
+from zakaah.zakaah_management.config_cache import get_company_configs
+from zakaah.zakaah_management.doctype.zakaah_payment_ledger.zakaah_payment_ledger import (
+	get_company_payment_accounts,
+	update_ledger_allocations
+)
+
+# SQL queries each endpoint may run, whatever the number of calculation runs,
+# journal entries or configurations involved (see test_zakaah_payments)
+QUERY_BUDGETS = {
+	"get_calculation_runs": 2,
+	"get_payment_accounts_from_settings": 2,
+	"allocate_payments": 4,
+	"import_journal_entries": 3,
+	"import_journal_entries_page": 3,
+}
+
+# Rows per page of import_journal_entries_page (default and upper limit)
+JOURNAL_ENTRY_PAGE_SIZE = 100
+MAX_JOURNAL_ENTRY_PAGE_SIZE = 1000
+
+# Journal entries allocated per transaction (row locks are held until its commit)
+ALLOCATION_CHUNK_SIZE = 500
+
+# Additional queries allowed per ALLOCATION_CHUNK_SIZE journal entries
+# (locks, idempotency lookup, reads, insert, run and ledger totals, commit)
+ALLOCATION_QUERY_BUDGET = 9
 
 class ZakaahPayments(Document):
 	def validate(self):
@@ -90,232 +116,116 @@ class ZakaahPayments(Document):
 def get_calculation_runs(company=None, show_unreconciled_only=True):
 	"""Get Zakaah Calculation Runs
 	By default: only years with outstanding > 0 (like Payment Reconciliation)
+
+	Read only: paid and outstanding amounts are derived from allocation history
+	in the same query, stored amounts are repaired by repair_calculation_run_totals.
 	"""
 	try:
 		if not frappe.db.exists("DocType", "Zakaah Calculation Run"):
 			return []
 		
-		# Base filters
-		filters = {}
+		conditions = ""
 		if company:
-			filters["company"] = company
-		if show_unreconciled_only:
+			conditions += " AND zcr.company = %(company)s"
+
+		having = ""
+		if sbool(show_unreconciled_only):
 			# Use >= 1 to exclude rounding errors (e.g., 0.001750)
-			filters["outstanding_zakaah"] = [">=", 1]
-		
-		# Get calculation runs
-		runs = frappe.db.get_all(
-			"Zakaah Calculation Run",
-			filters=filters,
-			fields=[
-				"name", 
-				"fiscal_year",
-				"total_zakaah", 
-				"paid_zakaah", 
-				"outstanding_zakaah", 
-				"status"
-			],
-			order_by="fiscal_year asc"
-		)
-		
-		# Update outstanding amounts (recalculate from allocation history)
-		for run in runs:
-			paid_amount = get_total_allocated_for_run(run.name)
-			outstanding = (run.total_zakaah or 0) - paid_amount
-
-			# Update if different
-			if outstanding != (run.outstanding_zakaah or 0):
-				frappe.db.set_value(
-					"Zakaah Calculation Run",
-					run.name,
-					{
-						"paid_zakaah": paid_amount,
-						"outstanding_zakaah": outstanding
-					},
-					update_modified=False
-				)
-
-				run.paid_zakaah = paid_amount
-				run.outstanding_zakaah = outstanding
-
-		# Filter out runs with 0 outstanding after recalculation (if show_unreconciled_only)
-		# Use >= 1 to exclude rounding errors (e.g., 0.001750)
-		if show_unreconciled_only:
-			runs = [run for run in runs if (run.outstanding_zakaah or 0) >= 1]
-
-		return runs
+			having = "HAVING outstanding_zakaah >= 1"
+
+		# Outstanding amounts recalculated from allocation history
+		return frappe.db.sql("""
+			SELECT
+				zcr.name,
+				zcr.fiscal_year,
+				zcr.total_zakaah,
+				COALESCE(SUM(alloc.allocated_amount), 0) as paid_zakaah,
+				COALESCE(zcr.total_zakaah, 0) - COALESCE(SUM(alloc.allocated_amount), 0) as outstanding_zakaah,
+				zcr.status
+			FROM `tabZakaah Calculation Run` zcr
+			LEFT JOIN `tabZakaah Allocation History` alloc
+				ON alloc.zakaah_calculation_run = zcr.name
+				AND alloc.docstatus != 2
+			WHERE 1 = 1
+			{conditions}
+			GROUP BY zcr.name, zcr.fiscal_year, zcr.total_zakaah, zcr.status
+			{having}
+			ORDER BY zcr.fiscal_year asc
+		""".format(conditions=conditions, having=having), {"company": company}, as_dict=True)
 		
 	except Exception as e:
 		frappe.log_error(f"Error getting calculation runs: {str(e)}", "Get Calculation Runs")
 		return []
 
 
+@frappe.whitelist()
+def repair_calculation_run_totals(company=None):
+	"""Rewrite paid, outstanding and status of runs whose stored amounts disagree with allocation history"""
+	frappe.only_for(["System Manager", "Zakaah Manager"])
+
+	return {"repaired": update_stale_calculation_run_totals(company)}
+
+
+def update_stale_calculation_run_totals(company=None):
+	"""Maintenance for get_calculation_runs (which never writes): find stale runs in one query and rewrite them"""
+	conditions = ""
+	if company:
+		conditions = "AND zcr.company = %(company)s"
+
+	stale_runs = frappe.db.sql_list("""
+		SELECT zcr.name
+		FROM `tabZakaah Calculation Run` zcr
+		LEFT JOIN `tabZakaah Allocation History` alloc
+			ON alloc.zakaah_calculation_run = zcr.name
+			AND alloc.docstatus != 2
+		WHERE 1 = 1
+		{conditions}
+		GROUP BY zcr.name, zcr.total_zakaah, zcr.paid_zakaah, zcr.outstanding_zakaah
+		HAVING ABS(COALESCE(zcr.paid_zakaah, 0) - COALESCE(SUM(alloc.allocated_amount), 0)) >= 0.01
+			OR ABS(COALESCE(zcr.outstanding_zakaah, 0)
+				- GREATEST(0, COALESCE(zcr.total_zakaah, 0) - COALESCE(SUM(alloc.allocated_amount), 0))) >= 0.01
+	""".format(conditions=conditions), {"company": company})
+
+	for start in range(0, len(stale_runs), ALLOCATION_CHUNK_SIZE):
+		update_calculation_run_totals(stale_runs[start:start + ALLOCATION_CHUNK_SIZE])
+		frappe.db.commit()
+
+	return len(stale_runs)
+
+
+def repair_all_calculation_run_totals():
+	"""Scheduler (daily): repair stored run amounts of every company"""
+	update_stale_calculation_run_totals()
+
+
 @frappe.whitelist()
 def import_journal_entries(company, from_date, to_date, selected_accounts):
 	"""
 	Import ONLY UNRECONCILED journal entries
 	Exactly like Payment Reconciliation module
+
+	Reads the Zakaah Payment Ledger, which keeps each journal entry's payment
+	account debit and allocated amount up to date, so the cost does not grow
+	with the size of GL Entry or Zakaah Allocation History.
 	"""
 	try:
-		# Parse selected_accounts if it's a JSON string
-		if isinstance(selected_accounts, str):
-			import json
-			selected_accounts = json.loads(selected_accounts)
-
-		if not selected_accounts or len(selected_accounts) == 0:
+		accounts = _parse_selected_accounts(selected_accounts)
+		if not accounts:
 			return {
 				"journal_entry_records": [],
 				"skipped_count": 0
 			}
-		
-		# 1. Get ALL journal entries from selected accounts
-		# IMPORTANT: Get debit from GL Entry (not Journal Entry Account)
-		# This aligns with Payment Accounts rule (Debit from GL Entry)
-
-		# Debug: Log parameters before query
-		frappe.log_error(
-			f"SQL Query Parameters:\n"
-			f"Company: {company}\n"
-			f"From Date: {from_date}\n"
-			f"To Date: {to_date}\n"
-			f"Selected Accounts (raw): {selected_accounts}\n"
-			f"Accounts type: {type(selected_accounts)}\n"
-			f"Accounts tuple: {tuple(selected_accounts) if isinstance(selected_accounts, list) else (selected_accounts,)}",
-			"Import Journal Entries SQL Debug"
-		)
 
-		# Query 1: Get journal entries within date range
-		entries_in_range = frappe.db.sql("""
-			SELECT
-				je.name as journal_entry,
-				je.posting_date,
-				je.user_remark as remarks,
-				SUM(gle.debit) as debit,
-				SUM(gle.credit) as credit
-			FROM `tabJournal Entry` je
-			INNER JOIN `tabGL Entry` gle ON gle.voucher_no = je.name
-			WHERE je.company = %(company)s
-			AND je.posting_date BETWEEN %(from_date)s AND %(to_date)s
-			AND gle.account IN %(accounts)s
-			AND je.docstatus = 1
-			AND gle.is_cancelled = 0
-			GROUP BY je.name, je.posting_date, je.user_remark
-			ORDER BY je.posting_date, je.name
-		""", {
-			'company': company,
-			'from_date': from_date,
-			'to_date': to_date,
-			'accounts': tuple(selected_accounts) if isinstance(selected_accounts, list) else (selected_accounts,)
-		}, as_dict=True)
-
-		# Query 2: Get ALL journal entries with CURRENT unallocated amounts (regardless of date)
+		# Journal entries with an unallocated amount, whatever their posting date
 		# This ensures we show journal entries that still have unallocated amounts from previous periods
-		# FIXED: Calculate current unallocated by comparing total debit vs sum of allocations
-		entries_with_unallocated = frappe.db.sql("""
-			SELECT
-				je.name as journal_entry,
-				je.posting_date,
-				je.user_remark as remarks,
-				SUM(gle.debit) as debit,
-				SUM(gle.credit) as credit,
-				COALESCE(alloc.total_allocated, 0) as already_allocated,
-				SUM(gle.debit) - COALESCE(alloc.total_allocated, 0) as current_unallocated
-			FROM `tabJournal Entry` je
-			INNER JOIN `tabGL Entry` gle ON gle.voucher_no = je.name
-			LEFT JOIN (
-				SELECT journal_entry, SUM(allocated_amount) as total_allocated
-				FROM `tabZakaah Allocation History`
-				WHERE docstatus = 1
-				GROUP BY journal_entry
-			) alloc ON alloc.journal_entry = je.name
-			WHERE je.company = %(company)s
-			AND gle.account IN %(accounts)s
-			AND je.docstatus = 1
-			AND gle.is_cancelled = 0
-			GROUP BY je.name, je.posting_date, je.user_remark
-			HAVING current_unallocated > 0
-			ORDER BY je.posting_date, je.name
-		""", {
-			'company': company,
-			'accounts': tuple(selected_accounts) if isinstance(selected_accounts, list) else (selected_accounts,)
-		}, as_dict=True)
-
-		# Combine both result sets and remove duplicates
-		all_entries_dict = {}
-		for entry in entries_in_range:
-			all_entries_dict[entry.journal_entry] = entry
-		for entry in entries_with_unallocated:
-			if entry.journal_entry not in all_entries_dict:
-				all_entries_dict[entry.journal_entry] = entry
-
-		# Convert back to list and sort by posting date
-		all_entries = sorted(all_entries_dict.values(), key=lambda x: (x.posting_date, x.journal_entry))
-		
-		# 2. Get already allocated amounts from Allocation History
-		already_allocated = frappe.db.sql("""
-			SELECT 
-				journal_entry,
-				SUM(allocated_amount) as total_allocated
-			FROM `tabZakaah Allocation History`
-			WHERE docstatus != 2
-			GROUP BY journal_entry
-		""", as_dict=True)
-		
-		# Create dictionary for quick lookup
-		allocated_dict = {
-			row.journal_entry: row.total_allocated 
-			for row in already_allocated
-		}
-		
-		# 3. Filter: Only unreconciled (unallocated > 0)
-		journal_entry_records = []
-		skipped_count = 0
-		
-		for entry in all_entries:
-			entry_name = entry.journal_entry
-			debit_amount = entry.debit or 0
-			
-			# Get total allocated for this JE
-			total_allocated = allocated_dict.get(entry_name, 0)
-			
-			# Calculate unallocated amount
-			unallocated = debit_amount - total_allocated
-			
-			# Only add if there's unallocated amount
-			if unallocated > 0:
-				journal_entry_records.append({
-					"journal_entry": entry_name,
-					"posting_date": str(entry.posting_date),
-					"debit": debit_amount,
-					"credit": entry.credit or 0,
-					"balance": debit_amount,
-					"remarks": entry.remarks or "",
-					"allocated_amount": total_allocated,
-					"unallocated_amount": unallocated
-				})
-			else:
-				skipped_count += 1
-		
-		# Debug: Log what we're returning
-		debug_msg = f"Journal Entries Found: {len(journal_entry_records)}\n"
-		debug_msg += f"All Entries: {len(all_entries)}\n"
-		debug_msg += f"Skipped: {skipped_count}\n"
-		debug_msg += f"Accounts: {selected_accounts}\n"
-		debug_msg += f"Date Range: {from_date} to {to_date}\n\n"
-
-		if len(all_entries) > 0:
-			debug_msg += "Sample entries from SQL query:\n"
-			for entry in all_entries[:3]:
-				total_allocated = allocated_dict.get(entry.journal_entry, 0)
-				unallocated = (entry.debit or 0) - total_allocated
-				debug_msg += f"  - {entry.journal_entry}: debit={entry.debit}, allocated={total_allocated}, unallocated={unallocated}\n"
-
-		frappe.log_error(debug_msg, "Import Journal Entries Debug")
+		from_ledger = is_payment_ledger_source(company, accounts)
+		journal_entry_records = get_unallocated_journal_entries(company, accounts, from_ledger=from_ledger)
+		totals = get_unallocated_journal_entry_totals(company, from_date, to_date, accounts, from_ledger)
 
 		# Return result without showing message (let JS handle it)
 		return {
 			"journal_entry_records": journal_entry_records,
-			"skipped_count": skipped_count
+			"skipped_count": totals["skipped_count"]
 		}
 		
 	except Exception as e:
@@ -324,11 +234,203 @@ def import_journal_entries(company, from_date, to_date, selected_accounts):
 
 
 @frappe.whitelist()
-def allocate_payments(calculation_run_items, journal_entries):
+def import_journal_entries_page(company, from_date, to_date, selected_accounts, cursor=None, page_size=None):
+	"""
+	One page of import_journal_entries, ordered by (posting_date, journal_entry)
+
+	cursor is the next_cursor of the previous page (none for the first page,
+	which also carries total_count, total_unallocated and skipped_count).
+	"""
+	try:
+		import json
+		accounts = _parse_selected_accounts(selected_accounts)
+		if isinstance(cursor, str):
+			cursor = json.loads(cursor) if cursor else None
+		page_size = min(cint(page_size) or JOURNAL_ENTRY_PAGE_SIZE, MAX_JOURNAL_ENTRY_PAGE_SIZE)
+
+		if not accounts:
+			return {"journal_entry_records": [], "next_cursor": None, "total_count": 0, "total_unallocated": 0, "skipped_count": 0}
+
+		# One extra row tells whether there is a next page
+		from_ledger = is_payment_ledger_source(company, accounts)
+		journal_entry_records = get_unallocated_journal_entries(company, accounts, cursor, page_size + 1, from_ledger)
+		next_cursor = None
+		if len(journal_entry_records) > page_size:
+			journal_entry_records = journal_entry_records[:page_size]
+			next_cursor = {
+				"posting_date": journal_entry_records[-1]["posting_date"],
+				"journal_entry": journal_entry_records[-1]["journal_entry"]
+			}
+
+		result = {
+			"journal_entry_records": journal_entry_records,
+			"next_cursor": next_cursor
+		}
+		if not cursor:
+			result.update(get_unallocated_journal_entry_totals(company, from_date, to_date, accounts, from_ledger))
+
+		return result
+
+	except Exception as e:
+		frappe.log_error(f"Error importing journal entries: {str(e)}", "Import Journal Entries")
+		return {"journal_entry_records": [], "next_cursor": None}
+
+
+def _parse_selected_accounts(selected_accounts):
+	# Parse selected_accounts if it's a JSON string
+	if isinstance(selected_accounts, str):
+		import json
+		selected_accounts = json.loads(selected_accounts)
+
+	if not selected_accounts:
+		return ()
+
+	return tuple(selected_accounts) if isinstance(selected_accounts, list) else (selected_accounts,)
+
+
+def get_unallocated_journal_entries(company, accounts, cursor=None, limit=None, from_ledger=None):
+	"""Unallocated journal entries of the selected accounts after cursor, in (posting_date, journal_entry) order"""
+	conditions = ""
+	if cursor:
+		# Keyset pagination: resume after the last row of the previous page
+		conditions = """
+			AND (posting_date > %(after_date)s
+				OR (posting_date = %(after_date)s AND journal_entry > %(after_journal_entry)s))
+		"""
+
+	# Debit and allocations are summed over the selected accounts only, like the GL Entry query did
+	entries = frappe.db.sql("""
+		SELECT
+			journal_entry,
+			posting_date,
+			remarks,
+			SUM(debit) as debit,
+			SUM(credit) as credit,
+			MAX(allocated_amount) as allocated_amount,
+			SUM(debit) - MAX(allocated_amount) as unallocated_amount
+		FROM ({rows}) entry
+		WHERE 1=1
+		{conditions}
+		GROUP BY journal_entry, posting_date, remarks
+		HAVING unallocated_amount > 0
+		ORDER BY posting_date, journal_entry
+		{limit}
+	""".format(
+		rows=_get_journal_entry_rows(company, accounts, unallocated_only=True, from_ledger=from_ledger),
+		conditions=conditions,
+		limit="LIMIT %(limit)s" if limit else ""
+	), {
+		'company': company,
+		'accounts': accounts,
+		'after_date': cursor and cursor.get("posting_date"),
+		'after_journal_entry': cursor and cursor.get("journal_entry"),
+		'limit': cint(limit)
+	}, as_dict=True)
+
+	return [
+		{
+			"journal_entry": entry.journal_entry,
+			"posting_date": str(entry.posting_date),
+			"debit": entry.debit or 0,
+			"credit": entry.credit or 0,
+			"balance": entry.debit or 0,
+			"remarks": entry.remarks or "",
+			"allocated_amount": entry.allocated_amount or 0,
+			"unallocated_amount": entry.unallocated_amount
+		}
+		for entry in entries
+	]
+
+
+def get_unallocated_journal_entry_totals(company, from_date, to_date, accounts, from_ledger=None):
+	"""Count and amount of unallocated journal entries, and fully allocated ones of the date range, in one aggregate"""
+	totals = frappe.db.sql("""
+		SELECT
+			COALESCE(SUM(unallocated_amount > 0), 0) as total_count,
+			COALESCE(SUM(CASE WHEN unallocated_amount > 0 THEN unallocated_amount ELSE 0 END), 0) as total_unallocated,
+			COALESCE(SUM(unallocated_amount <= 0 AND posting_date BETWEEN %(from_date)s AND %(to_date)s), 0) as skipped_count
+		FROM (
+			SELECT journal_entry, posting_date, SUM(debit) - MAX(allocated_amount) as unallocated_amount
+			FROM ({rows}) entry
+			GROUP BY journal_entry, posting_date
+		) je
+	""".format(rows=_get_journal_entry_rows(company, accounts, from_ledger=from_ledger)), {
+		'company': company,
+		'from_date': from_date,
+		'to_date': to_date,
+		'accounts': accounts
+	}, as_dict=True)[0]
+
+	return {
+		"total_count": cint(totals.total_count),
+		"total_unallocated": flt(totals.total_unallocated),
+		"skipped_count": cint(totals.skipped_count)
+	}
+
+
+def is_payment_ledger_source(company, accounts):
+	"""Whether the Zakaah Payment Ledger holds every selected account of the company"""
+	return set(accounts) <= set(get_company_payment_accounts(company))
+
+
+def _get_journal_entry_rows(company, accounts, unallocated_only=False, from_ledger=None):
 	"""
-	Allocate journal entries to Zakaah Calculation Runs
+	Derived table of (journal entry, payment account) rows of the selected accounts
+
+	Read from the Zakaah Payment Ledger when it holds every selected account.
+	Accounts missing from every configuration are not in the ledger, so their
+	rows are read from GL Entry instead.
+	"""
+	if from_ledger is None:
+		from_ledger = is_payment_ledger_source(company, accounts)
+
+	if from_ledger:
+		# unallocated_amount is over all payment accounts of the journal entry,
+		# never below the amount left on the selected ones
+		return """
+			SELECT journal_entry, posting_date, remarks, debit, credit, allocated_amount
+			FROM `tabZakaah Payment Ledger`
+			WHERE company = %(company)s
+			AND payment_account IN %(accounts)s
+			{unallocated}
+		""".format(unallocated="AND unallocated_amount > 0" if unallocated_only else "")
+
+	return """
+		SELECT
+			je.name as journal_entry,
+			je.posting_date,
+			je.user_remark as remarks,
+			gle.debit,
+			gle.credit,
+			COALESCE(alloc.total_allocated, 0) as allocated_amount
+		FROM `tabJournal Entry` je
+		INNER JOIN `tabGL Entry` gle ON gle.voucher_no = je.name
+		LEFT JOIN (
+			SELECT journal_entry, SUM(allocated_amount) as total_allocated
+			FROM `tabZakaah Allocation History`
+			WHERE docstatus != 2
+			GROUP BY journal_entry
+		) alloc ON alloc.journal_entry = je.name
+		WHERE je.company = %(company)s
+		AND gle.account IN %(accounts)s
+		AND je.docstatus = 1
+		AND gle.is_cancelled = 0
+	"""
+
+
+@frappe.whitelist()
+def allocate_payments(calculation_run_items, journal_entries, idempotency_key=None):
+	"""
+	Allocate journal entries to Zakaah Calculation Runs (FIFO: oldest run first)
 	Updates outstanding amounts after allocation
+
+	Retrying with the same idempotency_key does not allocate a journal entry
+	again: its allocations from the earlier attempt are returned instead.
 	"""
+	# Rows are bulk inserted as submitted, so check what insert() and submit() would have
+	frappe.has_permission("Zakaah Allocation History", "create", throw=True)
+	frappe.has_permission("Zakaah Allocation History", "submit", throw=True)
+
 	try:
 		# Parse parameters if they're JSON strings
 		import json
@@ -340,149 +442,24 @@ def allocate_payments(calculation_run_items, journal_entries):
 		if not frappe.db.exists("DocType", "Zakaah Allocation History"):
 			return {"success": False, "message": "Zakaah Allocation History doctype not found"}
 
-		allocated_records = []
-		allocation_summary = []
+		run_names = list(dict.fromkeys(
+			run_item.get("zakaah_calculation_run")
+			for run_item in calculation_run_items
+			if run_item.get("zakaah_calculation_run")
+		))
+		journal_entries = [row for row in journal_entries if row.get("journal_entry")]
 
-		# Get already allocated amounts from database
-		already_allocated = frappe.db.sql("""
-			SELECT
-				journal_entry,
-				SUM(allocated_amount) as total_allocated
-			FROM `tabZakaah Allocation History`
-			WHERE docstatus != 2
-			GROUP BY journal_entry
-		""", as_dict=True)
+		# Start a new transaction: reads after the row locks must see other allocators' commits
+		frappe.db.commit()
 
-		# Create dictionary for quick lookup
-		allocated_dict = {
-			row.journal_entry: row.total_allocated
-			for row in already_allocated
-		}
+		allocated_records = []
+		allocation_summary = []
+		for start in range(0, len(journal_entries), ALLOCATION_CHUNK_SIZE):
+			records, summary = _allocate_chunk(
+				run_names, journal_entries[start:start + ALLOCATION_CHUNK_SIZE], idempotency_key)
+			allocated_records.extend(records)
+			allocation_summary.extend(summary)
 
-		# Process each journal entry
-		for journal_entry in journal_entries:
-			journal_entry_name = journal_entry.get("journal_entry")
-			unallocated_amount = journal_entry.get("unallocated_amount") or 0
-			original_debit = journal_entry.get("debit") or 0
-			
-			# Track how much is being allocated in this session
-			remaining_to_allocate = unallocated_amount
-			
-			for run_item in calculation_run_items:
-				run_name = run_item.get("zakaah_calculation_run")
-				if not run_name:
-					continue
-
-				# CRITICAL: Get CURRENT outstanding from database (not from stale run_item)
-				# This prevents over-allocation if user clicks Allocate multiple times
-				current_data = frappe.db.get_value(
-					"Zakaah Calculation Run",
-					run_name,
-					["total_zakaah", "paid_zakaah", "outstanding_zakaah"],
-					as_dict=True
-				)
-
-				if not current_data:
-					continue
-
-				current_outstanding = current_data.outstanding_zakaah or 0
-				total_zakaah = current_data.total_zakaah or 0
-				current_paid = current_data.paid_zakaah or 0
-
-				# Skip if already fully paid
-				if current_outstanding <= 0:
-					continue
-
-				if remaining_to_allocate <= 0:
-					break
-
-				# Calculate allocation amount (minimum of remaining to allocate and current outstanding)
-				allocation_amount = min(remaining_to_allocate, current_outstanding)
-
-				# VALIDATION: Ensure allocation won't exceed total zakaah
-				new_paid = current_paid + allocation_amount
-				if new_paid > total_zakaah:
-					# Adjust allocation to not exceed total
-					allocation_amount = max(0, total_zakaah - current_paid)
-					frappe.log_error(
-						f"Prevented over-allocation for {run_name}\n"
-						f"Total Zakaah: {total_zakaah}\n"
-						f"Current Paid: {current_paid}\n"
-						f"Attempted: {allocation_amount + (new_paid - total_zakaah)}\n"
-						f"Adjusted to: {allocation_amount}",
-						"Allocation Over-limit Prevention"
-					)
-
-				if allocation_amount > 0:
-					# Calculate remaining unallocated after this allocation
-					# Include BOTH: allocations from this session AND previous allocations from database
-					current_session_allocated = sum([
-						r.get("allocated_amount", 0)
-						for r in allocated_records
-						if r.get("journal_entry") == journal_entry_name
-					])
-
-					# Get total allocated from database (including previous sessions)
-					previous_allocated = allocated_dict.get(journal_entry_name, 0)
-
-					# Total allocated = previous + current session + this allocation
-					total_allocated = previous_allocated + current_session_allocated + allocation_amount
-					new_unallocated = original_debit - total_allocated
-					
-					# Create allocation history record
-					allocation_doc = frappe.get_doc({
-						"doctype": "Zakaah Allocation History",
-						"journal_entry": journal_entry_name,
-						"zakaah_calculation_run": run_name,
-						"allocated_amount": allocation_amount,
-						"unallocated_amount": new_unallocated,
-						"allocation_date": now(),
-						"allocated_by": frappe.session.user
-					})
-					allocation_doc.insert()
-					allocation_doc.submit()
-
-					allocated_records.append({
-						"journal_entry": journal_entry_name,
-						"zakaah_calculation_run": run_name,
-						"allocated_amount": allocation_amount
-					})
-					
-					remaining_to_allocate -= allocation_amount
-			
-			if remaining_to_allocate > 0:
-				allocation_summary.append({
-					"journal_entry": journal_entry_name,
-					"still_unallocated": remaining_to_allocate
-				})
-		
-		# Update outstanding amounts in Calculation Runs
-		for run_item in calculation_run_items:
-			run_name = run_item.get("zakaah_calculation_run")
-			if run_name:
-				total_zakaah = frappe.db.get_value("Zakaah Calculation Run", run_name, "total_zakaah")
-				
-				# Recalculate paid amount
-				paid_amount = get_total_allocated_for_run(run_name)
-				outstanding = max(0, (total_zakaah or 0) - paid_amount)
-				
-				# Determine status
-				if outstanding == 0:
-					status = "Paid"
-				elif paid_amount > 0:
-					status = "Partially Paid"
-				else:
-					status = "Calculated"
-				
-				# Update Calculation Run
-				frappe.db.set_value("Zakaah Calculation Run", run_name, {
-					"paid_zakaah": paid_amount,
-					"outstanding_zakaah": outstanding,
-					"status": status
-				}, update_modified=False)
-		
-		frappe.db.commit()
-		
 		return {
 			"success": True,
 			"allocated_records": allocated_records,
@@ -495,6 +472,240 @@ def allocate_payments(calculation_run_items, journal_entries):
 		return {"success": False, "message": str(e)}
 
 
+def _allocate_chunk(run_names, journal_entries, idempotency_key=None):
+	"""Allocate some journal entries in one transaction, holding row locks on the runs and journal entries"""
+	lock_allocation_rows(run_names, [row.get("journal_entry") for row in journal_entries])
+
+	# Journal entries this request already allocated (a retry) are not allocated again
+	previous = get_idempotent_allocations(idempotency_key, [row.get("journal_entry") for row in journal_entries])
+	journal_entries = [row for row in journal_entries if row.get("journal_entry") not in previous]
+
+	# CRITICAL: Use CURRENT outstanding and unallocated amounts from database (not from stale client rows)
+	# This prevents over-allocation if user clicks Allocate multiple times
+	runs = get_outstanding_runs(run_names)
+	available = get_journal_entry_available(journal_entries)
+
+	allocations, summary = plan_allocations(
+		[(name, runs[name]) for name in run_names if name in runs],
+		[(name,) + available[name] for name in available]
+	)
+
+	insert_allocations(allocations, idempotency_key)
+
+	# Update outstanding amounts in Calculation Runs and unallocated amounts in the ledger
+	if allocations:
+		update_calculation_run_totals(list(runs))
+		update_ledger_allocations([allocation.journal_entry for allocation in allocations])
+	frappe.db.commit()
+
+	records = [record for journal_entry in previous for record in previous[journal_entry]]
+	records.extend(
+		{
+			"journal_entry": allocation.journal_entry,
+			"zakaah_calculation_run": allocation.zakaah_calculation_run,
+			"allocated_amount": allocation.allocated_amount
+		}
+		for allocation in allocations
+	)
+	return records, summary
+
+
+def lock_allocation_rows(run_names, journal_entry_names):
+	"""SELECT ... FOR UPDATE the calculation runs, then the journal entries, each in name order.
+
+	Concurrent allocations touching the same rows wait for each other, and the
+	fixed order means they cannot deadlock.
+	"""
+	if run_names:
+		frappe.db.sql("""
+			SELECT name FROM `tabZakaah Calculation Run`
+			WHERE name IN %(runs)s
+			ORDER BY name
+			FOR UPDATE
+		""", {"runs": run_names})
+
+	if journal_entry_names:
+		frappe.db.sql("""
+			SELECT name FROM `tabJournal Entry`
+			WHERE name IN %(journal_entries)s
+			ORDER BY name
+			FOR UPDATE
+		""", {"journal_entries": journal_entry_names})
+
+
+def get_idempotent_allocations(idempotency_key, journal_entry_names):
+	"""Return {journal_entry: [allocated records]} written earlier under idempotency_key"""
+	if not idempotency_key or not journal_entry_names:
+		return {}
+
+	previous = {}
+	for row in frappe.db.sql("""
+		SELECT journal_entry, zakaah_calculation_run, allocated_amount
+		FROM `tabZakaah Allocation History`
+		WHERE idempotency_key = %(key)s
+		AND journal_entry IN %(journal_entries)s
+		AND docstatus != 2
+		ORDER BY creation, name
+	""", {"key": idempotency_key, "journal_entries": journal_entry_names}, as_dict=True):
+		previous.setdefault(row.journal_entry, []).append(row)
+
+	return previous
+
+
+def get_outstanding_runs(run_names):
+	"""Return {run: outstanding} from total_zakaah minus submitted allocations, in one query"""
+	if not run_names:
+		return {}
+
+	return {
+		row.name: flt(row.total_zakaah) - flt(row.allocated)
+		for row in frappe.db.sql("""
+			SELECT
+				zcr.name,
+				zcr.total_zakaah,
+				COALESCE(SUM(alloc.allocated_amount), 0) as allocated
+			FROM `tabZakaah Calculation Run` zcr
+			LEFT JOIN `tabZakaah Allocation History` alloc
+				ON alloc.zakaah_calculation_run = zcr.name
+				AND alloc.docstatus != 2
+			WHERE zcr.name IN %(runs)s
+			GROUP BY zcr.name, zcr.total_zakaah
+		""", {"runs": run_names}, as_dict=True)
+	}
+
+
+def get_journal_entry_available(journal_entries):
+	"""Return {journal_entry: (debit, already_allocated, allocatable)} of submitted journal entries, in one query.
+
+	Journal entries keep the order of the request. debit is the client's
+	payment account debit (the Journal Entry total when missing) and
+	allocatable what is left of it, never more than the client's
+	unallocated_amount nor the Journal Entry total (see check_over_allocation).
+	"""
+	requested = {}
+	for row in journal_entries:
+		if row.get("journal_entry"):
+			requested.setdefault(row.get("journal_entry"), row)
+	if not requested:
+		return {}
+	order = {name: index for index, name in enumerate(requested)}
+
+	available = {}
+	for row in sorted(frappe.db.sql("""
+		SELECT
+			je.name as journal_entry,
+			je.total_debit,
+			COALESCE(SUM(alloc.allocated_amount), 0) as allocated
+		FROM `tabJournal Entry` je
+		LEFT JOIN `tabZakaah Allocation History` alloc
+			ON alloc.journal_entry = je.name
+			AND alloc.docstatus != 2
+		WHERE je.name IN %(journal_entries)s
+		AND je.docstatus = 1
+		GROUP BY je.name, je.total_debit
+	""", {"journal_entries": list(requested)}, as_dict=True), key=lambda row: order[row.journal_entry]):
+		client = requested[row.journal_entry]
+		debit = flt(client.get("debit")) or flt(row.total_debit)
+		allocatable = min(
+			flt(client.get("unallocated_amount")),
+			debit - flt(row.allocated),
+			flt(row.total_debit) - flt(row.allocated)
+		)
+		available[row.journal_entry] = (debit, flt(row.allocated), allocatable)
+
+	return available
+
+
+def plan_allocations(runs, journal_entries):
+	"""FIFO allocation plan, computed in memory.
+
+	runs is [(run, outstanding)] oldest first and journal_entries is
+	[(journal_entry, debit, already_allocated, allocatable)]. Each journal
+	entry fills the oldest runs with outstanding left. Returns (allocations,
+	summary): the Zakaah Allocation History rows to write and the journal
+	entries with an amount still unallocated.
+	"""
+	outstanding = [[name, flt(amount)] for name, amount in runs]
+	allocations, summary = [], []
+	position = 0
+
+	for journal_entry, debit, already_allocated, allocatable in journal_entries:
+		remaining_to_allocate = flt(allocatable)
+		allocated = flt(already_allocated)
+
+		while remaining_to_allocate > 0 and position < len(outstanding):
+			run = outstanding[position]
+			if run[1] <= 0:
+				# Runs only ever decrease, so a paid run is never revisited
+				position += 1
+				continue
+
+			allocation_amount = min(remaining_to_allocate, run[1])
+			allocated += allocation_amount
+			allocations.append(frappe._dict({
+				"journal_entry": journal_entry,
+				"zakaah_calculation_run": run[0],
+				"allocated_amount": allocation_amount,
+				"unallocated_amount": max(0, flt(debit) - allocated)
+			}))
+
+			remaining_to_allocate -= allocation_amount
+			run[1] -= allocation_amount
+
+		if remaining_to_allocate > 0:
+			summary.append({
+				"journal_entry": journal_entry,
+				"still_unallocated": remaining_to_allocate
+			})
+
+	return allocations, summary
+
+
+def insert_allocations(allocations, idempotency_key=None):
+	"""Write submitted Zakaah Allocation History rows with a multi-row insert"""
+	if not allocations:
+		return
+
+	timestamp, user = now(), frappe.session.user
+	frappe.db.bulk_insert("Zakaah Allocation History", fields=[
+		"name", "journal_entry", "zakaah_calculation_run", "allocated_amount", "unallocated_amount",
+		"allocation_date", "allocated_by", "idempotency_key", "docstatus", "creation", "modified", "owner", "modified_by"
+	], values=[
+		(
+			frappe.generate_hash(length=10), allocation.journal_entry, allocation.zakaah_calculation_run,
+			allocation.allocated_amount, allocation.unallocated_amount,
+			timestamp, user, idempotency_key, 1, timestamp, timestamp, user, user
+		)
+		for allocation in allocations
+	])
+
+
+def update_calculation_run_totals(run_names):
+	"""Recompute paid, outstanding and status of calculation runs from their allocations, in one statement"""
+	if not run_names:
+		return
+
+	frappe.db.sql("""
+		UPDATE `tabZakaah Calculation Run` zcr
+		LEFT JOIN (
+			SELECT zakaah_calculation_run, SUM(allocated_amount) as total
+			FROM `tabZakaah Allocation History`
+			WHERE zakaah_calculation_run IN %(runs)s
+			AND docstatus != 2
+			GROUP BY zakaah_calculation_run
+		) alloc ON alloc.zakaah_calculation_run = zcr.name
+		SET
+			zcr.paid_zakaah = COALESCE(alloc.total, 0),
+			zcr.outstanding_zakaah = GREATEST(0, COALESCE(zcr.total_zakaah, 0) - COALESCE(alloc.total, 0)),
+			zcr.status = CASE
+				WHEN COALESCE(zcr.total_zakaah, 0) - COALESCE(alloc.total, 0) <= 0 THEN 'Paid'
+				WHEN COALESCE(alloc.total, 0) > 0 THEN 'Partially Paid'
+				ELSE 'Calculated'
+			END
+		WHERE zcr.name IN %(runs)s
+	""", {"runs": run_names})
+
+
 @frappe.whitelist()
 def get_allocation_history(calculation_run=None, journal_entry=None):
 	"""Get allocation history records with CURRENT unallocated amounts (not historical snapshots)"""
@@ -523,37 +734,15 @@ def get_allocation_history(calculation_run=None, journal_entry=None):
 		)
 
 		# FIXED: Recalculate CURRENT unallocated amount for each journal entry
-		# Get current unallocated amounts for all journal entries
-		# IMPORTANT: Only count debits from Zakaa Liability account (payment account)
+		# (payment account debit minus all allocations, kept by Zakaah Payment Ledger)
 		je_unallocated = {}
 		if history:
-			unique_jes = list(set([h["journal_entry"] for h in history]))
-
-			# Get the Zakaa Liability payment account (the account used for zakaah payments)
-			# This is typically "2205001 - Zakaa Liability - AP" or similar
-			# We'll query GL Entry filtered by the payment account to get accurate amounts
-			current_unallocated = frappe.db.sql("""
-				SELECT
-					gle.voucher_no as journal_entry,
-					SUM(gle.debit) as total_debit,
-					COALESCE(alloc.total_allocated, 0) as total_allocated,
-					SUM(gle.debit) - COALESCE(alloc.total_allocated, 0) as current_unallocated
-				FROM `tabGL Entry` gle
-				LEFT JOIN (
-					SELECT journal_entry, SUM(allocated_amount) as total_allocated
-					FROM `tabZakaah Allocation History`
-					WHERE docstatus = 1
-					GROUP BY journal_entry
-				) alloc ON alloc.journal_entry = gle.voucher_no
-				WHERE gle.voucher_no IN %(je_list)s
-				AND gle.account LIKE '%%Zakaa Liability%%'
-				AND gle.is_cancelled = 0
-				GROUP BY gle.voucher_no
-			""", {"je_list": unique_jes}, as_dict=True)
-
-			# Build lookup dict
-			for row in current_unallocated:
-				je_unallocated[row.journal_entry] = row.current_unallocated
+			je_unallocated = dict(frappe.db.sql("""
+				SELECT journal_entry, MAX(unallocated_amount)
+				FROM `tabZakaah Payment Ledger`
+				WHERE journal_entry IN %(je_list)s
+				GROUP BY journal_entry
+			""", {"je_list": list(set([h["journal_entry"] for h in history]))}))
 
 		# Replace historical unallocated_amount with current value
 		for record in history:
@@ -594,29 +783,17 @@ def get_payment_accounts_from_settings(company):
 		if not company:
 			return []
 
-		# Find ALL assets configurations for this company (all fiscal years)
-		config_names = frappe.db.get_all(
-			"Zakaah Assets Configuration",
-			filters={"company": company},
-			pluck="name"
-		)
-
-		if not config_names:
-			return []
-
-		# Collect all unique payment accounts from all fiscal years
+		# Collect all unique payment accounts from ALL assets configurations
+		# of the company (all fiscal years), using the cached compiled configurations
 		accounts_dict = {}  # Use dict to avoid duplicates
 
-		for config_name in config_names:
-			config_doc = frappe.get_doc("Zakaah Assets Configuration", config_name)
-
-			if config_doc and hasattr(config_doc, 'payment_accounts') and config_doc.payment_accounts:
-				for row in config_doc.payment_accounts:
-					if row.account and row.account not in accounts_dict:
-						accounts_dict[row.account] = {
-							"account": row.account,
-							"account_name": row.account_name or frappe.db.get_value("Account", row.account, "account_name")
-						}
+		for config in get_company_configs(company):
+			for row in config.get("payment_accounts", []):
+				if row.get("account") and row.get("account") not in accounts_dict:
+					accounts_dict[row.get("account")] = {
+						"account": row.get("account"),
+						"account_name": row.get("account_name")
+					}
 
 		# Return list of accounts
 		return list(accounts_dict.values())
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Batched Currency Exchange lookups for valuing foreign currency accounts."""
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import flt, getdate
+
+EXCHANGE_RATE_CACHE_KEY = "zakaah_exchange_rates"
+
+
+def get_exchange_rates(currencies, to_currency, date):
+    """Return {currency: rate to to_currency} as of date for every currency.
+
+    Rates are the latest Currency Exchange on or before date (an inverse
+    pair is used when only the opposite direction exists), read for all
+    currencies in one query and cached per (currency, to_currency, date).
+    Currencies without a Currency Exchange fall back to ERPNext's
+    get_exchange_rate.
+    """
+    date = str(getdate(date))
+    currencies = sorted(set(c for c in (currencies or []) if c))
+    rates = {currency: 1.0 for currency in currencies if currency == to_currency}
+
+    local_cache = _get_local_cache()
+    missing = []
+    for currency in currencies:
+        if currency in rates:
+            continue
+        field = "{0}::{1}::{2}".format(currency, to_currency, date)
+        rate = local_cache.get(field)
+        if rate is None:
+            rate = frappe.cache().hget(EXCHANGE_RATE_CACHE_KEY, field)
+        if rate is None:
+            missing.append(currency)
+        else:
+            rates[currency] = local_cache[field] = flt(rate)
+
+    if missing:
+        fetched = _get_currency_exchange_rates(missing, to_currency, date)
+        for currency in missing:
+            rate = fetched.get(currency)
+            if not rate:
+                rate = _get_fallback_rate(currency, to_currency, date)
+            if not rate:
+                continue
+            field = "{0}::{1}::{2}".format(currency, to_currency, date)
+            frappe.cache().hset(EXCHANGE_RATE_CACHE_KEY, field, rate)
+            rates[currency] = local_cache[field] = flt(rate)
+
+    return rates
+
+
+def _get_currency_exchange_rates(currencies, to_currency, date):
+    """Latest direct (or inverse) Currency Exchange rate of each currency, in one query"""
+    rows = frappe.db.sql("""
+        SELECT ce.from_currency, ce.to_currency, ce.exchange_rate
+        FROM `tabCurrency Exchange` ce
+        INNER JOIN (
+            SELECT from_currency, to_currency, MAX(`date`) AS latest
+            FROM `tabCurrency Exchange`
+            WHERE `date` <= %(date)s
+                AND ((from_currency IN %(currencies)s AND to_currency = %(to_currency)s)
+                    OR (from_currency = %(to_currency)s AND to_currency IN %(currencies)s))
+            GROUP BY from_currency, to_currency
+        ) latest
+            ON latest.from_currency = ce.from_currency
+            AND latest.to_currency = ce.to_currency
+            AND latest.latest = ce.`date`
+    """, {
+        'date': date,
+        'currencies': currencies,
+        'to_currency': to_currency
+    }, as_dict=True)
+
+    direct, inverse = {}, {}
+    for row in rows:
+        if not flt(row.exchange_rate):
+            continue
+        if row.to_currency == to_currency:
+            direct[row.from_currency] = flt(row.exchange_rate)
+        else:
+            inverse[row.to_currency] = 1 / flt(row.exchange_rate)
+
+    return {**inverse, **direct}
+
+
+def _get_fallback_rate(from_currency, to_currency, date):
+    try:
+        from erpnext.setup.utils import get_exchange_rate
+        return flt(get_exchange_rate(from_currency, to_currency, date))
+    except Exception as e:
+        frappe.log_error(f"Error getting exchange rate {from_currency} to {to_currency} on {date}: {str(e)}", "Exchange Rate")
+        return None
+
+
+def clear_exchange_rate_cache(doc=None, method=None):
+    """Currency Exchange on_update / on_trash: cached rates may have changed"""
+    frappe.cache().delete_value(EXCHANGE_RATE_CACHE_KEY)
+    if hasattr(frappe.local, "zakaah_exchange_rate_cache"):
+        frappe.local.zakaah_exchange_rate_cache = {}
+
+
+def _get_local_cache():
+    if getattr(frappe.local, "zakaah_exchange_rate_cache", None) is None:
+        frappe.local.zakaah_exchange_rate_cache = {}
+    return frappe.local.zakaah_exchange_rate_cache
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+from contextlib import contextmanager
+import frappe
+
+# InnoDB handler counters that together give the rows read by a session
+HANDLER_READ_COUNTERS = (
+    "Handler_read_first",
+    "Handler_read_key",
+    "Handler_read_last",
+    "Handler_read_next",
+    "Handler_read_prev",
+    "Handler_read_rnd",
+    "Handler_read_rnd_next",
+)
+
+
+class QueryCounter(object):
+    """Count frappe.db.sql calls (including get_value, get_all, ...) while active"""
+
+    def __init__(self):
+        self.count = 0
+        self.queries = []
+
+    def __enter__(self):
+        self._previous = frappe.db.__dict__.get("sql")
+        sql = frappe.db.sql
+
+        def counting_sql(query, *args, **kwargs):
+            self.count += 1
+            self.queries.append(str(query))
+            return sql(query, *args, **kwargs)
+
+        frappe.db.sql = counting_sql
+        return self
+
+    def __exit__(self, *exc):
+        if self._previous is None:
+            del frappe.db.sql
+        else:
+            frappe.db.sql = self._previous
+        return False
+
+
+class CalculationProfiler(object):
+    """Record wall time, SQL query count and rows scanned for each phase of a calculation"""
+
+    def __init__(self):
+        self.phases = []
+        self._rows_read_cost = None
+
+    @contextmanager
+    def phase(self, name):
+        if self._rows_read_cost is None:
+            self._rows_read_cost = get_rows_read_cost()
+
+        rows_before = get_rows_read()
+        start = time.monotonic()
+        try:
+            with QueryCounter() as counter:
+                yield
+        finally:
+            wall_time = time.monotonic() - start
+            # Read after the counter exits, so SHOW STATUS is neither counted nor timed;
+            # the rows it scans itself are subtracted
+            rows_read = get_rows_read() - rows_before - self._rows_read_cost
+            self.phases.append({
+                "phase": name,
+                "wall_time_ms": round(wall_time * 1000, 1),
+                "query_count": counter.count,
+                "rows_scanned": max(0, rows_read)
+            })
+
+
+def get_rows_read():
+    """Rows read by this database session so far (MariaDB/MySQL handler counters)"""
+    try:
+        rows = frappe.db.sql("""
+            SHOW SESSION STATUS WHERE Variable_name IN %(counters)s
+        """, {"counters": HANDLER_READ_COUNTERS})
+        return sum(int(value) for name, value in rows)
+    except Exception:
+        return 0
+
+
+def get_rows_read_cost():
+    """Rows one get_rows_read call scans itself (SHOW STATUS reads a temporary table)"""
+    first = get_rows_read()
+    return max(0, get_rows_read() - first)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def assert_query_budget(budget, label="block"):
+    """Raise QueryBudgetExceeded when the block runs more than budget SQL queries"""
+    with QueryCounter() as counter:
+        yield counter
+
+    if counter.count > budget:
+        raise QueryBudgetExceeded("{0} ran {1} queries (budget {2}):\n{3}".format(
+            label, counter.count, budget,
+            "\n".join(" ".join(query.split())[:200] for query in counter.queries)
+        ))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import numpy as np
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+# Nisab is 85 grams of 24K gold per owner, zakaah is 2.5% of the assets
+NISAB_GRAMS_PER_OWNER = 85
+ZAKAAH_RATE = 0.025
+
+# (run field, adjustment key, sign in total assets) for each asset category
+SCENARIO_CATEGORIES = (
+    ('cash_balance', 'cash', 1),
+    ('inventory_balance', 'inventory', 1),
+    ('receivables', 'receivables', 1),
+    ('liabilities', 'liabilities', -1),
+    ('reserves', 'reserves', 1),
+)
+
+
+@frappe.whitelist()
+def evaluate_scenarios(calculation_run_name, gold_prices, owners_counts=None, adjustments=None):
+    """Evaluate zakaah for a grid of what-if scenarios of a calculation run.
+
+    gold_prices and owners_counts are lists; adjustments is a list of
+    {category: margin} dicts using the configuration's margin syntax
+    ("10%", "-5%", "+2000"). Every combination is evaluated in one
+    vectorized pass; nothing is written. zakaah and nisab_met are indexed
+    [adjustment][gold price][owners count].
+    """
+    run = frappe.get_doc("Zakaah Calculation Run", calculation_run_name)
+    run.check_permission("read")
+
+    gold_prices = _parse_list(gold_prices)
+    owners_counts = _parse_list(owners_counts) or [run.owners_count or 1]
+    adjustments = _parse_list(adjustments) or [{}]
+
+    if not gold_prices or any(flt(price) <= 0 for price in gold_prices):
+        frappe.throw(_("Gold prices must be a non-empty list of positive numbers."))
+    if any(cint(count) <= 0 for count in owners_counts):
+        frappe.throw(_("Owner counts must be positive integers."))
+
+    base = np.array([flt(run.get(field)) for field, key, sign in SCENARIO_CATEGORIES])
+    result = compute_scenarios(
+        base,
+        np.array([flt(price) for price in gold_prices]),
+        np.array([cint(count) for count in owners_counts]),
+        adjustments
+    )
+
+    return {
+        "calculation_run": run.name,
+        "gold_prices": [flt(price) for price in gold_prices],
+        "owners_counts": [cint(count) for count in owners_counts],
+        "adjustments": adjustments,
+        "total_assets": np.round(result["total_assets"], 2).tolist(),
+        "nisab_value": np.round(result["nisab_value"], 2).tolist(),
+        "zakaah": np.round(result["zakaah"], 2).tolist(),
+        "nisab_met": result["nisab_met"].astype(int).tolist()
+    }
+
+
+def compute_scenarios(base, gold_prices, owners_counts, adjustments):
+    """Vectorized nisab/zakaah over adjustments (A) x gold prices (G) x owner counts (O).
+
+    base holds the category totals in SCENARIO_CATEGORIES order.
+    """
+    percent, fixed = _parse_adjustments(adjustments)
+    signs = np.array([sign for field, key, sign in SCENARIO_CATEGORIES])
+
+    # (A, categories) adjusted totals, then signed sum per scenario
+    adjusted = base[np.newaxis, :] * (1 + percent / 100) + fixed
+    total_assets = adjusted @ signs                                               # (A,)
+
+    nisab_value = np.outer(gold_prices, owners_counts) * NISAB_GRAMS_PER_OWNER    # (G, O)
+    nisab_met = total_assets[:, np.newaxis, np.newaxis] >= nisab_value[np.newaxis, :, :]
+    zakaah = np.where(nisab_met, total_assets[:, np.newaxis, np.newaxis] * ZAKAAH_RATE, 0.0)
+
+    return {
+        "total_assets": total_assets,
+        "nisab_value": nisab_value,
+        "nisab_met": nisab_met,
+        "zakaah": zakaah
+    }
+
+
+def _parse_adjustments(adjustments):
+    """Split margin strings into (A, categories) percent and fixed amount matrices"""
+    keys = [key for field, key, sign in SCENARIO_CATEGORIES]
+    percent = np.zeros((len(adjustments), len(keys)))
+    fixed = np.zeros((len(adjustments), len(keys)))
+
+    for row, adjustment in enumerate(adjustments):
+        for key, margin in (adjustment or {}).items():
+            if key not in keys:
+                frappe.throw(_("Unknown asset category {0} in adjustments").format(key))
+            margin = str(margin or "").strip()
+            if not margin:
+                continue
+            if '%' in margin:
+                percent[row, keys.index(key)] = flt(margin.replace('%', ''))
+            else:
+                fixed[row, keys.index(key)] = flt(margin)
+
+    return percent, fixed
+
+
+def _parse_list(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]